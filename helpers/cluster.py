@@ -0,0 +1,261 @@
+import os
+import socket
+import sqlite3
+import hashlib
+import logging
+from time import time, monotonic
+from threading import Event, Lock, Thread
+from collections.abc import Iterable
+from typing import NamedTuple, Optional
+
+CLUSTER_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS instances (
+        instance TEXT PRIMARY KEY,
+        heartbeat REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS leases (
+        grp TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires REAL NOT NULL
+    ) WITHOUT ROWID;
+"""
+
+
+def source_groups(sources: tuple[NamedTuple, ...]) -> dict[str, str]:
+    """
+        Returns group of each source. Sources connected by upstream links (in any direction) form single group, so
+        source and its downstream sources are always owned by the same instance (downstream runs are dispatched by
+        worker pool of the instance which ran upstream). Group is named after its first source (alphabetically).
+
+            Parameters:
+                sources (tuple): Collection of all sources
+
+            Returns:
+                groups (dict): Collection of source name: group name
+    """
+    parent = {source.name: source.name for source in sources}
+
+    def _root(name: str) -> str:
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    for source in sources:
+        for upstream in source.upstream:
+            if upstream in parent:
+                a, b = sorted((_root(source.name), _root(upstream)))
+                parent[b] = a
+
+    return {name: _root(name) for name in parent}
+
+
+def preferred_owner(group: str, instances: Iterable[str]) -> Optional[str]:
+    """
+        Returns instance which should own the group (rendezvous hashing): each instance computes the same owner from
+        the same set of live instances, when instance joins or leaves only groups it gains or loses move.
+
+            Parameters:
+                group (str): group name
+                instances (iterable): Collection of live instances
+
+            Returns:
+                owner (str): preferred instance, None if there are no instances
+    """
+    return max(instances, key=lambda instance: hashlib.sha1(f'{instance}\n{group}'.encode()).digest(), default=None)
+
+
+class ClusterMembership:
+    """
+        Membership of watcher instance in a cluster of instances sharing the same config. Sources are split between
+        live instances with leases kept in shared SQLite database (WAL mode, file locking, so all instances have to
+        see the same local filesystem). Every instance keeps heartbeat and renews its leases in background thread,
+        instance which stops renewing for lease_time is dead and its groups are taken over by the others.
+        Rebalancing runs in single transaction: each group should be owned by its preferred instance among live
+        ones, instance releases groups preferred by other instance only while they are idle (no job running or
+        waiting), free or expired groups are taken by their preferred instance (or by any instance once they stay
+        unclaimed for another lease_time). Owned groups are valid until lease_time after last renewal, checked
+        locally before each dispatch, so group is never polled and dispatched by two instances at once.
+
+            Parameters:
+                path (str): path of the shared database file
+                instance (str): optional instance name, defaults to '<host>:<pid>'
+                lease_time (float): validity of leases and heartbeat in seconds
+    """
+
+    def __init__(self, path: str, instance: Optional[str] = None, lease_time: float = 30.0):
+        self.path = path
+        self.instance = instance or f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_time = lease_time
+        self.owned = frozenset()
+        self._valid_until = 0.0
+        self._rebalanced_at = None
+        self._lock = Lock()
+        self._stop = Event()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=lease_time / 3, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(CLUSTER_SCHEMA)
+        self._thread = Thread(target=self._renew_loop, name='cluster', daemon=True)
+
+    def start(self) -> None:
+        """
+            Registers heartbeat of the instance and starts renewing it (with owned leases) in background.
+
+                Returns:
+                    None
+        """
+        self._renew()
+        self._thread.start()
+
+    def _heartbeat(self, now: float) -> None:
+        self._conn.execute('INSERT OR REPLACE INTO instances (instance, heartbeat) VALUES (?, ?)',
+                           (self.instance, now))
+
+    def _renew(self) -> None:
+        with self._lock:
+            now = time()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._heartbeat(now)
+                self._conn.execute('UPDATE leases SET expires = ? WHERE owner = ?', (now + self.lease_time,
+                                                                                    self.instance))
+                leases = {row[0] for row in self._conn.execute('SELECT grp FROM leases WHERE owner = ?',
+                                                               (self.instance,))}
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            # leases taken over while renewal was not possible are lost
+            self.owned = self.owned & leases
+            self._valid_until = now + self.lease_time
+
+    def _renew_loop(self) -> None:
+        while not self._stop.wait(self.lease_time / 3):
+            try:
+                self._renew()
+            except sqlite3.Error as exc:
+                logging.getLogger(__name__).warning(f'Cluster heartbeat of {self.instance} failed ({exc})')
+
+    def rebalance_due(self) -> bool:
+        """
+            Returns True if groups should be rebalanced (every third of lease time).
+        """
+        return self._rebalanced_at is None or monotonic() >= self._rebalanced_at + self.lease_time / 3
+
+    def rebalance(self, groups: Iterable[str], busy: Iterable[str] = ()) -> frozenset[str]:
+        """
+            Rebalances groups between live instances and returns groups owned by this instance. Leases of groups
+            which are no longer configured are released. If shared database is not available, owned groups are kept
+            (until their leases run out).
+
+                Parameters:
+                    groups (iterable): Collection of configured groups
+                    busy (iterable): Collection of groups with jobs running or waiting, they are not released
+
+                Returns:
+                    owned (frozenset): Collection of groups owned by this instance
+        """
+        logger = logging.getLogger(__name__)
+        groups, busy = set(groups), set(busy)
+        self._rebalanced_at = monotonic()
+
+        with self._lock:
+            now = time()
+            expires = now + self.lease_time
+            try:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._heartbeat(now)
+                    self._conn.execute('DELETE FROM instances WHERE heartbeat < ?', (now - self.lease_time,))
+                    live = [row[0] for row in self._conn.execute('SELECT instance FROM instances')]
+                    leases = {row[0]: row[1:] for row in self._conn.execute('SELECT grp, owner, expires FROM leases')}
+                    owned, acquired, released = set(), [], []
+
+                    for group in sorted(groups | {g for g, (owner, _) in leases.items() if owner == self.instance}):
+                        owner, until = leases.get(group, ('', None))
+                        preferred = preferred_owner(group, live)
+
+                        if owner == self.instance:
+                            if group in groups and (preferred == self.instance or group in busy):
+                                owned.add(group)
+                            else:
+                                released.append(group)
+                        elif group in groups and (until is None or until <= now) and \
+                                (preferred == self.instance or (until is not None and until <= now - self.lease_time)):
+                            owned.add(group)
+                            acquired.append(group)
+                        elif until is None:
+                            # unclaimed group, placeholder lets other instances claim it if preferred one never does
+                            self._conn.execute('INSERT INTO leases (grp, owner, expires) VALUES (?, ?, ?)',
+                                               (group, '', now))
+
+                    self._conn.executemany('UPDATE leases SET owner = ?, expires = ? WHERE grp = ?',
+                                           [('', now, group) for group in released])
+                    self._conn.executemany('INSERT OR REPLACE INTO leases (grp, owner, expires) VALUES (?, ?, ?)',
+                                           [(group, self.instance, expires) for group in owned])
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as exc:
+                logger.warning(f'Cluster rebalance of {self.instance} failed ({exc}), owned sources kept')
+                return self.owned
+
+            self._valid_until = expires
+            self.owned = frozenset(owned)
+
+        if acquired or released:
+            logger.info(f'Cluster instance {self.instance} ({len(live)} live) took over: {acquired}, '
+                        f'released: {released}')
+
+        return self.owned
+
+    def owns(self, group: str) -> bool:
+        """
+            Returns True if this instance owns the group and its lease is still valid (checked locally, leases of
+            other instances cannot take over before it expires).
+        """
+        return group in self.owned and time() < self._valid_until
+
+    def leave(self) -> None:
+        """
+            Stops heartbeat and releases all leases of the instance, its groups are taken over by other instances
+            on their next rebalance.
+
+                Returns:
+                    None
+        """
+        self._stop.set()
+
+        with self._lock:
+            try:
+                now = time()
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('UPDATE leases SET owner = ?, expires = ? WHERE owner = ?', ('', now, self.instance))
+                self._conn.execute('DELETE FROM instances WHERE instance = ?', (self.instance,))
+                self._conn.execute('COMMIT')
+            except sqlite3.Error as exc:
+                logging.getLogger(__name__).warning(f'Cluster instance {self.instance} not released ({exc})')
+            finally:
+                self.owned = frozenset()
+                self._conn.close()
+
+
+def owned_sources(sources: tuple[NamedTuple, ...], cluster: Optional[ClusterMembership]) -> tuple[NamedTuple, ...]:
+    """
+        Returns sources owned by the instance, all sources if cluster mode is disabled.
+
+            Parameters:
+                sources (tuple): Collection of all sources
+                cluster (ClusterMembership): optional membership of the instance in cluster
+
+            Returns:
+                sources (tuple): Collection of owned sources
+    """
+    if cluster is None:
+        return sources
+
+    groups = source_groups(sources)
+
+    return tuple(source for source in sources if groups[source.name] in cluster.owned)
@@ -7,10 +7,13 @@ from collections import namedtuple
 from typing import NamedTuple, Optional
 from collections.abc import Callable
 
-from office365.runtime.auth.client_credential import ClientCredential
+from requests import RequestException
 from office365.sharepoint.client_context import ClientContext
 
-from executables import *
+from helpers.stability import stability_window
+from helpers.dispatcher import run_policy, RUN_POLICIES, import_executable
+from helpers.log import log_settings, LOG_OVERFLOW_POLICIES
+from helpers.sharepoint import sp_client_context
 
 
 def source_paths_kwargs(sources: tuple[NamedTuple]) -> dict[str, dict[str, Path]]:
@@ -40,18 +43,25 @@ def source_process_exec(sources: tuple[NamedTuple]) -> dict[str, Callable]:
     return {source.name: source.func for source in sources}
 
 
-def sp_connect_client(site_url: str, client_id: str, client_secret: str, mode: str) -> Optional[ClientContext]:
+_contexts = {}
+
+
+def sp_connect_client(site_url: str, client_id: str, client_secret: str, mode: str,
+                      settings: Optional[NamedTuple] = None) -> Optional[ClientContext]:
     """
         Returns sharepoint context (connector) objects or None if mode is not 'sharepoint' or incorrect credential
-        have been provided or not provided at all. Client ID and Client Secret can be set in '.env' file.
+        have been provided or not provided at all. Client ID and Client Secret can be set in '.env' file. Contexts
+        of the same host share connection pool and access token (cached on disk and refreshed before expiry).
+        Connected contexts are kept, so config reload reconnects only tenants whose entry changed.
 
             Parameters:
                 site_url (str): String with sharepoint tenant address -> 'config.ini'
                 client_id (str): Client ID (login) for sharepoint authentication -> '.env'
                 client_secret (str): Client Secret (password) for sharepoint authentication -> '.env'
-                mode (str ['sharepoint' | 'local']): working mode of SharepointFileWatcher
+                mode (str ['sharepoint' | 'local' | 'all']): working mode of SharepointFileWatcher
                     'sharepoint' -> sharepoint connections prioritized
                     'local' -> local files prioritized
+                settings (NamedTuple): optional engine settings (connection pool size, token cache path)
 
             Returns:
                 ctx (object): Sharepoint connection object (ctx)
@@ -60,21 +70,29 @@ def sp_connect_client(site_url: str, client_id: str, client_secret: str, mode: s
 
     if mode in ['sharepoint', 'all']:
 
+        key = (site_url, client_id, client_secret)
+        if key in _contexts:
+            return _contexts[key]
+
         try:
-            ctx = ClientContext(site_url).with_credentials(ClientCredential(client_id, client_secret))
+            ctx = sp_client_context(site_url, client_id, client_secret,
+                                    getattr(settings, 'sp_connections', 8),
+                                    getattr(settings, 'sp_token_cache', './logs/sp_tokens.json'))
             web = ctx.web
             ctx.load(web)
             ctx.execute_query()
             logger.info(f'Connection to {site_url} successful')
+            _contexts[key] = ctx
             return ctx
-        except ValueError:
+        except (ValueError, RequestException):
             logger.warning(f'Connection to {site_url} UNSUCCESSFUL, Client_id, Client_secret not provided or incorrect')
             return None
     else:
         return None
 
 
-def ctx_parser(config: ConfigParser, mode: str) -> dict[str, Optional[ClientContext]]:
+def ctx_parser(config: ConfigParser, mode: str,
+               settings: Optional[NamedTuple] = None) -> dict[str, Optional[ClientContext]]:
     """
         Returns Dict with sharepoint context object compiled with sharepoint tenant url and client_id, client_secret
         taken from '.env' file.
@@ -82,6 +100,7 @@ def ctx_parser(config: ConfigParser, mode: str) -> dict[str, Optional[ClientCont
             Parameters:
                 config (object): config object -> 'config.ini'
                 mode (str): working mode of application -> '.env'
+                settings (NamedTuple): optional engine settings passed to sharepoint contexts
 
             Returns:
                 ctx_collection (dict): Dict with sharepoint connection object (ctx) of all sources
@@ -98,7 +117,7 @@ def ctx_parser(config: ConfigParser, mode: str) -> dict[str, Optional[ClientCont
         ctx_params[option][ctx_params[option].index(client_id_ref)] = client_id
         ctx_params[option][ctx_params[option].index(client_secret_ref)] = client_secret
 
-    return {k: sp_connect_client(*v, mode) for (k, v) in ctx_params.items()}
+    return {k: sp_connect_client(*v, mode, settings) for (k, v) in ctx_params.items()}
 
 
 def files_parser(config: ConfigParser, ctx_collection: dict[str, Optional[ClientContext]]) -> dict[str, NamedTuple]:
@@ -110,18 +129,19 @@ def files_parser(config: ConfigParser, ctx_collection: dict[str, Optional[Client
                 ctx_collection (dict): collection of sharepoint contexts for given tenants
 
             Returns:
-                files (dict): Dict with file name: file local path, sharepoint context, sharepoint url
+                files (dict): Dict with file name: file local path, sharepoint context, sharepoint url, tenant name
     """
     files = {}
     section = 'Files2monitor'
-    file = namedtuple("file", "local_path, ctx, sp_url",
-                      defaults=[None, None, None])
+    file = namedtuple("file", "local_path, ctx, sp_url, tenant",
+                      defaults=[None, None, None, None])
 
     for filename in config.options(section):
-        files[filename] = config.get(section, filename, raw=False).replace('\n', '', 1).split('\n')
-        files[filename][0] = Path(files[filename][0])
-        files[filename][1] = ctx_collection.get(files[filename][1])
-        files[filename] = file(*files[filename])
+        file_params = config.get(section, filename, raw=False).replace('\n', '', 1).split('\n')
+        # ctx and sharepoint url lines are optional (local only files)
+        tenant = file_params[1] if len(file_params) > 1 else None
+        sp_url = file_params[2] if len(file_params) > 2 else None
+        files[filename] = file(Path(file_params[0]), ctx_collection.get(tenant), sp_url, tenant)
 
     return files
 
@@ -136,7 +156,8 @@ def source_parser(config: ConfigParser, files: dict) -> tuple[NamedTuple, ...]:
 
             Returns:
                 sources (dict): Dict of NamedTuples: name of the resource, related function name from executables, files
-                as Dict with file details (file local path, sharepoint context, sharepoint url)
+                as Dict with file details (file local path, sharepoint context, sharepoint url), names of upstream
+                sources (optional third line of the source entry)
     """
     logger = logging.getLogger(__name__)
 
@@ -144,7 +165,7 @@ def source_parser(config: ConfigParser, files: dict) -> tuple[NamedTuple, ...]:
 
     sources = []
 
-    source = namedtuple("source", "name, func, files", defaults=[None, None, None])
+    source = namedtuple("source", "name, func, files, upstream", defaults=[None, None, None, ()])
 
     try:
         for option in config.options(section):
@@ -159,7 +180,10 @@ def source_parser(config: ConfigParser, files: dict) -> tuple[NamedTuple, ...]:
 
             source_params[1] = file_params
 
-            func = getattr(globals()[module], func_name)
+            if len(source_params) > 2:
+                source_params[2] = tuple(name.strip() for name in source_params[2].split(',') if name.strip())
+
+            func = getattr(import_executable(module), func_name)
             source_params.insert(1, func)
             sources.append(source(*source_params))
     except Exception:
@@ -169,12 +193,278 @@ def source_parser(config: ConfigParser, files: dict) -> tuple[NamedTuple, ...]:
     return tuple(sources)
 
 
-def config_loader(config_path: str) -> tuple[str, int, tuple[NamedTuple, ...], dict[str, Callable], dict[str, dict[str, Path]]]:
+def source_downstream(sources: tuple[NamedTuple, ...]) -> dict[str, tuple[str, ...]]:
+    """
+        Returns Dict with downstream sources of each source (dependency DAG declared by upstream sources). Unknown
+        upstream names and dependency cycles are rejected.
+
+            Parameters:
+                sources (tuple): Collection of all sources
+
+            Returns:
+                downstream (dict): Dict with source name: names of sources depending directly on it
+    """
+    logger = logging.getLogger(__name__)
+    names = {source.name for source in sources}
+    downstream = {source.name: [] for source in sources}
+
+    for source in sources:
+        for upstream in source.upstream:
+            if upstream not in names:
+                logger.critical(f"Upstream source <{upstream}> of <{source.name}> not found in <config.ini>")
+                raise ValueError(f'Unknown upstream source {upstream} of {source.name}')
+            downstream[upstream].append(source.name)
+
+    visited, path = set(), set()
+
+    def _visit(name: str) -> None:
+        if name in path:
+            logger.critical(f"Dependency cycle of sources through <{name}> in <config.ini>")
+            raise ValueError(f'Dependency cycle of sources through {name}')
+        if name in visited:
+            return
+        path.add(name)
+        for child in downstream[name]:
+            _visit(child)
+        path.discard(name)
+        visited.add(name)
+
+    for name in downstream:
+        _visit(name)
+
+    return {name: tuple(children) for name, children in downstream.items()}
+
+
+def source_intervals(config: ConfigParser, sources: tuple[NamedTuple, ...], poll_time: int) -> dict[str, float]:
+    """
+        Returns Dict with base poll interval of each source. Interval can be set in 'Poll_intervals' section per
+        source name or per tenant name (ctx name from 'Sp_ctx'), source setting wins over tenant setting, for source
+        spread over several tenants the longest tenant interval is used. Defaults to poll_time.
+
+            Parameters:
+                config (object): config object -> 'config.ini'
+                sources (tuple): Collection of all sources
+                poll_time (int): default poll interval in seconds
+
+            Returns:
+                intervals (dict): Dict with source name: base poll interval in seconds
+    """
+    section = 'Poll_intervals'
+    intervals = {}
+
+    for source in sources:
+        if config.has_option(section, source.name):
+            intervals[source.name] = config.getfloat(section, source.name)
+            continue
+
+        tenants = {f.tenant for f in source.files.values() if f is not None and f.tenant}
+        tenant_intervals = [config.getfloat(section, tenant) for tenant in tenants
+                            if config.has_option(section, tenant)]
+        intervals[source.name] = max(tenant_intervals, default=float(poll_time))
+
+    return intervals
+
+
+def source_stability(config: ConfigParser, sources: tuple[NamedTuple, ...]) -> dict[str, NamedTuple]:
+    """
+        Returns Dict with write stability window of each source from 'Stability' section. Window can be given in
+        seconds ('<source> = 30') or in polls ('<source> = 3 polls'), '[Environs] stable_time' is a default for
+        sources without entry.
+
+            Parameters:
+                config (object): config object -> 'config.ini'
+                sources (tuple): Collection of all sources
+
+            Returns:
+                windows (dict): Dict with source name: stability_window (seconds, polls)
+    """
+    section = 'Stability'
+    default = config.get('Environs', 'stable_time', fallback='0')
+    windows = {}
+
+    for source in sources:
+        value = config.get(section, source.name, fallback=default).strip().lower()
+        if value.endswith('polls') or value.endswith('poll'):
+            windows[source.name] = stability_window(polls=int(value.split()[0]))
+        else:
+            windows[source.name] = stability_window(seconds=float(value))
+
+    return windows
+
+
+def source_run_policies(config: ConfigParser, sources: tuple[NamedTuple, ...]) -> dict[str, NamedTuple]:
+    """
+        Returns Dict with run policy of each source. What happens when source changes while its executable is still
+        running is set in 'Run_policy' section ('supersede', 'queue' or 'ignore'), wall-clock time limit in seconds
+        in 'Run_timeout' section, '[Environs] run_policy' and 'run_timeout' are defaults for sources without entry.
+        Memory ('run_memory_mb') and CPU time ('run_cpu_time') limits of single run are set in 'Environs' section.
+
+            Parameters:
+                config (object): config object -> 'config.ini'
+                sources (tuple): Collection of all sources
+
+            Returns:
+                policies (dict): Dict with source name: run_policy (on_change, timeout, memory_mb, cpu_time)
+    """
+    logger = logging.getLogger(__name__)
+    section = 'Environs'
+    memory_mb = config.getint(section, 'run_memory_mb', fallback=0)
+    cpu_time = config.getint(section, 'run_cpu_time', fallback=0)
+    default_policy = config.get(section, 'run_policy', fallback='queue')
+    default_timeout = config.get(section, 'run_timeout', fallback='0')
+    policies = {}
+
+    for source in sources:
+        on_change = config.get('Run_policy', source.name, fallback=default_policy).strip().lower()
+        if on_change not in RUN_POLICIES:
+            logger.critical(f"Run policy <{on_change}> of <{source.name}> not supported, use one of {RUN_POLICIES}")
+            raise ValueError(f'Unsupported run policy {on_change} of {source.name}')
+
+        timeout = float(config.get('Run_timeout', source.name, fallback=default_timeout))
+        policies[source.name] = run_policy(on_change, timeout, memory_mb, cpu_time)
+
+    return policies
+
+
+def environs_parser(config: ConfigParser) -> NamedTuple:
+    """
+        Returns NamedTuple with optional engine settings from 'Environs' section, missing options fall back to defaults.
+
+            Parameters:
+                config (object): config object -> 'config.ini'
+
+            Returns:
+                settings (NamedTuple): workers - number of sources polled concurrently,
+                    source_timeout - time budget in seconds for polling single source,
+                    local_events - use filesystem events (inotify) for local sources in 'local' mode,
+                    event_coalesce - quiet period in seconds used to coalesce bursts of filesystem events,
+                    sp_delta - query sharepoint folders with change tokens instead of full listings,
+                    sp_page_size - number of items requested per page of sharepoint folder listing,
+                    sp_connections - maximum number of connections to single sharepoint host,
+                    sp_token_cache - path of on-disk cache of sharepoint access tokens (empty - memory only),
+                    sp_verify_interval - interval in seconds between sharepoint verifications of synced folders
+                        in 'all' mode,
+                    sp_sync_timeout - longest time in seconds remote edit waits for its synced local copy in 'all'
+                        mode,
+                    pool_size - number of long-lived worker processes running executables,
+                    interval_min_factor, interval_max_factor - bounds of adaptive poll interval relative to base one,
+                    interval_backoff - growth of poll interval after each poll without changes,
+                    fingerprint - dispatch local sources only if content of files changed, not just modify date,
+                    metrics_port - port of local metrics endpoint (Prometheus text format), 0 - disabled,
+                    metrics_file - path of periodic JSON snapshot of metrics (empty - disabled),
+                    metrics_interval - interval in seconds between metrics snapshots,
+                    cluster - path of database shared by watcher instances splitting sources (empty - disabled),
+                    cluster_lease - validity of leases and heartbeat of the instance in seconds,
+                    cluster_instance - name of the instance in cluster (empty - '<host>:<pid>'),
+                    state_path - path of state database of files and runs (empty - state.sqlite3 next to cluster
+                        database in cluster mode, otherwise ./logs/state.sqlite3),
+                    intervals - base poll interval of each source (filled in by source_intervals),
+                    stability - write stability window of each source (filled in by source_stability),
+                    downstream - downstream sources of each source (filled in by source_downstream),
+                    policies - run policy and limits of each source (filled in by source_run_policies)
+    """
+    section = 'Environs'
+    settings = namedtuple("settings", "workers, source_timeout, local_events, event_coalesce, "
+                                      "sp_delta, sp_page_size, sp_connections, sp_token_cache, sp_verify_interval, "
+                                      "sp_sync_timeout, pool_size, interval_min_factor, interval_max_factor, "
+                                      "interval_backoff, fingerprint, metrics_port, metrics_file, metrics_interval, "
+                                      "cluster, cluster_lease, cluster_instance, state_path, "
+                                      "intervals, stability, downstream, policies",
+                          defaults=[None, None, None, None])
+
+    cluster = config.get(section, 'cluster', fallback='') or None
+    state_path = config.get(section, 'state_path', fallback='') or \
+        os.path.join(os.path.dirname(cluster) if cluster else './logs', 'state.sqlite3')
+
+    # instances of cluster continue from state stored by each other, state cannot be kept in memory of one of them
+    if cluster and state_path == ':memory:':
+        raise ValueError('state_path has to be database file shared by all instances in cluster mode')
+
+    return settings(config.getint(section, 'workers', fallback=8),
+                    config.getfloat(section, 'source_timeout', fallback=60.0),
+                    config.getboolean(section, 'local_events', fallback=True),
+                    config.getfloat(section, 'event_coalesce', fallback=0.5),
+                    config.getboolean(section, 'sp_delta', fallback=False),
+                    config.getint(section, 'sp_page_size', fallback=500),
+                    config.getint(section, 'sp_connections', fallback=8),
+                    config.get(section, 'sp_token_cache', fallback='./logs/sp_tokens.json') or None,
+                    config.getfloat(section, 'sp_verify_interval', fallback=300.0),
+                    config.getfloat(section, 'sp_sync_timeout', fallback=600.0),
+                    config.getint(section, 'pool_size', fallback=4),
+                    config.getfloat(section, 'interval_min_factor', fallback=0.5),
+                    config.getfloat(section, 'interval_max_factor', fallback=8.0),
+                    config.getfloat(section, 'interval_backoff', fallback=1.5),
+                    config.getboolean(section, 'fingerprint', fallback=False),
+                    config.getint(section, 'metrics_port', fallback=0),
+                    config.get(section, 'metrics_file', fallback='') or None,
+                    config.getfloat(section, 'metrics_interval', fallback=60.0),
+                    cluster,
+                    config.getfloat(section, 'cluster_lease', fallback=30.0),
+                    config.get(section, 'cluster_instance', fallback='') or None,
+                    state_path)
+
+
+def log_level(value: str) -> int:
+    """
+        Returns numeric logging level of level name from config (quotes and case are ignored).
+
+            Parameters:
+                value (str): level name, e.g. 'INFO' or DEBUG
+
+            Returns:
+                level (int): logging level
+    """
+    level = logging.getLevelName(value.strip('\'" ').upper())
+
+    if not isinstance(level, int):
+        raise ValueError(f'Unsupported log level {value}, use one of DEBUG, INFO, WARNING, ERROR, CRITICAL')
+
+    return level
+
+
+def log_settings_loader(config_path: str) -> NamedTuple:
+    """
+        Returns logging settings from 'config.ini': root level ('[Environs]' log_level), capacity and overflow
+        policy of log queue and optional levels of loggers and sources from '[Log_levels]' (entry named as source
+        from '[Sources]' applies while its executable runs). Settings are loaded before the rest of the config,
+        so logging is set up first.
+
+            Parameters:
+                config_path (str): config path -> 'config.ini'
+
+            Returns:
+                settings (log_settings): level, levels, source_levels, queue_size, overflow
+    """
+    config = ConfigParser(interpolation=ExtendedInterpolation(), strict=True)
+    config.optionxform = str
+    config.read(config_path)
+
+    section = 'Environs'
+    overflow = config.get(section, 'log_overflow', fallback='drop')
+
+    if overflow not in LOG_OVERFLOW_POLICIES:
+        raise ValueError(f'Unsupported log overflow policy {overflow}, use one of {LOG_OVERFLOW_POLICIES}')
+
+    sources = set(config.options('Sources')) if config.has_section('Sources') else set()
+    levels = {name: log_level(value) for name, value in config.items('Log_levels', raw=True)} \
+        if config.has_section('Log_levels') else {}
+
+    return log_settings(log_level(config.get(section, 'log_level', fallback='INFO')),
+                        {name: level for name, level in levels.items() if name not in sources},
+                        {name: level for name, level in levels.items() if name in sources},
+                        config.getint(section, 'log_queue_size', fallback=10_000),
+                        overflow)
+
+
+def config_loader(config_path: str, reload: bool = False) -> tuple[str, int, tuple[NamedTuple, ...],
+                                                                   dict[str, Callable], dict[str, dict[str, Path]],
+                                                                   NamedTuple]:
     """
         Main function for config parsing. Returns Tuple of all config values based on 'config.ini' and '.env'.
 
             Parameters:
                 config_path (str): config path -> 'config.ini'
+                reload (bool): config is reloaded, values from '.env' replace those loaded before
 
             Returns:
                 mode: working mode of application ['sharepoint' | 'local']
@@ -183,6 +473,7 @@ def config_loader(config_path: str) -> tuple[str, int, tuple[NamedTuple, ...], d
                     and attached executable functions to be triggered
                 source_exec: helper Dict with collection of all executable functions
                 source_paths: helper Dict with collection of all first monitored files (Process kwargs)
+                settings: optional engine settings (concurrency, timeouts, poll intervals, dependencies of sources)
     """
     logger = logging.getLogger(__name__)
 
@@ -195,6 +486,7 @@ def config_loader(config_path: str) -> tuple[str, int, tuple[NamedTuple, ...], d
 
         mode = config.get('Environs', 'mode')
         poll_time = config.getint('Environs', 'poll_time')
+        settings = environs_parser(config)
     except NoSectionError:
         logger.critical(f"Config file <{config_path}> NOT LOADED. Check file name <config.ini> or path <./config.ini>")
         raise
@@ -202,7 +494,7 @@ def config_loader(config_path: str) -> tuple[str, int, tuple[NamedTuple, ...], d
     env = './.env'
 
     try:
-        load_dotenv(env)
+        load_dotenv(env, override=reload)
         logger.info(f'Config file from {env} successfully loaded')
     except Exception:
         logger.warning(
@@ -210,11 +502,15 @@ def config_loader(config_path: str) -> tuple[str, int, tuple[NamedTuple, ...], d
             f"by default should be named <.env> and located in root folder")
         raise
 
-    ctx_objects = ctx_parser(config, mode)
+    ctx_objects = ctx_parser(config, mode, settings)
     files = files_parser(config, ctx_objects)
     sources = source_parser(config, files)
 
     source_paths = source_paths_kwargs(sources)
     source_exec = source_process_exec(sources)
+    settings = settings._replace(intervals=source_intervals(config, sources, poll_time),
+                                 stability=source_stability(config, sources),
+                                 downstream=source_downstream(sources),
+                                 policies=source_run_policies(config, sources))
 
-    return mode, poll_time, sources, source_exec, source_paths
+    return mode, poll_time, sources, source_exec, source_paths, settings
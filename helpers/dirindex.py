@@ -0,0 +1,145 @@
+import os
+from pathlib import Path
+from threading import Lock, local
+from contextlib import contextmanager
+from time import time_ns
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+
+from helpers.patterns import PatternMatcher, pattern_matcher
+
+
+# listing is trusted only if directory has not been touched within this window before the scan (mtime granularity)
+RACY_WINDOW_NS = 2_000_000_000
+
+
+class DirectoryIndex:
+    """
+        Per-directory index of file names. Each unique directory is listed at most once per cycle and is not listed
+        again as long as its own modify time stays the same. Configured names and patterns are compiled into single
+        matcher and checked against that listing in one pass (result is kept until listing changes), only matched
+        files are stat'ed (once per cycle, even if shared by many sources).
+        Recursive patterns ('**', 'sub/*.csv') walk only subfolders their patterns can reach, each subfolder has its
+        own cached listing, so unchanged parts of the tree are not listed again.
+        Directory modify time changes only when entries are added, removed or renamed, content changes of files
+        are caught by stat of matched files.
+    """
+
+    def __init__(self):
+        self._listings = {}
+        self._matches = {}
+        self._stats = {}
+        self._locks = defaultdict(Lock)
+        self._lock = Lock()
+        self._local = local()
+
+    def new_cycle(self) -> None:
+        """
+            Starts new polling cycle, drops stats of files collected in the previous one. Inside own_cycle only
+            stats of the own cycle of calling thread are dropped.
+
+                Returns:
+                    None
+        """
+        own = getattr(self._local, 'stats', None)
+
+        if own is not None:
+            own.clear()
+            return
+
+        with self._lock:
+            self._stats = {}
+
+    @contextmanager
+    def own_cycle(self) -> Iterator[None]:
+        """
+            Runs lookups of calling thread in its own cycle (e.g. refresh of single source while main polling cycle
+            is in progress), its stats are collected separately, shared cycle is neither used nor reset.
+        """
+        self._local.stats = {}
+        try:
+            yield
+        finally:
+            del self._local.stats
+
+    def _directory_lock(self, directory: str) -> Lock:
+        with self._lock:
+            return self._locks[directory]
+
+    def _listing(self, directory: str) -> tuple[frozenset[str], frozenset[str]]:
+        dir_mtime = os.stat(directory).st_mtime_ns
+        cached = self._listings.get(directory)
+
+        if cached is not None and cached[0] == dir_mtime and dir_mtime < cached[1] - RACY_WINDOW_NS:
+            return cached[2]
+
+        scanned_at = time_ns()
+        files, directories = set(), set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    files.add(entry.name)
+                elif entry.is_dir(follow_symlinks=False):
+                    directories.add(entry.name)
+        listing = frozenset(files), frozenset(directories)
+        self._listings[directory] = (dir_mtime, scanned_at, listing)
+
+        return listing
+
+    def _match(self, directory: str, prefix: str, matcher: PatternMatcher) -> tuple[str, ...]:
+        try:
+            listing = self._listing(directory)
+        except (FileNotFoundError, NotADirectoryError):
+            if not prefix:
+                raise
+            return ()
+
+        cached = self._matches.get((directory, prefix, matcher))
+
+        if cached is None or cached[0] is not listing:
+            cached = (listing, tuple(sorted(matcher.filter(prefix + name for name in listing[0]))))
+            self._matches[(directory, prefix, matcher)] = cached
+
+        matched = cached[1]
+
+        if matcher.recursive:
+            for name in sorted(listing[1]):
+                if matcher.descend(prefix + name):
+                    matched += self._match(os.path.join(directory, name), f'{prefix}{name}/', matcher)
+
+        return matched
+
+    def lookup(self, directory: Path, files: Iterable[str]) -> dict[str, os.stat_result]:
+        """
+            Returns stats of files from given directory (and its subfolders for recursive patterns) matching any of
+            given names or patterns.
+
+                Parameters:
+                    directory (Path): path object of monitored directory
+                    files (iterable): Collection of file names and file patterns (see helpers.patterns)
+
+                Returns:
+                    matched (dict): Collection of relative file path ('/' as separator): stat result of matched files
+        """
+        directory = os.fspath(directory)
+        matched = {}
+
+        own = getattr(self._local, 'stats', None)
+
+        with self._directory_lock(directory):
+            if own is not None:
+                stats = own.setdefault(directory, {})
+            else:
+                with self._lock:
+                    stats = self._stats.setdefault(directory, {})
+
+            for name in self._match(directory, '', pattern_matcher(frozenset(files))):
+                if name not in stats:
+                    try:
+                        stats[name] = os.stat(os.path.join(directory, name))
+                    except FileNotFoundError:
+                        self._listings.pop(os.path.dirname(os.path.join(directory, name)), None)
+                        continue
+                matched[name] = stats[name]
+
+        return matched
@@ -0,0 +1,538 @@
+import os
+import sys
+import signal
+import inspect
+import logging
+import importlib
+import multiprocessing
+from collections import deque, namedtuple
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Queue
+from multiprocessing.connection import Connection, wait
+from threading import Lock, Thread
+from time import monotonic
+from types import ModuleType
+from typing import Any, NamedTuple, Optional, NoReturn
+
+from helpers.log import source_log_level
+from helpers.metrics import JOBS, JOB_SECONDS
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# on_change: what happens to the running job when its source changes again, 'supersede' - job is cancelled and
+# restarted, 'queue' - single follow-up run once job finishes, 'ignore' - change waits for the next run
+run_policy = namedtuple("run_policy", "on_change, timeout, memory_mb, cpu_time", defaults=['queue', 0.0, 0, 0])
+RUN_POLICIES = ('supersede', 'queue', 'ignore')
+
+
+def accepts_changes(func: Callable) -> bool:
+    """
+        Returns True if executable accepts 'changes' argument (added, modified and removed files since its last
+        successful run), executables without it are called with source paths only.
+
+            Parameters:
+                func (Callable): executable function
+
+            Returns:
+                accepts (bool): True if 'changes' argument is accepted
+    """
+    try:
+        return 'changes' in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+_executables_mtimes = {}
+
+
+def import_executable(module: str) -> ModuleType:
+    """
+        Returns module of executables package, module whose file changed since it was imported is reloaded, so
+        edited and newly added functions are picked up without restart (config reload, long-lived workers).
+
+            Parameters:
+                module (str): module name within executables package
+
+            Returns:
+                module (ModuleType): imported module
+    """
+    name = f'executables.{module}'
+    if name not in sys.modules:
+        importlib.invalidate_caches()
+    imported = importlib.import_module(name)
+
+    try:
+        mtime = os.stat(imported.__file__).st_mtime_ns
+    except (OSError, TypeError):
+        return imported
+
+    if _executables_mtimes.setdefault(name, mtime) != mtime:
+        imported = importlib.reload(imported)
+        _executables_mtimes[name] = mtime
+
+    return imported
+
+
+def apply_limits(memory_mb: int, cpu_time: int) -> None:
+    """
+        Sets resource limits (rlimits) of the worker process for the next job, 0 means no limit. Memory limit caps
+        address space of the process (allocation above it fails with MemoryError), CPU time is counted from now on,
+        process exceeding it is killed by the system (SIGXCPU). Not available on platforms without 'resource'.
+
+            Parameters:
+                memory_mb (int): address space limit in MB
+                cpu_time (int): CPU time limit in seconds
+
+            Returns:
+                None
+    """
+    if resource is None:
+        return
+
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    soft = memory_mb * 1024 * 1024 if memory_mb else hard
+    resource.setrlimit(resource.RLIMIT_AS, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    soft = int(usage.ru_utime + usage.ru_stime) + 1 + cpu_time if cpu_time else hard
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+
+def run_limited(func: Callable, memory_mb: int, cpu_time: int, kwargs: dict) -> None:
+    """
+        Runs executable within resource limits, used as target of standalone Process.
+
+            Parameters:
+                func (Callable): executable function
+                memory_mb (int): address space limit in MB
+                cpu_time (int): CPU time limit in seconds
+                kwargs (dict): kwargs for executable function
+
+            Returns:
+                None
+    """
+    apply_limits(memory_mb, cpu_time)
+    func(**kwargs)
+
+
+def worker_loop(conn: Connection, configurer: Callable, queue: Queue) -> NoReturn:
+    """
+        Main loop of long-lived worker process. Imports all executables upfront (pre-warm), then executes jobs
+        received from dispatcher one by one (within resource limits of the job) and reports the outcome back.
+
+            Parameters:
+                conn (Connection): worker end of the pipe to dispatcher
+                configurer (Callable): logger configurer for worker to capture logs from independent Process
+                queue (Queue): container for logs transportation between Processes
+
+            Returns:
+                None
+    """
+    configurer(queue)
+    logger = logging.getLogger(__name__)
+
+    executables = importlib.import_module('executables')
+    for module in executables.__all__:
+        import_executable(module)
+
+    while True:
+        try:
+            # job refers to its executable by name, modules edited since they were imported are reloaded first
+            conn.poll(None)
+            for name in [name for name in sys.modules if name.startswith('executables.')]:
+                import_executable(name.split('.', 1)[1])
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        source, func, kwargs, changes, (memory_mb, cpu_time) = job
+        kwargs = dict(kwargs or {})
+        if changes is not None and accepts_changes(func):
+            kwargs['changes'] = changes
+        started = monotonic()
+
+        try:
+            apply_limits(memory_mb, cpu_time)
+            with source_log_level(source):
+                func(**kwargs)
+            result = (source, 0, None, monotonic() - started)
+        except Exception as exc:
+            logger.exception(f'Executable of {source} failed')
+            result = (source, 1, f'{exc.__class__.__name__}: {exc}', monotonic() - started)
+        finally:
+            apply_limits(0, 0)
+
+        conn.send(result)
+
+
+class Worker:
+    """
+        Handle of single worker process in the pool.
+    """
+
+    def __init__(self, name: str, configurer: Callable, queue: Queue):
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_loop, args=(child_conn, configurer, queue), name=name,
+                                       daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.source = None
+        self.started = None
+        self.changes = None
+        self.preparing = None
+
+
+class WorkerPool:
+    """
+        Persistent pool of pre-warmed worker processes which run executables asynchronously. Dispatch does not block,
+        polling keeps running while jobs are in flight. A source which changes again while its job is still running
+        gets exactly one follow-up run once the current one finishes, never two parallel runs. Sources can depend
+        on each other (DAG), downstream source is run as soon as its upstream finishes successfully and it waits
+        while any of its (transitive) upstreams is running or waiting, so it runs once even if several upstreams
+        changed, independent branches run in parallel. Policy of each source decides what happens when it changes
+        while running (supersede, queue or ignore) and limits wall-clock time, memory and CPU time of its runs,
+        worker running over time is killed and replaced.
+
+            Parameters:
+                size (int): number of worker processes
+                configurer (Callable): logger configurer for workers to capture logs from independent Process
+                queue (Queue): container for logs transportation between Processes
+                changes (Callable): optional provider of changes of the source since its last successful run, called
+                    when job is started (in separate thread, outside of the pool lock, worker is reserved meanwhile),
+                    passed to executables accepting 'changes' argument
+                on_finished (Callable): optional callback called with source, delivered changes, exit code and error
+                    message once job ends
+                downstream (dict): optional Collection of source name: names of sources depending directly on it
+                policies (dict): optional Collection of source name: run_policy, default policy queues follow-up
+                    run without limits
+    """
+
+    def __init__(self, size: int, configurer: Callable, queue: Queue, changes: Optional[Callable] = None,
+                 on_finished: Optional[Callable] = None, downstream: Optional[dict[str, tuple[str, ...]]] = None,
+                 policies: Optional[dict[str, NamedTuple]] = None):
+        self.size = max(1, size)
+        self._configurer = configurer
+        self._queue = queue
+        self._changes = changes
+        self._on_finished = on_finished
+        self._downstream = downstream or {}
+        self._upstream = self._ancestors(self._downstream)
+        self._policies = policies or {}
+        self._lock = Lock()
+        self._jobs = {}
+        self._exec, self._kwargs = {}, {}
+        self._waiting = deque()
+        self._follow_up = set()
+        self._spawned = 0
+        self._closing = False
+        self._wakeup_r, self._wakeup_w = multiprocessing.Pipe(duplex=False)
+        self._wakeup_lock = Lock()
+        self._preparer = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix='dispatcher')
+        self._workers = [self._spawn() for _ in range(self.size)]
+        self._monitor = Thread(target=self._monitor_loop, name='dispatcher', daemon=True)
+        self._monitor.start()
+
+    def configure(self, changes: Optional[Callable] = None, downstream: Optional[dict[str, tuple[str, ...]]] = None,
+                  policies: Optional[dict[str, NamedTuple]] = None) -> None:
+        """
+            Applies new configuration of sources (after config reload), running and waiting jobs are kept.
+
+                Parameters:
+                    changes (Callable): provider of changes of the source since its last successful run
+                    downstream (dict): Collection of source name: names of sources depending directly on it
+                    policies (dict): Collection of source name: run_policy
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._changes = changes
+            self._downstream = downstream or {}
+            self._upstream = self._ancestors(self._downstream)
+            self._policies = policies or {}
+
+        self._wake()
+
+    def _wake(self) -> None:
+        with self._wakeup_lock:
+            self._wakeup_w.send(None)
+
+    @staticmethod
+    def _ancestors(downstream: dict[str, tuple[str, ...]]) -> dict[str, set[str]]:
+        ancestors = {}
+
+        def _collect(name: str, upstream: str) -> None:
+            for child in downstream.get(name, ()):
+                if upstream not in ancestors.setdefault(child, set()):
+                    ancestors[child].add(upstream)
+                    _collect(child, upstream)
+
+        for name in downstream:
+            _collect(name, name)
+
+        return ancestors
+
+    def _spawn(self) -> Worker:
+        self._spawned += 1
+        return Worker(f'Worker-{self._spawned}', self._configurer, self._queue)
+
+    def dispatch(self, sources: list[str], source_exec: dict[str, Callable], source_kwargs: dict[str, dict]) -> None:
+        """
+            Schedules executables of given sources, returns immediately. Source already running is handled by its
+            policy (cancelled and restarted, coalesced into single follow-up run or ignored), source already waiting
+            is not queued twice.
+
+                Parameters:
+                    sources (list): Collection of modified sources
+                    source_exec (dict): helper dictionary with executable functions
+                    source_kwargs (dict): helper dictionary with kwargs for executable functions
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._exec, self._kwargs = source_exec, source_kwargs
+            for source in sources:
+                self._enqueue(source)
+
+        self._wake()
+
+    def _enqueue(self, source: str) -> None:
+        logger = logging.getLogger(__name__)
+        self._jobs[source] = (source, self._exec.get(source), self._kwargs.get(source))
+
+        running = next((worker for worker in self._workers if worker.source == source), None)
+
+        if running is not None:
+            on_change = self._policy(source).on_change
+            if on_change == 'ignore':
+                logger.info(f'{source} is still running, change ignored until next run')
+            elif on_change == 'supersede' and running.started is not None:
+                self._follow_up.add(source)
+                self._stop(running, f'{source} superseded by newer change')
+            else:
+                if source not in self._follow_up:
+                    logger.info(f'{source} is still running, follow-up run scheduled')
+                self._follow_up.add(source)
+        elif source not in self._waiting:
+            self._waiting.append(source)
+
+    @property
+    def in_flight(self) -> int:
+        """
+            Returns number of running, waiting and follow-up jobs.
+        """
+        with self._lock:
+            return sum(worker.source is not None for worker in self._workers) + len(self._waiting) + \
+                len(self._follow_up)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+            Returns number of jobs waiting for worker, including follow-up runs of running sources.
+        """
+        with self._lock:
+            return len(self._waiting) + len(self._follow_up)
+
+    @property
+    def running(self) -> int:
+        """
+            Returns number of jobs running in workers.
+        """
+        with self._lock:
+            return sum(worker.source is not None for worker in self._workers)
+
+    @property
+    def busy(self) -> set[str]:
+        """
+            Returns names of sources with running, waiting or follow-up jobs.
+        """
+        with self._lock:
+            return {worker.source for worker in self._workers if worker.source is not None} | \
+                set(self._waiting) | self._follow_up
+
+    def _policy(self, source: str) -> NamedTuple:
+        return self._policies.get(source) or run_policy()
+
+    def _stop(self, worker: Worker, reason: str) -> None:
+        logging.getLogger(__name__).error(f'{reason}, {worker.process.name} killed')
+        worker.process.kill()
+        worker.process.join(5)
+        self._finished(worker, -1, reason)
+        self._workers[self._workers.index(worker)] = self._spawn()
+
+    def _deadline(self) -> Optional[float]:
+        deadlines = [worker.started + self._policy(worker.source).timeout for worker in self._workers
+                     if worker.started is not None and self._policy(worker.source).timeout]
+        return min(deadlines, default=None)
+
+    def _ready(self) -> Optional[str]:
+        active = {worker.source for worker in self._workers} | set(self._waiting) | self._follow_up
+
+        for source in self._waiting:
+            if not self._upstream.get(source, set()) & active:
+                return source
+
+        return None
+
+    def _assign(self) -> None:
+        for worker in self._workers:
+            if worker.source is not None:
+                continue
+
+            source = self._ready()
+            if source is None:
+                return
+
+            self._waiting.remove(source)
+            worker.source = source
+
+            if self._changes is None:
+                self._send(worker, None)
+            else:
+                # changes may refresh state of the source (polling), worker stays reserved until they are ready
+                worker.preparing = self._preparer.submit(self._source_changes, self._changes, source)
+                worker.preparing.add_done_callback(lambda _: self._wake())
+
+    def _send(self, worker: Worker, changes: Any) -> None:
+        policy = self._policy(worker.source)
+
+        try:
+            worker.conn.send((*self._jobs[worker.source], changes, (policy.memory_mb, policy.cpu_time)))
+        except (BrokenPipeError, OSError):
+            self._waiting.appendleft(worker.source)
+            worker.source = None
+            return
+
+        worker.started, worker.changes = monotonic(), changes
+        logging.getLogger(__name__).info(f'{worker.source} dispatched to {worker.process.name}')
+
+    def _start_prepared(self) -> None:
+        for worker in self._workers:
+            if worker.preparing is None or not worker.preparing.done():
+                continue
+
+            changes, worker.preparing = worker.preparing.result(), None
+
+            if self._closing:
+                worker.source = None
+            else:
+                self._send(worker, changes)
+
+    @staticmethod
+    def _source_changes(provider: Callable, source: str) -> Any:
+        try:
+            return provider(source)
+        except Exception:
+            logging.getLogger(__name__).exception(f'Changes of {source} not available')
+            return None
+
+    def _finished(self, worker: Worker, exitcode: int, error: Optional[str] = None) -> None:
+        source, changes, started = worker.source, worker.changes, worker.started
+        worker.source, worker.started, worker.changes = None, None, None
+
+        if source is not None:
+            JOBS.inc(source, exitcode)
+            JOB_SECONDS.observe(monotonic() - started, source)
+
+        if self._on_finished is not None and source is not None:
+            try:
+                self._on_finished(source, changes, exitcode, error)
+            except Exception:
+                logging.getLogger(__name__).exception(f'Outcome of {source} not recorded')
+
+        if source in self._follow_up:
+            self._follow_up.discard(source)
+            self._waiting.append(source)
+
+        if exitcode and self._downstream.get(source):
+            logging.getLogger(__name__).warning(f'{source} failed, downstream sources not triggered: '
+                                                f'{", ".join(self._downstream[source])}')
+        elif source is not None and not self._closing:
+            for child in self._downstream.get(source, ()):
+                self._enqueue(child)
+
+    def _monitor_loop(self) -> None:
+        logger = logging.getLogger(__name__)
+
+        while not self._closing:
+            with self._lock:
+                # reserved workers are idle until their job is sent, their death is noticed on send
+                workers = {worker.conn: worker for worker in self._workers if worker.preparing is None}
+                workers.update({worker.process.sentinel: worker for worker in self._workers
+                                if worker.preparing is None})
+                deadline = self._deadline()
+
+            timeout = None if deadline is None else max(0.0, deadline - monotonic())
+
+            for ready in wait([self._wakeup_r, *workers], timeout):
+                if ready is self._wakeup_r:
+                    self._wakeup_r.recv()
+                    continue
+
+                worker = workers[ready]
+
+                with self._lock:
+                    if worker not in self._workers:
+                        continue
+                    if ready is worker.conn:
+                        try:
+                            source, exitcode, error, runtime = worker.conn.recv()
+                        except (EOFError, OSError):
+                            continue
+                        if exitcode:
+                            logger.error(f'{source} failed after {runtime:.1f} sec: {error}')
+                        else:
+                            logger.info(f'{source} finished in {runtime:.1f} sec')
+                        self._finished(worker, exitcode, error)
+                    elif not worker.process.is_alive() and not self._closing:
+                        exitcode = worker.process.exitcode
+                        reason = 'CPU time limit exceeded' if exitcode == -getattr(signal, 'SIGXCPU', 0) else \
+                            f'exit code {exitcode}'
+                        logger.error(f'{worker.process.name} died ({reason}) while running {worker.source}')
+                        self._finished(worker, exitcode or -1, f'{worker.process.name} died ({reason})')
+                        self._workers[self._workers.index(worker)] = self._spawn()
+
+            with self._lock:
+                now = monotonic()
+                for worker in list(self._workers):
+                    limit = self._policy(worker.source).timeout if worker.started is not None else 0
+                    if limit and now >= worker.started + limit and not self._closing:
+                        self._stop(worker, f'{worker.source} exceeded run timeout of {limit} sec')
+                self._start_prepared()
+                self._assign()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+            Stops worker processes once their current jobs finish, waiting jobs are dropped.
+
+                Parameters:
+                    timeout (float): time in seconds to wait for each worker, afterwards worker is terminated
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._closing = True
+            self._waiting.clear()
+            self._follow_up.clear()
+
+        self._wake()
+        self._preparer.shutdown(wait=False)
+
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
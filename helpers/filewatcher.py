@@ -1,44 +1,58 @@
 import os
-import glob
-import pickle
 import logging
 from collections.abc import Callable
+from functools import partial
 from pathlib import Path
 
 from time import altzone
-from datetime import datetime, timedelta
-from collections import namedtuple
-from typing import NamedTuple, NoReturn
+from time import monotonic
+from datetime import datetime, timedelta, timezone
+from collections import namedtuple, defaultdict
+from typing import NamedTuple, NoReturn, Optional
 from multiprocessing import Process, Queue
 
+from office365.sharepoint.client_context import ClientContext
 
-def paths_from_file_pattern(local_path: Path, file_pat: str) -> list:
-    """
-        Returns List of absolute paths with file name based on given path and file pattern.
+from helpers.poller import SourcePoller
+from helpers.dispatcher import WorkerPool, accepts_changes, run_limited, run_policy
+from helpers.fingerprint import FingerprintCache
+from helpers.dirindex import DirectoryIndex
+from helpers.hybrid import RemoteViews, file_view, whole_seconds
+from helpers.patterns import pattern_matcher
+from helpers.metrics import SOURCE_POLL_SECONDS, JOBS, JOB_SECONDS
+from helpers.sharepoint import sp_rest_client, sp_folder_files, sp_delta_tracker, sp_delta_new_cycle, \
+    sp_delta_own_cycle
+from helpers.state import file_state, StateStore
 
-            Parameters:
-                local_path (Path): path object
-                file_pat (str): string with '*' (pattern*.ext), where '*' plays a role of placeholder for variable part
-                    of file name
+file_modify_date = namedtuple("file_modify_date", "fname, modify_date, size, path, mtime_ns",
+                              defaults=[None, None, None, None, None])
 
-            Returns:
-                paths (list): list of absolute paths with file names
-    """
-    paths = os.path.join(local_path, file_pat)
-    return glob.glob(paths)
+directory_index = DirectoryIndex()
+remote_views = RemoteViews()
 
 
-def fname_extractor(paths: list) -> list:
+def local_source_stats(single_source: NamedTuple) -> dict[str, os.stat_result]:
     """
-        Returns Dict with local paths and file names for pandas script.
+        Returns stats of all local files of single source. Files are grouped by directory, each directory is resolved
+        with single lookup in shared directory index.
 
             Parameters:
-                paths (list): Collection of file names
+                single_source (NamedTuple): Collection of details regarding single source from sources (paths, ctx, file names)
 
             Returns:
-                file_names (list): Collection of file names extracted from given path
+                local_files_stats (dict): Collection of absolute file path: stat result
     """
-    return [os.path.basename(x) for x in paths]
+    local_files_stats = {}
+    directories = defaultdict(list)
+
+    for file, file_params in single_source.files.items():
+        directories[file_params.local_path].append(file)
+
+    for local_path, files in directories.items():
+        for fname, stat in directory_index.lookup(local_path, files).items():
+            local_files_stats[os.path.join(local_path, fname)] = stat
+
+    return local_files_stats
 
 
 def local_files_modify_dates_extractor(single_source: NamedTuple) -> list:
@@ -50,144 +64,324 @@ def local_files_modify_dates_extractor(single_source: NamedTuple) -> list:
                 single_source (NamedTuple): Collection of details regarding single source from sources (paths, ctx, file names)
 
             Returns:
-                local_files_mod_dates (list): Collection of file names and last modify dates from local paths
+                local_files_mod_dates (list): Collection of file names, last modify dates, sizes and paths from local
+                    paths
     """
-    local_files_mod_dates = []
+    return [file_modify_date(os.path.basename(path), datetime.fromtimestamp(stat.st_mtime), stat.st_size, path,
+                             stat.st_mtime_ns)
+            for path, stat in local_source_stats(single_source).items()]
 
-    for file, file_params in single_source.files.items():
 
-        if '*' in file:
-            file_paths = paths_from_file_pattern(file_params.local_path, file)
-            local_files = fname_extractor(file_paths)
-        else:
-            local_files = file
+def sp_modify_date(time_last_modified: str) -> datetime:
+    """
+        Returns local modify date based on sharepoint 'TimeLastModified' (UTC, ISO format with 'Z' suffix).
+
+            Parameters:
+                time_last_modified (str): sharepoint time stamp
 
-        file_mod_date = namedtuple("file_modify_date", "fname, modify_date", defaults=[None, None])
+            Returns:
+                modify_date (datetime): modify date
+    """
+    return datetime.fromisoformat(time_last_modified[:-1]) + timedelta(seconds=abs(altzone))
 
-        for file_obj in os.scandir(file_params.local_path):
-            if os.path.isfile(file_obj.path) and (file_obj.name in local_files):
-                local_files_mod_dates.append(file_mod_date(file_obj.name,
-                                                           datetime.fromtimestamp(file_obj.stat().st_mtime)))
 
-    return local_files_mod_dates
+def sp_modify_time_ns(time_last_modified: str) -> int:
+    """
+        Returns sharepoint 'TimeLastModified' (UTC, ISO format with 'Z' suffix) as nanoseconds since epoch.
 
+            Parameters:
+                time_last_modified (str): sharepoint time stamp
 
-def sp_files_modify_dates_extractor(single_source: NamedTuple) -> list:
+            Returns:
+                mtime_ns (int): modify time in nanoseconds
+    """
+    return int(datetime.fromisoformat(time_last_modified[:-1]).replace(tzinfo=timezone.utc).timestamp()) * 10 ** 9
+
+
+def sp_files_modify_dates_extractor(single_source: NamedTuple,
+                                    sp_delta: bool = False,
+                                    page_size: int = 500,
+                                    store: Optional[StateStore] = None) -> list:
     """
         Returns collection of file name and last modify date for single source for sharepoint resources.
-        Supports file name patterns.
+        Supports file name patterns, each folder is listed once for all names and patterns of the source. In delta
+        mode only changes since last change token of the document library are queried (recursive patterns always
+        list the folder tree), otherwise folder is listed with server side filter on file name and only required
+        fields, page by page.
 
             Parameters:
                 single_source (NamedTuple): Collection of details regarding single source from sources (paths, ctx, file names)
+                sp_delta (bool): use change token (delta) queries instead of full folder listings
+                page_size (int): number of items requested per page of folder listing
+                store (StateStore): optional state store keeping change tokens of delta mode
 
             Returns:
-                sp_files_mod_dates (list): Collection of file names and last modify dates from the sharepoint resources
+                sp_files_mod_dates (list): Collection of file names, last modify dates, sizes and urls from the
+                    sharepoint resources
     """
     sp_files_mod_dates = []
-    file_mod_date = namedtuple("file_modify_date", "fname, modify_date", defaults=[None, None])
+    folders = defaultdict(list)
 
     for file, file_params in single_source.files.items():
-        ctx = file_params.ctx
-        folder_url = file_params.sp_url
-
-        folder = ctx.web.get_folder_by_server_relative_url(folder_url).get().execute_query()
-        files = folder.files
-        ctx.load(files)
-        ctx.execute_query()
-
-        if '*' in file:
-            sp_files = [file_mod_date(f.name, datetime.fromisoformat(f.time_last_modified[:-1]) + timedelta(
-                seconds=abs(altzone)))
-                        for f in files if
-                        f.name.startswith(file.split('*', 1)[0]) and f.name.endswith(file.split('*', 1)[1])]
-        else:
-            sp_files = [file_mod_date(f.name, datetime.fromisoformat(f.time_last_modified[:-1]) + timedelta(
-                seconds=abs(altzone)))
-                        for f in files if f.name == file]
+        folders[(file_params.ctx, file_params.sp_url)].append(file)
+
+    for (ctx, folder_url), files in folders.items():
+        sp_files = [file_modify_date(f.name.rsplit('/', 1)[-1], sp_modify_date(f.time_last_modified), f.length,
+                                     f"{folder_url.rstrip('/')}/{f.name}", sp_modify_time_ns(f.time_last_modified))
+                    for f in sp_folder_listing(ctx, folder_url, files, sp_delta, page_size, store)]
 
         sp_files_mod_dates.extend(sp_files)
 
     return sp_files_mod_dates
 
 
-def single_source_latest_date_modified(single_source: NamedTuple, mode: str) -> str:
+def sp_folder_listing(ctx: ClientContext, folder_url: str, files: list[str],
+                      sp_delta: bool = False,
+                      page_size: int = 500,
+                      store: Optional[StateStore] = None) -> list[NamedTuple]:
+    """
+        Returns files of single sharepoint folder matching any of given names or patterns. In delta mode only
+        changes since last change token of its document library are queried (recursive patterns always list the
+        folder tree).
+
+            Parameters:
+                ctx (ClientContext): sharepoint context of the tenant
+                folder_url (str): server relative url of the folder
+                files (list): Collection of file names and file patterns
+                sp_delta (bool): use change token (delta) queries instead of full folder listings
+                page_size (int): number of items requested per page of folder listing
+                store (StateStore): optional state store keeping change tokens of delta mode
+
+            Returns:
+                files (list): Collection of sp_file (path relative to the folder, time last modified, length)
+    """
+    matcher = pattern_matcher(frozenset(files))
+
+    if sp_delta and not matcher.recursive:
+        tracker = sp_delta_tracker(ctx, folder_url, page_size, store)
+        return [f for f in tracker.files(folder_url) if matcher.match(f.name)]
+
+    return sp_folder_files(sp_rest_client(ctx), folder_url, files, page_size)
+
+
+def hybrid_files_modify_dates_extractor(single_source: NamedTuple, settings: Optional[NamedTuple] = None,
+                                        store: Optional[StateStore] = None) -> list:
     """
-        Returns last modify date for the latest file in collection attached to single source. Depends on selected mode,
-        if mode = 'sharepoint', sharepoint resources will be queried, otherwise local paths.
+        Returns collection of file name and last modify date for single source in hybrid ('all') mode. Synced local
+        copy is stat'ed every cycle, sharepoint folder is queried only for files without local copy or when its
+        verification is due (sp_verify_interval), both views are reconciled per file (see helpers.hybrid). Remote
+        edits are reported once their synced copy arrives (executables read local copies), sharepoint view is used
+        only if the sync does not arrive within sp_sync_timeout. Files are reported under their local paths, modify
+        times are truncated to whole seconds (sharepoint resolution).
 
             Parameters:
                 single_source (NamedTuple): Collection of details regarding single source from sources (paths, ctx, file names)
-                mode (str): 'sharepoint' or 'local'
+                settings (NamedTuple): optional engine settings (verification interval, sync timeout, sharepoint
+                    delta mode)
+                store (StateStore): optional state store keeping change tokens of delta mode
+
+            Returns:
+                files_mod_dates (list): Collection of file names, last modify dates, sizes and local paths
+    """
+    sp_delta, page_size = getattr(settings, 'sp_delta', False), getattr(settings, 'sp_page_size', 500)
+    remote_views.verify_interval = getattr(settings, 'sp_verify_interval', 300.0)
+    remote_views.sync_timeout = getattr(settings, 'sp_sync_timeout', 600.0)
+    files_mod_dates = []
+    unsynced = False
+    folders = defaultdict(list)
+
+    for file, file_params in single_source.files.items():
+        folders[(file_params.local_path, file_params.ctx, file_params.sp_url)].append(file)
+
+    for (local_path, ctx, folder_url), files in folders.items():
+        try:
+            local = {name: file_view(whole_seconds(stat.st_mtime_ns), stat.st_size)
+                     for name, stat in directory_index.lookup(local_path, files).items()}
+        except FileNotFoundError:
+            if ctx is None or folder_url is None:
+                raise
+            local = {}
+
+        if ctx is None or folder_url is None:
+            views = {name: (view, False) for name, view in local.items()}
+        else:
+            views = remote_views.folder(folder_url, (ctx, folder_url, os.fspath(local_path), frozenset(files)), local,
+                                        partial(sp_folder_views, ctx, folder_url, files, sp_delta, page_size, store))
+
+        for name, (view, remote) in sorted(views.items()):
+            unsynced = unsynced or remote
+            files_mod_dates.append(file_modify_date(name.rsplit('/', 1)[-1],
+                                                    datetime.fromtimestamp(view.mtime_ns / 10 ** 9), view.size,
+                                                    os.path.join(local_path, name), view.mtime_ns))
+
+    remote_views.mark(single_source.name, unsynced)
+
+    return files_mod_dates
+
+
+def sp_folder_views(ctx: ClientContext, folder_url: str, files: list[str],
+                    sp_delta: bool = False,
+                    page_size: int = 500,
+                    store: Optional[StateStore] = None) -> dict[str, NamedTuple]:
+    """
+        Returns remote view (modify time, size) of files of single sharepoint folder matching given names or
+        patterns, used by hybrid mode.
+    """
+    return {f.name: file_view(sp_modify_time_ns(f.time_last_modified), f.length)
+            for f in sp_folder_listing(ctx, folder_url, files, sp_delta, page_size, store)}
+
+
+def single_source_files(single_source: NamedTuple, mode: str, settings: Optional[NamedTuple] = None,
+                        store: Optional[StateStore] = None) -> list:
+    """
+        Returns collection of files attached to single source. Depends on selected mode, if mode = 'sharepoint',
+        sharepoint resources will be queried, if mode = 'all', local paths reconciled with sharepoint resources
+        (hybrid mode), otherwise local paths.
+
+            Parameters:
+                single_source (NamedTuple): Collection of details regarding single source from sources (paths, ctx, file names)
+                mode (str): 'sharepoint', 'all' or 'local'
+                settings (NamedTuple): optional engine settings (e.g. sharepoint delta mode)
+                store (StateStore): optional state store keeping change tokens of delta mode
             Returns:
-                latest_date_modified (str): Single value for last modify date
+                files_mod_dates (list): Collection of file_modify_date of the source files
     """
     logger_watcher = logging.getLogger(__name__)
 
+    if mode == 'all':
+        return hybrid_files_modify_dates_extractor(single_source, settings, store)
+
     if mode == 'sharepoint':
         try:
-            files_mod_dates = sp_files_modify_dates_extractor(single_source)
+            return sp_files_modify_dates_extractor(single_source, getattr(settings, 'sp_delta', False),
+                                                   getattr(settings, 'sp_page_size', 500), store)
         except AttributeError:
             logger_watcher.debug(
                 f'CTX not set, provide credentials in env file, modify date taken from local files for {single_source.name}')
-            files_mod_dates = local_files_modify_dates_extractor(single_source)
-    else:
-        files_mod_dates = local_files_modify_dates_extractor(single_source)
 
-    return max([file.modify_date for file in files_mod_dates]).strftime("%m/%d/%Y %H:%M:%S")
+    return local_files_modify_dates_extractor(single_source)
 
 
-def sources_latest_date_modified(sources: tuple[NamedTuple], mode: str) -> dict[str, str]:
+def sources_files_snapshot(sources: tuple[NamedTuple],
+                           mode: str,
+                           poller: Optional[SourcePoller] = None,
+                           settings: Optional[NamedTuple] = None,
+                           store: Optional[StateStore] = None) -> dict[str, dict[str, NamedTuple]]:
     """
-        Returns dictionary with last modify dates for each resource and saves it to pickle file,
-        each time once files are queried adds 'CHECKED_AT'
-        entry which indicates when was last check.
+        Returns current state of files (path, modify time, size) of each given source. If poller is provided sources
+        are queried concurrently, sources which failed or timed out are left out (their stored state stays intact).
 
             Parameters:
-                sources (tuple): Collection of all sources
+                sources (tuple): Collection of sources to query
                 mode (str): 'sharepoint' or 'local'
+                poller (SourcePoller): concurrent polling engine, if not provided sources are queried one by one
+                settings (NamedTuple): optional engine settings passed to extractors
+                store (StateStore): optional state store keeping change tokens of sharepoint delta mode
             Returns:
-                sources_latest_mod_dates (dict): Collection of latest modify dates for all the sources
+                snapshot (dict): Collection of source name: {path: file_state}
     """
-    sources_latest_mod_dates = {'CHECKED_AT': datetime.now().strftime("%m/%d/%Y %H:%M:%S")}
+    def _source_files(source: NamedTuple) -> dict[str, NamedTuple]:
+        with SOURCE_POLL_SECONDS.time(source.name):
+            files = single_source_files(source, mode, settings, store)
+        return {f.path: file_state(f.path, f.mtime_ns, f.size) for f in files}
 
-    for source in sources:
-        sources_latest_mod_dates[source.name] = single_source_latest_date_modified(source, mode)
+    directory_index.new_cycle()
+    sp_delta_new_cycle()
 
-    logger_watcher = logging.getLogger(__name__)
+    if poller is None:
+        return {source.name: _source_files(source) for source in sources}
 
-    try:
-        with open('./logs/dir_modified_dates.pickle', 'wb') as f:
-            pickle.dump(sources_latest_mod_dates, f, protocol=pickle.HIGHEST_PROTOCOL)
-            f.close()
-    except FileNotFoundError:
-        logger_watcher.warning(f'IO issue, file is busy')
+    return poller.poll(sources, _source_files)
 
-    return sources_latest_mod_dates
 
+def source_run_started(name: str,
+                       sources: tuple[NamedTuple],
+                       mode: str,
+                       settings: Optional[NamedTuple],
+                       store: StateStore) -> NamedTuple:
+    """
+        Records start of the run of the source and returns its changes since last successful run. State of source
+        with upstream sources is refreshed first, its files are usually written by upstream run which just finished,
+        so run gets them as changes and next poll does not trigger the source once again. Refresh is called by
+        worker pool outside of its lock and runs in its own directory index and delta tracker cycle, so it neither
+        reuses stats of polling cycle in progress nor resets them, only change trackers of the source are queried.
 
-def sources_comparison(last_check_dates: dict[str, str], current_check_dates: dict[str, str]) -> list[str]:
+            Parameters:
+                name (str): source name
+                sources (tuple): Collection of all sources
+                mode (str): 'sharepoint' or 'local'
+                settings (NamedTuple): optional engine settings passed to extractors
+                store (StateStore): state store of files
+            Returns:
+                changes (file_delta): added, modified and removed files since last successful run
+    """
+    source = next((source for source in sources if source.name == name), None)
+
+    if source is not None and source.upstream:
+        try:
+            with directory_index.own_cycle(), sp_delta_own_cycle():
+                store.update(sources_files_snapshot((source,), mode, None, settings, store))
+        except Exception as exc:
+            logging.getLogger(__name__).warning(f'State of {name} not refreshed before run ({exc})')
+
+    return store.run_started(name)
+
+
+def sources_content_filter(modified_sources: list[str],
+                           sources: tuple[NamedTuple],
+                           fingerprints: FingerprintCache) -> list[str]:
     """
-        Returns collection of resources which have changed since list last check
+        Returns collection of modified resources whose content really changed. Resources with only modify date
+        changed (e.g. OneDrive sync, some Excel save paths) are dropped, so no pointless executables are dispatched.
+        Only local files are fingerprinted, sources reported from sharepoint view after sync timed out (hybrid
+        mode) are kept. Changes of dropped sources are recorded as handled in state store of the fingerprints, so
+        they are not delivered to the next run nor dispatched after restart.
 
             Parameters:
-                last_check_dates (dict): Collection of modified dates for all resources from previous check
-                current_check_dates (dict): Collection of modified dates for all resources from current check
+                modified_sources (list): Collection of modified sources since last check
+                sources (tuple): Collection of all sources
+                fingerprints (FingerprintCache): content fingerprints of files and sources
             Returns:
-                modified_sources (list): Collection of all resources which have been modified since last check
+                changed_sources (list): Collection of sources with changed content
     """
-    modified_sources = [source for source in current_check_dates
-                        if current_check_dates.get(source) != last_check_dates.get(source) and source != 'CHECKED_AT']
+    logger_watcher = logging.getLogger(__name__)
+    sources_by_name = {source.name: source for source in sources}
+    changed_sources = []
+
+    for name in modified_sources:
+        if remote_views.unsynced(name):
+            changed_sources.append(name)
+            continue
+
+        try:
+            changed = fingerprints.source_changed(name, local_source_stats(sources_by_name[name]))
+        except (KeyError, OSError):
+            changed = True
 
-    return modified_sources
+        if changed:
+            changed_sources.append(name)
+        else:
+            logger_watcher.info(f'Modify date of {name} changed but content is the same, dispatch skipped')
+            if fingerprints.store is not None:
+                fingerprints.store.skip(name)
+
+    return changed_sources
 
 
 def process_files(modified_sources: list[str],
                   source_exec: dict[str, Callable],
                   source_paths: dict[str, dict[str, Path]],
                   configurer: Callable,
-                  queue: Queue) -> NoReturn:
+                  queue: Queue,
+                  pool: Optional[WorkerPool] = None,
+                  store: Optional[StateStore] = None,
+                  policies: Optional[dict[str, NamedTuple]] = None) -> NoReturn:
     """
-        Process runner, dispatches functions from executables attached to modified resources
+        Process runner, dispatches functions from executables attached to modified resources. If worker pool is
+        provided functions are dispatched to it asynchronously, otherwise separate Process is started for each
+        resource and all of them are awaited (Process running over its run timeout is terminated). Functions
+        accepting 'changes' argument get added, modified and removed files since their last successful run (pool
+        gets them from its own changes provider). If state store is provided runs are recorded in its journal.
 
             Parameters:
                 modified_sources (list): Collection of modified sources since last check
@@ -195,18 +389,45 @@ def process_files(modified_sources: list[str],
                 source_paths (dict): helper dictionary with kwargs for executable function
                 configurer (object): logger object for worker to capture logs from independent Process
                 queue (object): container for logs transportation between Processes
+                pool (WorkerPool): persistent pool of pre-warmed workers
+                store (StateStore): state store with pending changes of sources
+                policies (dict): run policies (timeout, memory and CPU limits) of sources, pool has its own
             Returns:
                 None
     """
-    processes = []
+    if pool is not None:
+        pool.dispatch(modified_sources, source_exec, source_paths)
+        return
+
+    logger_watcher = logging.getLogger(__name__)
+    policies = policies or {}
+    processes = {}
 
     configurer(queue)
 
     for source in modified_sources:
-        processes.append(Process(target=source_exec.get(source), kwargs=source_paths.get(source)))
+        func, kwargs = source_exec.get(source), dict(source_paths.get(source) or {})
+        policy = policies.get(source) or run_policy()
+        changes = store.run_started(source) if store is not None else None
+        if changes is not None and accepts_changes(func):
+            kwargs['changes'] = changes
+        processes[source] = (Process(target=run_limited, args=(func, policy.memory_mb, policy.cpu_time, kwargs)),
+                             changes, policy.timeout)
+
+    started = monotonic()
 
-    for process in processes:
+    for process, _, _ in processes.values():
         process.start()
 
-    for process in processes:
-        process.join()
+    for source, (process, changes, timeout) in processes.items():
+        process.join(max(0.0, started + timeout - monotonic()) if timeout else None)
+        error = f'exit code {process.exitcode}' if process.exitcode else None
+        if process.is_alive():
+            logger_watcher.error(f'{source} exceeded run timeout of {timeout} sec, process terminated')
+            process.terminate()
+            process.join()
+            error = 'run timeout exceeded'
+        JOBS.inc(source, process.exitcode)
+        JOB_SECONDS.observe(monotonic() - started, source)
+        if store is not None:
+            store.run_finished(source, changes, process.exitcode, error)
@@ -0,0 +1,125 @@
+import os
+import mmap
+import hashlib
+from threading import Lock
+from typing import Optional
+
+from helpers.state import StateStore
+
+
+def file_digest(path: str) -> str:
+    """
+        Returns content hash of the file, file is memory mapped and hashed in single pass without copying.
+
+            Parameters:
+                path (str): absolute path of the file
+
+            Returns:
+                digest (str): hex digest (blake2b, 128 bits)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                digest.update(content)
+
+    return digest.hexdigest()
+
+
+class FingerprintCache:
+    """
+        Content fingerprints of files and sources. Size and modify time of the file are compared first, file is read
+        only when they do not tell the answer, hash of the file is kept as long as size and modify time stay the same.
+        For each source fingerprint of the content seen last time is kept, so source counts as changed only if
+        content of its files really differs (mtime-only changes, e.g. OneDrive sync, are suppressed). If state store
+        is given fingerprints are persisted in it and survive restarts.
+
+            Parameters:
+                store (StateStore): optional state store of files
+    """
+
+    def __init__(self, store: Optional[StateStore] = None):
+        self.store = store
+        self._files = {}
+        self._sources = {}
+        self._lock = Lock()
+
+    def _stored(self, name: str) -> Optional[dict]:
+        if self.store is None:
+            return None
+        stored = self.store.files(name)
+        if not stored or any(f.fingerprint is None for f in stored.values()):
+            return None
+        return {path: (None, f.fingerprint) for path, f in stored.items()}
+
+    def file(self, path: str, stat: os.stat_result) -> tuple[int, str]:
+        """
+            Returns fingerprint (size, hash) of the file, hash is computed only if file changed since last call.
+
+                Parameters:
+                    path (str): absolute path of the file
+                    stat (stat_result): current stat of the file
+
+                Returns:
+                    fingerprint (tuple): size and content hash of the file
+        """
+        with self._lock:
+            cached = self._files.get(path)
+
+        if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return stat.st_size, cached[2]
+
+        digest = file_digest(path)
+
+        with self._lock:
+            self._files[path] = (stat.st_size, stat.st_mtime_ns, digest)
+
+        return stat.st_size, digest
+
+    def source_changed(self, name: str, files: dict[str, os.stat_result]) -> bool:
+        """
+            Returns True if content of source files differs from the content seen last time. Files are compared by
+            set of paths and sizes first, hash of a file is computed only if its modify time changed (it is needed
+            anyway as a baseline for next comparison). Source seen for the first time counts as changed.
+
+                Parameters:
+                    name (str): source name
+                    files (dict): Collection of absolute path: current stat of the source files
+
+                Returns:
+                    changed (bool): True if content changed
+        """
+        with self._lock:
+            previous: Optional[dict] = self._sources.get(name)
+
+        if previous is None:
+            previous = self._stored(name)
+
+        changed = previous is None or previous.keys() != files.keys() or \
+            any(previous[path][0] not in (None, stat.st_size) for path, stat in files.items())
+
+        current = {}
+        for path, stat in files.items():
+            try:
+                current[path] = self.file(path, stat)
+            except FileNotFoundError:
+                changed = True
+
+        changed = changed or {path: digest for path, (_, digest) in current.items()} != \
+            {path: digest for path, (_, digest) in previous.items()}
+
+        with self._lock:
+            self._sources[name] = current
+
+        if self.store is not None:
+            self.store.set_fingerprints(name, {path: digest for path, (_, digest) in current.items()})
+
+        return changed
+
+    def forget(self, name: str) -> None:
+        """
+            Drops fingerprint of the source, next check counts as change.
+        """
+        with self._lock:
+            self._sources.pop(name, None)
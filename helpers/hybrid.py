@@ -0,0 +1,173 @@
+import logging
+from threading import Lock
+from time import monotonic
+from collections import namedtuple, defaultdict
+from collections.abc import Callable, Hashable
+from typing import NamedTuple, Optional
+
+from helpers.sharepoint import retry_after
+
+# delay in seconds before failed verification of a folder is retried (unless sharepoint asks for longer one)
+VERIFY_RETRY_DELAY = 60.0
+
+# single view of a file: modify time (whole seconds, in nanoseconds) and size
+file_view = namedtuple("file_view", "mtime_ns, size")
+
+# last remote listing of a folder: relative name: file_view, time of listing, no query before given time
+remote_folder = namedtuple("remote_folder", "files, verified_at, not_before", defaults=[None, 0.0, 0.0])
+
+
+def whole_seconds(mtime_ns: int) -> int:
+    """
+        Returns modify time truncated to whole seconds (sharepoint resolution), so synced local copy and sharepoint
+        file have the same modify time.
+
+            Parameters:
+                mtime_ns (int): modify time in nanoseconds
+
+            Returns:
+                mtime_ns (int): modify time in nanoseconds, truncated to whole seconds
+    """
+    return mtime_ns - mtime_ns % 10 ** 9
+
+
+def reconcile(local: dict[str, NamedTuple], remote: dict[str, NamedTuple]) -> dict[str, tuple[NamedTuple, bool]]:
+    """
+        Returns single view of each file out of its local and remote view. Local copy wins, unless file exists only
+        remotely (not synced yet) or remote file is newer (remote edit not synced yet).
+
+            Parameters:
+                local (dict): Collection of relative name: file_view of local copy
+                remote (dict): Collection of relative name: file_view from sharepoint
+
+            Returns:
+                views (dict): Collection of relative name: (file_view, True if remote view is used)
+    """
+    views = {name: (view, False) for name, view in local.items()}
+
+    for name, view in remote.items():
+        if name not in local or view.mtime_ns > local[name].mtime_ns:
+            views[name] = (view, True)
+
+    return views
+
+
+class RemoteViews:
+    """
+        Remote (sharepoint) views of folders in hybrid ('all') mode. Local copy of a folder is stat'ed every cycle,
+        sharepoint folder is queried only if verification is due (every verify_interval seconds) or if last listing
+        holds files without local copy (not synced yet, or removed locally and removal has to be confirmed), those
+        are followed remotely every cycle. Between verifications last listing is reconciled with local stats, so
+        remote edits which have not been synced yet are caught at the latest by the next verification.
+        Executables read local copies, so remote edit is held back (local view is reported, file without local copy
+        is left out) until its synced copy arrives, then it is reported by local stat. If the sync does not arrive
+        within sync_timeout, remote view is reported 1 ns before remote modify time, so executable runs and the
+        synced copy, once it arrives, counts as another change and is processed too.
+
+            Parameters:
+                verify_interval (float): interval in seconds between verifications of a folder
+                sync_timeout (float): longest time in seconds remote edit waits for its synced local copy
+    """
+
+    def __init__(self, verify_interval: float = 300.0, sync_timeout: float = 600.0):
+        self.verify_interval = verify_interval
+        self.sync_timeout = sync_timeout
+        self._folders = {}
+        self._waiting = {}
+        self._unsynced = {}
+        self._locks = defaultdict(Lock)
+        self._lock = Lock()
+
+    def _folder_lock(self, key: Hashable) -> Lock:
+        with self._lock:
+            return self._locks[key]
+
+    def _due(self, folder: Optional[NamedTuple], local: dict[str, NamedTuple], now: float) -> bool:
+        if folder is None:
+            return True
+        if now < folder.not_before:
+            return False
+        return now >= folder.verified_at + self.verify_interval or any(name not in local for name in folder.files)
+
+    def _hold(self, key: Hashable, local: dict[str, NamedTuple], views: dict[str, tuple[NamedTuple, bool]],
+              folder_url: str, now: float) -> dict[str, tuple[NamedTuple, bool]]:
+        logger = logging.getLogger(__name__)
+        previous = self._waiting.get(key, {})
+        waiting = {}
+
+        for name, (view, remote) in list(views.items()):
+            if not remote:
+                continue
+
+            since, reported = previous[name][1:] if name in previous and previous[name][0] == view else (now, False)
+            waiting[name] = (view, since, reported)
+
+            if now < since + self.sync_timeout:
+                logger.debug(f'{name} in {folder_url} changed on sharepoint, waiting for synced copy')
+                if name in local:
+                    views[name] = (local[name], False)
+                else:
+                    del views[name]
+                continue
+
+            if not reported:
+                logger.warning(f'{name} in {folder_url} not synced within {self.sync_timeout:.0f} sec, sharepoint '
+                               f'view used, synced copy will be processed once it arrives')
+                waiting[name] = (view, since, True)
+            views[name] = (view._replace(mtime_ns=view.mtime_ns - 1), True)
+
+        if waiting:
+            self._waiting[key] = waiting
+        else:
+            self._waiting.pop(key, None)
+
+        return views
+
+    def folder(self, folder_url: str, key: Hashable, local: dict[str, NamedTuple],
+               query: Callable[[], dict[str, NamedTuple]]) -> dict[str, tuple[NamedTuple, bool]]:
+        """
+            Returns reconciled views of files of single folder. Sharepoint is queried only if it is due, if query
+            fails local view is reconciled with last listing and query is retried after VERIFY_RETRY_DELAY (or
+            delay requested by throttled sharepoint). Remote edits are held back until their synced copy arrives
+            (or sync_timeout runs out).
+
+                Parameters:
+                    folder_url (str): server relative url of sharepoint folder
+                    key (Hashable): identity of the folder (sharepoint folder, local folder, names and patterns)
+                    local (dict): Collection of relative name: file_view of local copy
+                    query (Callable): returns Collection of relative name: file_view from sharepoint
+
+                Returns:
+                    views (dict): Collection of relative name: (file_view, True if remote view is used)
+        """
+        logger = logging.getLogger(__name__)
+
+        with self._folder_lock(key):
+            folder = self._folders.get(key)
+            now = monotonic()
+
+            if self._due(folder, local, now):
+                try:
+                    folder = remote_folder(query(), now, now)
+                # malformed or unexpected responses (ValueError, KeyError) fall back to local copy as well
+                except (OSError, AttributeError, ValueError, KeyError) as exc:
+                    delay = retry_after(exc) or min(VERIFY_RETRY_DELAY, self.verify_interval)
+                    logger.warning(f'Sharepoint verification of {folder_url} failed ({exc.__class__.__name__}: {exc}), '
+                                   f'local copy used, next attempt in {delay:.0f} sec')
+                    folder = (folder or remote_folder({}))._replace(not_before=now + delay)
+                self._folders[key] = folder
+
+            return self._hold(key, local, reconcile(local, folder.files), folder_url, now)
+
+    def mark(self, source: str, unsynced: bool) -> None:
+        """
+            Records whether last poll of the source used remote view of some files (sync timed out).
+        """
+        self._unsynced[source] = unsynced
+
+    def unsynced(self, source: str) -> bool:
+        """
+            Returns True if last poll of the source used remote view of some files (sync timed out), content of their
+            local copy is not current.
+        """
+        return self._unsynced.get(source, False)
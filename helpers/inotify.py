@@ -0,0 +1,233 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+from pathlib import Path
+from time import monotonic
+from collections import defaultdict
+from typing import NamedTuple, Optional
+
+from helpers.patterns import pattern_matcher
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# network and virtual filesystems which do not deliver events for changes made by other hosts (or by Windows host)
+NO_EVENTS_FS = {'cifs', 'smb3', 'smbfs', 'nfs', 'nfs4', 'afs', 'ncpfs', '9p', 'drvfs', 'fuse', 'fuseblk',
+                'fuse.sshfs', 'fuse.rclone', 'davfs', 'fuse.davfs2', 'vboxsf', 'vmhgfs', 'prl_fs'}
+
+
+def _libc() -> Optional[ctypes.CDLL]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def filesystem_type(path: Path) -> Optional[str]:
+    """
+        Returns type of filesystem the path is mounted on, based on '/proc/mounts'.
+
+            Parameters:
+                path (Path): path object
+
+            Returns:
+                fs_type (str): filesystem type or None if it cannot be determined
+    """
+    path = os.path.realpath(path)
+    best, fs_type = '', None
+
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and \
+                        len(mount_point) >= len(best):
+                    best, fs_type = mount_point, fields[2]
+    except OSError:
+        return None
+
+    return fs_type
+
+
+class InotifyWatcher:
+    """
+        Event driven backend for local sources based on Linux inotify (through ctypes). Directories of sources are
+        watched by kernel, events are mapped back to sources by file names and patterns and coalesced, so a burst
+        of writes ends up as single change of source. Sources located on filesystems which do not deliver events
+        (SMB/CIFS, NFS, WSL mounts...) or which could not be watched stay on the polling path.
+
+            Parameters:
+                sources (tuple): Collection of all sources
+                coalesce (float): quiet period in seconds, events are collected until no new event comes within it
+                    (but not longer than 10 quiet periods, so constantly written file still gets reported)
+    """
+
+    def __init__(self, sources: tuple[NamedTuple, ...], coalesce: float = 0.5):
+        logger = logging.getLogger(__name__)
+
+        self.coalesce = coalesce
+        self.event_sources = set()
+        self.polled_sources = set()
+        self._libc = _libc()
+        self._fd = None
+        self._wd_dirs = {}
+        self._dir_files = defaultdict(list)
+        self._pending = set()
+
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            self._fd = fd if fd >= 0 else None
+
+        if self._fd is None:
+            logger.warning('inotify not available, local sources will be polled')
+
+        watched = {}
+
+        for source in sources:
+            event_driven = self._fd is not None
+
+            for file, file_params in source.files.items():
+                directory = os.fspath(file_params.local_path)
+                if directory not in watched:
+                    watched[directory] = self._fd is not None and self._add_watch(directory)
+                # only monitored folder itself is watched, files in its subfolders are polled
+                event_driven = event_driven and watched[directory] and not pattern_matcher(frozenset((file,))).recursive
+                self._dir_files[directory].append((source.name, file))
+
+            (self.event_sources if event_driven else self.polled_sources).add(source.name)
+
+        if self.polled_sources and self._fd is not None:
+            logger.info(f'Sources without filesystem events, polled: {sorted(self.polled_sources)}')
+
+    def _add_watch(self, directory: str) -> bool:
+        logger = logging.getLogger(__name__)
+        fs_type = filesystem_type(Path(directory))
+
+        if fs_type in NO_EVENTS_FS:
+            logger.info(f'{directory} is on {fs_type} filesystem, no inotify events, falling back to polling')
+            return False
+
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            logger.warning(f'inotify watch for {directory} failed ({errno.errorcode.get(err, err)}), '
+                           f'falling back to polling')
+            return False
+
+        self._wd_dirs[wd] = directory
+        return True
+
+    def _sources_for(self, directory: str, name: Optional[str]) -> set[str]:
+        return {source_name for source_name, file in self._dir_files.get(directory, ())
+                if source_name in self.event_sources and
+                (not name or pattern_matcher(frozenset((file,))).match(name))}
+
+    def _read_events(self) -> bool:
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.getLogger(__name__).warning('inotify queue overflow, all event driven sources marked')
+                self._pending |= self.event_sources
+                continue
+
+            directory = self._wd_dirs.get(wd)
+            if directory is None:
+                continue
+
+            self._pending |= self._sources_for(directory, os.fsdecode(name))
+
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                self._watch_lost(wd, directory)
+
+        return True
+
+    def _watch_lost(self, wd: int, directory: str) -> None:
+        self._wd_dirs.pop(wd, None)
+        moved = {source_name for source_name, _ in self._dir_files.get(directory, ())} & self.event_sources
+        self.event_sources -= moved
+        self.polled_sources |= moved
+        self._pending |= moved
+        logging.getLogger(__name__).warning(f'Watch on {directory} lost, sources moved to polling: {sorted(moved)}')
+
+    def wait(self, timeout: float) -> set[str]:
+        """
+            Blocks until events for watched sources arrive or timeout passes. Once first event comes, events are
+            collected until quiet period passes, so burst of events for one source gives single change.
+
+                Parameters:
+                    timeout (float): maximal waiting time in seconds
+
+                Returns:
+                    changed_sources (set): Collection of names of event driven sources with changes
+        """
+        deadline = monotonic() + timeout
+
+        if self._fd is None:
+            remaining = deadline - monotonic()
+            if remaining > 0:
+                select.select([], [], [], remaining)
+            return set()
+
+        while not self._pending:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return set()
+            ready, _, _ = select.select([self._fd], [], [], remaining)
+            if ready:
+                self._read_events()
+
+        burst_deadline = monotonic() + 10 * self.coalesce
+
+        while monotonic() < burst_deadline:
+            ready, _, _ = select.select([self._fd], [], [], self.coalesce)
+            if not ready or not self._read_events():
+                break
+
+        changed_sources, self._pending = self._pending, set()
+        return changed_sources
+
+    def close(self) -> None:
+        """
+            Closes inotify descriptor, all watches are released by kernel.
+
+                Returns:
+                    None
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
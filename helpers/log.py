@@ -1,28 +1,125 @@
+import copy
+import queue as queue_module
 import logging
 import logging.handlers
-from collections.abc import Callable
-from multiprocessing import Queue
-from typing import NoReturn
+from contextlib import contextmanager
+from collections import namedtuple
+from collections.abc import Callable, Iterator
+from multiprocessing import Queue, get_context
+from typing import NamedTuple, NoReturn, Optional
+
+# maximum number of records handled by listener at once, handlers are flushed once per batch
+LOG_BATCH_SIZE = 500
+# longest time in seconds process waits for free space in full log queue ('block' overflow), record is dropped then
+LOG_BLOCK_TIMEOUT = 5.0
+LOG_OVERFLOW_POLICIES = ('drop', 'block')
+LOG_FORMAT = '%(asctime)-20s| %(levelname)-8s| %(processName)-12s| %(message)s'
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# level: root level, levels: logger name: level, source_levels: source name: level used while its executable runs,
+# queue_size: capacity of log queue, overflow: 'drop' (new records dropped) or 'block' (process waits) on full queue
+log_settings = namedtuple("log_settings", "level, levels, source_levels, queue_size, overflow",
+                          defaults=[logging.INFO, {}, {}, 10_000, 'drop'])
+
+_source_levels = {}
+
+
+class BatchRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+        Rotating file handler which does not flush after each record, listener flushes it once per batch.
+    """
+
+    def flush(self) -> None:
+        pass
+
+    def flush_batch(self) -> None:
+        super().flush()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+        Queue handler for bounded log queue. Records are not formatted in producing process, only message is merged
+        with its arguments (and traceback rendered) for records which passed level filters, formatting happens once
+        in log listener. If queue is full record is dropped ('drop') or process waits for free space up to
+        LOG_BLOCK_TIMEOUT ('block'), number of dropped records is reported once queue accepts records again.
+
+            Parameters:
+                queue (Queue): bounded container for logs from independent processes
+                overflow (str): 'drop' or 'block'
+    """
+
+    def __init__(self, queue: Queue, overflow: str = 'drop'):
+        super().__init__(queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            if self.overflow == 'block':
+                self.queue.put(record, timeout=LOG_BLOCK_TIMEOUT)
+            else:
+                self.queue.put_nowait(record)
+        except queue_module.Full:
+            self.dropped += 1
+            return
+
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            warning = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                        f'{dropped} log records dropped, log queue full', None, None)
+            warning.processName = record.processName
+            try:
+                self.queue.put_nowait(warning)
+            except queue_module.Full:
+                self.dropped += dropped
+
+
+def log_queue(size: int = 10_000) -> Queue:
+    """
+        Returns bounded log queue shared by all processes (spawn context, the same as worker pool).
+
+            Parameters:
+                size (int): capacity of the queue in records
+
+            Returns:
+                queue (Queue): container for logs from independent processes
+    """
+    return get_context('spawn').Queue(max(1, size))
 
 
 def listener_configurer() -> NoReturn:
     """
-        Creates instance of logger for log listener, set the configuration for logger.
+        Creates instance of logger for log listener, set the configuration for logger. Records are written to
+        rotating log file and to console, formatted once here.
 
             Returns:
                 None
     """
     root = logging.getLogger()
-    handler = logging.handlers.RotatingFileHandler('./logs/filewatcher_multi.log', 'a', 1_000_000, 3)
-    formatter = logging.Formatter('%(asctime)-20s| %(levelname)-8s| %(processName)-12s| %(message)s',
-                                  '%Y-%m-%d %H:%M:%S')
-    handler.setFormatter(formatter)
-    root.addHandler(handler)
+    formatter = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+
+    for handler in (BatchRotatingFileHandler('./logs/filewatcher_multi.log', 'a', 1_000_000, 3),
+                    logging.StreamHandler()):
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+
+    root.setLevel(logging.NOTSET)
 
 
 def listener_process(configurer: Callable, queue: Queue) -> NoReturn:
     """
-        Intercepts logs from the queue and send them to handlers.
+        Intercepts logs from the queue and send them to handlers. Records are taken from the queue in batches (up
+        to LOG_BATCH_SIZE waiting records), handlers are flushed once per batch.
 
             Parameters:
                 configurer (Logger): instance of listener logger object
@@ -32,41 +129,98 @@ def listener_process(configurer: Callable, queue: Queue) -> NoReturn:
                 None
     """
     configurer()
+    root = logging.getLogger()
+
     while True:
         try:
-            record = queue.get()
-            if record is None:
+            records = [queue.get()]
+            while len(records) < LOG_BATCH_SIZE:
+                try:
+                    records.append(queue.get_nowait())
+                except queue_module.Empty:
+                    break
+
+            for record in records:
+                if record is None:
+                    break
+                logging.getLogger(record.name).handle(record)
+
+            for handler in root.handlers:
+                getattr(handler, 'flush_batch', handler.flush)()
+
+            if None in records:
                 break
-            logger = logging.getLogger(record.name)
-            logger.handle(record)
         except Exception:
             import sys, traceback
             print('Log listener died', file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
 
 
-def worker_configurer(queue: Queue) -> NoReturn:
+def worker_configurer(queue: Queue, settings: Optional[NamedTuple] = None) -> NoReturn:
     """
         Creates instance of logger for workers, set the configuration for logger, store logs in shared queue.
+        Records below configured levels are dropped before they are formatted or sent.
+
             Parameters:
                 queue (Queue): container for logs from independent processes
+                settings (NamedTuple): optional log_settings (levels, overflow policy of the queue)
 
             Returns:
                 None
     """
-    handler_q = logging.handlers.QueueHandler(queue)
-    handler_s = logging.StreamHandler()
-    
-    formatter = logging.Formatter('%(asctime)-20s| %(levelname)-8s| %(processName)-12s| %(message)s',
-                                  '%Y-%m-%d %H:%M:%S')
-    handler_q.setFormatter(formatter)
-    handler_s.setFormatter(formatter)
-    
+    settings = settings or log_settings()
     root = logging.getLogger()
-    
+
     if root.hasHandlers():
         root.handlers.clear()
 
-    root.addHandler(handler_q)
-    root.addHandler(handler_s)
-    root.setLevel(logging.INFO)
+    root.addHandler(BoundedQueueHandler(queue, settings.overflow))
+    root.setLevel(settings.level)
+
+    for name, level in settings.levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    _source_levels.clear()
+    _source_levels.update(settings.source_levels)
+
+
+@contextmanager
+def source_log_level(source: str) -> Iterator[None]:
+    """
+        Applies log level of the source (if configured) to the process while its executable runs.
+
+            Parameters:
+                source (str): source name
+
+            Returns:
+                None
+    """
+    level = _source_levels.get(source)
+
+    if level is None:
+        yield
+        return
+
+    root = logging.getLogger()
+    previous = root.level
+    root.setLevel(level)
+    try:
+        yield
+    finally:
+        root.setLevel(previous)
+
+
+def queue_backlog(queue: Queue) -> Optional[int]:
+    """
+        Returns number of log records waiting in the queue for log listener.
+
+            Parameters:
+                queue (Queue): container for logs from independent processes
+
+            Returns:
+                backlog (int): approximate number of records in the queue, None where not supported (macOS)
+    """
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
@@ -0,0 +1,325 @@
+import os
+import json
+import logging
+import tempfile
+from bisect import bisect_left
+from contextlib import nullcontext
+from collections.abc import Callable
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Optional
+
+# upper bounds of histogram buckets in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_NULL_TIMER = nullcontext()
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_string(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [extra] if extra else []
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    return '+Inf' if value == float('inf') else repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+        Base of metrics kept in registry. Metric does nothing (single attribute check) until registry is enabled.
+
+            Parameters:
+                registry (MetricsRegistry): registry the metric belongs to
+                name (str): metric name
+                documentation (str): help text
+                labels (tuple): names of labels, values are given positionally in the same order
+    """
+    kind = 'untyped'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def samples(self) -> list[tuple[tuple, Any]]:
+        with self._lock:
+            return sorted(self._values.items(), key=lambda item: tuple(map(str, item[0])))
+
+    def prometheus(self) -> list[str]:
+        return [f'{self.name}{_label_string(self.labels, values)} {_number(value)}' for values, value in self.samples()]
+
+    def json(self) -> list[dict]:
+        return [{'labels': dict(zip(self.labels, values)), 'value': value} for values, value in self.samples()]
+
+
+class Counter(Metric):
+    """
+        Monotonically growing value (count of events, bytes).
+    """
+    kind = 'counter'
+
+    def inc(self, *labels: Any, value: float = 1) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    """
+        Value which goes up and down. Gauge can be given function which is called when metrics are collected
+        instead of being set on hot path.
+    """
+    kind = 'gauge'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(registry, name, documentation, labels)
+        self._function = None
+
+    def set(self, value: float, *labels: Any) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function: Optional[Callable[[], Optional[float]]]) -> None:
+        self._function = function
+
+    def samples(self) -> list[tuple[tuple, Any]]:
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                value = None
+            return [((), value)] if value is not None else []
+        return super().samples()
+
+
+class Histogram(Metric):
+    """
+        Distribution of observed values (latencies) in cumulative buckets, with sum and count of observations.
+    """
+    kind = 'histogram'
+
+    def __init__(self, registry: 'MetricsRegistry', name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(registry, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: Any) -> None:
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def time(self, *labels: Any) -> Any:
+        """
+            Returns context manager observing duration of its block, no-op if metrics are disabled.
+        """
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def samples(self) -> list[tuple[tuple, Any]]:
+        with self._lock:
+            return sorted(((labels, ([*counts[0]], counts[1], counts[2])) for labels, counts in self._values.items()),
+                          key=lambda item: tuple(map(str, item[0])))
+
+    def prometheus(self) -> list[str]:
+        lines = []
+        for values, (buckets, total, count) in self.samples():
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, float('inf')), buckets):
+                cumulative += bucket
+                le = f'le="{_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_label_string(self.labels, values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_label_string(self.labels, values)} {_number(total)}')
+            lines.append(f'{self.name}_count{_label_string(self.labels, values)} {count}')
+        return lines
+
+    def json(self) -> list[dict]:
+        return [{'labels': dict(zip(self.labels, values)), 'count': count, 'sum': round(total, 6),
+                 'buckets': dict(zip(map(_number, (*self.buckets, float('inf'))), buckets))}
+                for values, (buckets, total, count) in self.samples()]
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> '_Timer':
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(monotonic() - self.started, *self.labels)
+
+
+class MetricsRegistry:
+    """
+        Registry of metrics of the process. Metrics are declared upfront and stay disabled (each call is a single
+        attribute check) until registry is enabled by start().
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = []
+        self._server = None
+        self._stopped = Event()
+
+    def _register(self, metric: Metric) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(self, name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(self, name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, documentation, labels, buckets))
+
+    def prometheus(self) -> str:
+        """
+            Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines += [f'# HELP {metric.name} {metric.documentation}', f'# TYPE {metric.name} {metric.kind}']
+            lines += metric.prometheus()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """
+            Returns all metrics as JSON serializable dictionary.
+        """
+        return {'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                'metrics': {metric.name: {'type': metric.kind, 'help': metric.documentation, 'samples': metric.json()}
+                            for metric in self._metrics}}
+
+    def write_snapshot(self, path: str) -> None:
+        """
+            Writes JSON snapshot of metrics to given file, file is replaced atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics_')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def start(self, port: int = 0, snapshot_path: Optional[str] = None, interval: float = 60.0) -> None:
+        """
+            Enables metrics, optionally serves them on local HTTP endpoint ('/metrics' in Prometheus text format,
+            '/metrics.json') and writes JSON snapshot to file periodically.
+
+                Parameters:
+                    port (int): port of HTTP endpoint on 127.0.0.1, 0 - no endpoint
+                    snapshot_path (str): path of JSON snapshot file, None - no snapshot
+                    interval (float): interval in seconds between snapshots
+
+                Returns:
+                    None
+        """
+        logger = logging.getLogger(__name__)
+
+        if not port and not snapshot_path:
+            return
+
+        self.enabled = True
+
+        if port:
+            handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': self})
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+            self._server.daemon_threads = True
+            Thread(target=self._server.serve_forever, name='metrics-http', daemon=True).start()
+            logger.info(f'Metrics served on http://127.0.0.1:{self._server.server_address[1]}/metrics')
+
+        if snapshot_path:
+            Thread(target=self._snapshot_loop, args=(snapshot_path, interval), name='metrics-snapshot',
+                   daemon=True).start()
+            logger.info(f'Metrics snapshot written to {snapshot_path} every {interval} sec')
+
+    def _snapshot_loop(self, path: str, interval: float) -> None:
+        while not self._stopped.wait(interval):
+            try:
+                self.write_snapshot(path)
+            except OSError as exc:
+                logging.getLogger(__name__).warning(f'Metrics snapshot not written ({exc})')
+
+    def stop(self) -> None:
+        """
+            Stops HTTP endpoint and snapshots.
+        """
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        path = self.path.split('?', 1)[0]
+        if path in ('/metrics', '/'):
+            body, content_type = self.registry.prometheus().encode(), PROMETHEUS_CONTENT_TYPE
+        elif path == '/metrics.json':
+            body, content_type = json.dumps(self.registry.snapshot()).encode(), 'application/json'
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+registry = MetricsRegistry()
+
+SOURCE_POLL_SECONDS = registry.histogram('sfw_source_poll_seconds', 'Latency of querying files of single source',
+                                         ('source',))
+SOURCE_POLL_ERRORS = registry.counter('sfw_source_poll_errors_total', 'Failed, timed out or skipped source polls',
+                                      ('source', 'reason'))
+SP_REQUESTS = registry.counter('sfw_sp_requests_total', 'SharePoint REST requests', ('host', 'method', 'status'))
+SP_RESPONSE_BYTES = registry.counter('sfw_sp_response_bytes_total', 'Bytes of SharePoint REST responses', ('host',))
+SP_THROTTLES = registry.counter('sfw_sp_throttled_total', 'SharePoint REST requests throttled (HTTP 429/503)',
+                                ('host',))
+SP_REQUEST_SECONDS = registry.histogram('sfw_sp_request_seconds', 'Latency of SharePoint REST requests', ('host',))
+CYCLE_SECONDS = registry.histogram('sfw_cycle_seconds', 'Duration of poll cycle (query, state update, dispatch)')
+CYCLE_OVERRUNS = registry.counter('sfw_cycle_overruns_total', 'Poll cycles longer than poll_time')
+POLL_TIME_SECONDS = registry.gauge('sfw_poll_time_seconds', 'Configured poll_time')
+CYCLE_SOURCES = registry.counter('sfw_cycle_sources_total', 'Polled and changed sources', ('outcome',))
+DISPATCH_QUEUE_DEPTH = registry.gauge('sfw_dispatch_queue_depth', 'Jobs waiting for worker (incl. follow-up runs)')
+DISPATCH_RUNNING = registry.gauge('sfw_dispatch_running', 'Jobs running in workers')
+JOB_SECONDS = registry.histogram('sfw_job_seconds', 'Runtime of executables', ('source',))
+JOBS = registry.counter('sfw_jobs_total', 'Finished runs of executables by exit code', ('source', 'exitcode'))
+LOG_QUEUE_BACKLOG = registry.gauge('sfw_log_queue_backlog', 'Log records waiting in queue for log listener')
@@ -0,0 +1,169 @@
+import re
+from functools import lru_cache
+from collections.abc import Iterable, Iterator
+
+WILDCARDS = ('*', '?', '[')
+
+
+def is_pattern(file: str) -> bool:
+    """
+        Returns True if file name contains wildcards ('*', '?', '[...]') or points to subfolders ('/').
+
+            Parameters:
+                file (str): file name or file pattern
+
+            Returns:
+                is_pattern (bool): True for patterns
+    """
+    return '/' in file.strip('/') or any(wildcard in file for wildcard in WILDCARDS)
+
+
+def _tokens(segment: str) -> Iterator[tuple[str, str]]:
+    i = 0
+
+    while i < len(segment):
+        char = segment[i]
+        if char == '*':
+            while i + 1 < len(segment) and segment[i + 1] == '*':
+                i += 1
+            yield 'any', '[^/]*'
+        elif char == '?':
+            yield 'any', '[^/]'
+        elif char == '[' and segment.find(']', i + 2 + (segment[i + 1:i + 2] in ('!', '^'))) >= 0:
+            negate = segment[i + 1:i + 2] in ('!', '^')
+            start = i + 1 + negate
+            # ']' right after '[' or '[!' is part of the class
+            end = segment.find(']', start + 1)
+            body = ''.join('\\' + c if c in '\\[]^' else c for c in segment[start:end])
+            yield 'any', f'[{"^/" if negate else ""}{body}]'
+            i = end
+        else:
+            yield 'literal', char
+        i += 1
+
+
+def _segment_regex(segment: str) -> str:
+    return ''.join(re.escape(value) if kind == 'literal' else value for kind, value in _tokens(segment))
+
+
+def pattern_literals(pattern: str) -> list[str]:
+    """
+        Returns literal parts of file name pattern, parts separated by wildcards, e.g. ['a', 'b', '.csv'] for
+        'a*b?.csv'. Used to narrow listings on server side.
+
+            Parameters:
+                pattern (str): file name pattern (single folder level)
+
+            Returns:
+                literals (list): Collection of literal parts (first is prefix of the name, last is its suffix,
+                    both are empty if pattern starts or ends with wildcard)
+    """
+    literals = ['']
+
+    for kind, value in _tokens(pattern):
+        if kind == 'literal':
+            literals[-1] += value
+        else:
+            literals.append('')
+
+    return literals
+
+
+@lru_cache(maxsize=None)
+def pattern_regex(pattern: str) -> str:
+    """
+        Returns regular expression of file pattern matched against file path relative to monitored folder ('/' as
+        separator). '*' matches any characters within single folder level, '?' single character, '[...]' character
+        class ('[!...]' negated), '**' as whole path segment matches any number of subfolders (also none).
+
+            Parameters:
+                pattern (str): file name or file pattern, e.g. 'report_*.xlsx', 'data/**/sales_20??.csv'
+
+            Returns:
+                regex (str): regular expression matching whole relative path
+    """
+    segments = pattern.strip('/').split('/')
+    regex = []
+
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            regex.append('.*' if last else '(?:[^/]+/)*')
+        else:
+            regex.append(_segment_regex(segment) + ('' if last else '/'))
+
+    return ''.join(regex)
+
+
+class PatternMatcher:
+    """
+        Compiled matcher of collection of file names and patterns. Exact names are looked up in a set, all patterns
+        are compiled into single regular expression, so listing of folder is checked in one pass. The same matcher
+        is used for local folders and sharepoint folders. Matching is case-sensitive.
+
+            Parameters:
+                files (iterable): Collection of file names and file patterns (relative to monitored folder)
+    """
+
+    def __init__(self, files: Iterable[str]):
+        files = frozenset(file.strip('/') for file in files)
+        self.names = frozenset(file for file in files if not is_pattern(file))
+        self.patterns = tuple(sorted(file for file in files if is_pattern(file)))
+        self._regex = re.compile('|'.join(f'(?:{pattern_regex(p)})' for p in self.patterns)) \
+            if self.patterns else None
+        self._segments = [[re.compile(_segment_regex(s)) if s != '**' else None for s in p.split('/')]
+                          for p in self.patterns]
+        # True if any pattern reaches into subfolders
+        self.recursive = any(len(segments) > 1 or None in segments for segments in self._segments)
+
+    def match(self, path: str) -> bool:
+        """
+            Returns True if relative path matches any name or pattern.
+        """
+        return path in self.names or (self._regex is not None and self._regex.fullmatch(path) is not None)
+
+    def filter(self, paths: Iterable[str]) -> list[str]:
+        """
+            Returns relative paths matching any name or pattern, in single pass over given paths.
+        """
+        return [path for path in paths if self.match(path)]
+
+    def descend(self, directory: str) -> bool:
+        """
+            Returns True if files of given subfolder (relative path) can match any name or pattern, so it has to be
+            walked.
+
+                Parameters:
+                    directory (str): relative path of the subfolder
+
+                Returns:
+                    descend (bool): True if subfolder has to be walked
+        """
+        parts = directory.strip('/').split('/')
+
+        for segments in self._segments:
+            for i, part in enumerate(parts):
+                if i < len(segments) and segments[i] is None:
+                    return True
+                if i >= len(segments) - 1:
+                    break
+                if not segments[i].fullmatch(part):
+                    break
+            else:
+                return True
+
+        return False
+
+
+@lru_cache(maxsize=1024)
+def pattern_matcher(files: frozenset[str]) -> PatternMatcher:
+    """
+        Returns compiled matcher of given names and patterns, matchers are compiled once and shared.
+
+            Parameters:
+                files (frozenset): Collection of file names and file patterns
+
+            Returns:
+                matcher (PatternMatcher): compiled matcher
+    """
+    return PatternMatcher(files)
@@ -0,0 +1,127 @@
+import logging
+from math import ceil
+from threading import Lock
+from time import monotonic
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Any, NamedTuple, Optional
+
+from helpers.metrics import SOURCE_POLL_ERRORS
+
+
+class SourcePoller:
+    """
+        Concurrent polling engine. Sources are queried in parallel on a persistent pool of threads, so latency of
+        the cycle depends on the slowest source instead of the sum of all of them. Each source is isolated, failure
+        or timeout of single source does not stall or break the others, last known value is kept instead.
+
+            Parameters:
+                workers (int): number of sources queried at the same time
+                timeout (float): time budget in seconds for single source, once exceeded source is abandoned
+    """
+
+    def __init__(self, workers: int, timeout: float):
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='poller')
+        self.errors = {}
+        self._started = {}
+        self._abandoned = {}
+        self._lock = Lock()
+
+    def _run(self, name: str, func: Callable, source: NamedTuple) -> Any:
+        with self._lock:
+            self._started[name] = monotonic()
+        return func(source)
+
+    def _abandon(self, name: str, future: Future) -> None:
+        def _release(_: Future) -> None:
+            with self._lock:
+                self._abandoned.pop(name, None)
+                self._started.pop(name, None)
+
+        with self._lock:
+            self._abandoned[name] = future
+        future.add_done_callback(_release)
+
+    def poll(self, sources: Iterable[NamedTuple], func: Callable, last_values: Optional[dict] = None) -> dict:
+        """
+            Returns values of func computed concurrently for each source. Sources which failed, timed out or are
+            still busy with query from previous cycle get value from last_values (if available). Exceptions of failed
+            sources are kept in errors attribute until next poll.
+
+                Parameters:
+                    sources (iterable): Collection of sources (NamedTuple with name attribute)
+                    func (Callable): function called with single source as an argument
+                    last_values (dict): Collection of values from previous cycle, used for isolated sources
+
+                Returns:
+                    values (dict): Collection of values for each source name
+        """
+        logger = logging.getLogger(__name__)
+        last_values = last_values or {}
+        values = {}
+        self.errors = {}
+        futures = {}
+
+        for source in sources:
+            with self._lock:
+                busy = source.name in self._abandoned
+            if busy:
+                logger.warning(f'Source {source.name} still busy with previous query, last known value kept')
+                if source.name in last_values:
+                    values[source.name] = last_values[source.name]
+                continue
+            futures[self._executor.submit(self._run, source.name, func, source)] = source.name
+
+        pending = set(futures)
+        cycle_deadline = monotonic() + self.timeout * ceil(len(futures) / self.workers)
+
+        while pending:
+            with self._lock:
+                started = {name: self._started.get(name) for name in map(futures.get, pending)}
+            wake_at = min([t + self.timeout for t in started.values() if t is not None] + [cycle_deadline])
+            done, pending = wait(pending, timeout=max(0.0, wake_at - monotonic()), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name = futures[future]
+                with self._lock:
+                    self._started.pop(name, None)
+                try:
+                    values[name] = future.result()
+                except Exception as exc:
+                    self.errors[name] = exc
+                    SOURCE_POLL_ERRORS.inc(name, 'error')
+                    logger.error(f'Polling of {name} failed ({exc.__class__.__name__}: {exc}), last known value kept')
+                    if name in last_values:
+                        values[name] = last_values[name]
+
+            now = monotonic()
+
+            for future in list(pending):
+                name = futures[future]
+                start = started.get(name)
+                if start is not None and now >= start + self.timeout:
+                    logger.error(f'Polling of {name} exceeded {self.timeout} sec, source abandoned for this cycle')
+                    SOURCE_POLL_ERRORS.inc(name, 'timeout')
+                elif start is None and now >= cycle_deadline and future.cancel():
+                    logger.error(f'Polling of {name} not started within cycle time budget, source skipped')
+                    SOURCE_POLL_ERRORS.inc(name, 'skipped')
+                else:
+                    continue
+                pending.discard(future)
+                if not future.cancelled():
+                    self._abandon(name, future)
+                if name in last_values:
+                    values[name] = last_values[name]
+
+        return values
+
+    def shutdown(self) -> None:
+        """
+            Stops the pool, queries which are still running are not awaited.
+
+                Returns:
+                    None
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
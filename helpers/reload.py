@@ -0,0 +1,100 @@
+import os
+import signal
+import logging
+from threading import Event
+from collections import namedtuple
+from typing import NamedTuple, Optional
+
+# longest time in seconds between checks of config file
+CONFIG_CHECK_INTERVAL = 5.0
+# settings applied on reload, other '[Environs]' options and working mode need restart
+RELOADABLE_SETTINGS = ('intervals', 'stability', 'downstream', 'policies')
+
+sources_delta = namedtuple("sources_delta", "added, changed, removed", defaults=[(), (), ()])
+
+
+def source_signature(source: NamedTuple) -> tuple:
+    """
+        Returns comparable signature of the source configuration (executable, monitored files with their locations
+        and sharepoint contexts, upstream sources).
+
+            Parameters:
+                source (NamedTuple): single source from sources
+
+            Returns:
+                signature (tuple): signature of the source
+    """
+    files = tuple(sorted((file, None if params is None else
+                          (os.fspath(params.local_path), id(params.ctx), params.sp_url, params.tenant))
+                         for file, params in source.files.items()))
+
+    # executable by name, function of reloaded module is the same executable
+    return (source.func.__module__, source.func.__qualname__), files, tuple(source.upstream)
+
+
+def sources_diff(old_sources: tuple[NamedTuple, ...], new_sources: tuple[NamedTuple, ...]) -> NamedTuple:
+    """
+        Returns difference between running and newly parsed sources. Source counts as changed if its executable,
+        files, their locations, sharepoint context (changed entry of '[Sp_ctx]') or upstream sources changed.
+
+            Parameters:
+                old_sources (tuple): Collection of running sources
+                new_sources (tuple): Collection of newly parsed sources
+
+            Returns:
+                delta (sources_delta): names of added, changed and removed sources
+    """
+    old = {source.name: source_signature(source) for source in old_sources}
+    new = {source.name: source_signature(source) for source in new_sources}
+
+    return sources_delta(tuple(name for name in new if name not in old),
+                         tuple(name for name in new if name in old and new[name] != old[name]),
+                         tuple(name for name in old if name not in new))
+
+
+class ConfigWatcher:
+    """
+        Detects request for config reload: SIGHUP signal (where available) or change of config file (modify time or
+        size), checked on each call of requested().
+
+            Parameters:
+                path (str): path of the config file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._event = Event()
+        self._signature = self._stat()
+
+        if hasattr(signal, 'SIGHUP'):
+            try:
+                signal.signal(signal.SIGHUP, lambda signum, frame: self._event.set())
+            except ValueError:
+                logging.getLogger(__name__).debug('SIGHUP handler not installed, not in main thread')
+
+    def _stat(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def wait(self, timeout: float) -> None:
+        """
+            Sleeps for given time, returns early if reload was requested by signal.
+        """
+        self._event.wait(max(0.0, timeout))
+
+    def requested(self) -> bool:
+        """
+            Returns True (once) if reload was requested by signal or config file changed since last check.
+        """
+        signature = self._stat()
+        changed = signature is not None and signature != self._signature
+        self._signature = signature or self._signature
+
+        if self._event.is_set() or changed:
+            self._event.clear()
+            return True
+
+        return False
@@ -0,0 +1,162 @@
+import heapq
+import logging
+from time import monotonic
+from collections.abc import Iterable
+from typing import NamedTuple, Optional
+
+
+class PollScheduler:
+    """
+        Priority queue scheduler of source polls. Each source has its own base interval (per source or per tenant,
+        defaults to poll_time) which adapts to observed changes: interval shrinks after change (down to base * min
+        factor) and grows while source stays idle (up to base * max factor). Throttled tenants are not polled
+        before time requested by server (Retry-After).
+
+            Parameters:
+                sources (tuple): Collection of all sources
+                intervals (dict): Collection of source name: base poll interval in seconds
+                min_factor (float): lower bound of adaptive interval as a fraction of base interval
+                max_factor (float): upper bound of adaptive interval as a multiple of base interval
+                backoff (float): growth of interval after each poll without changes
+    """
+
+    def __init__(self, sources: tuple[NamedTuple, ...], intervals: dict[str, float],
+                 min_factor: float = 0.5, max_factor: float = 8.0, backoff: float = 1.5):
+        now = monotonic()
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.backoff = backoff
+        self.base = dict(intervals)
+        self.current = dict(intervals)
+        self.tenants = {source.name: {f.tenant for f in source.files.values() if f is not None and f.tenant}
+                        for source in sources}
+        self._due = {name: now + interval for name, interval in intervals.items()}
+        self._heap = [(due, name) for name, due in self._due.items()]
+        heapq.heapify(self._heap)
+
+    def configure(self, sources: tuple[NamedTuple, ...], intervals: dict[str, float],
+                  reset: Iterable[str] = ()) -> None:
+        """
+            Applies new configuration of sources (after config reload). Removed sources are dropped, new sources and
+            sources in reset start from base interval, unchanged sources keep their schedule.
+
+                Parameters:
+                    sources (tuple): Collection of all sources
+                    intervals (dict): Collection of source name: base poll interval in seconds
+                    reset (iterable): Collection of sources scheduled from scratch
+
+                Returns:
+                    None
+        """
+        now = monotonic()
+        reset = set(reset)
+
+        for name in set(self.base) - set(intervals):
+            del self.base[name], self.current[name]
+            self._due.pop(name, None)
+
+        self.tenants = {source.name: {f.tenant for f in source.files.values() if f is not None and f.tenant}
+                        for source in sources}
+
+        for name, interval in intervals.items():
+            if name not in self.base or name in reset or self.base[name] != interval:
+                self.current[name] = interval
+                self._push(name, now + interval)
+            self.base[name] = interval
+
+    def _push(self, name: str, due: float) -> None:
+        self._due[name] = due
+        heapq.heappush(self._heap, (due, name))
+
+    def wait_time(self) -> float:
+        """
+            Returns number of seconds until the next source is due (0 if some source is already due).
+        """
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return max(0.0, self._heap[0][0] - monotonic()) if self._heap else 3600.0
+
+    def due(self) -> set[str]:
+        """
+            Returns names of sources which are due and removes them from the queue, they need to be rescheduled.
+        """
+        now = monotonic()
+        names = set()
+
+        while self._heap and self._heap[0][0] <= now:
+            due, name = heapq.heappop(self._heap)
+            if self._due.get(name) == due:
+                del self._due[name]
+                names.add(name)
+
+        return names
+
+    def wake(self, names: Iterable[str]) -> None:
+        """
+            Makes given sources due immediately (e.g. on filesystem event).
+        """
+        now = monotonic()
+        for name in names:
+            if name in self.base:
+                self._push(name, now)
+
+    def defer(self, delays: dict[str, Optional[float]]) -> None:
+        """
+            Makes sure given sources are polled not later than after given delay, even if they are event driven
+            (not polled periodically).
+
+                Parameters:
+                    delays (dict): Collection of source name: delay in seconds, None means current poll interval
+
+                Returns:
+                    None
+        """
+        now = monotonic()
+        for name, delay in delays.items():
+            if name not in self.base:
+                continue
+            due = now + (self.current[name] if delay is None else delay)
+            if self._due.get(name, float('inf')) > due:
+                self._push(name, due)
+
+    def reschedule(self, names: Iterable[str], changed: Iterable[str] = (),
+                   throttled: Optional[dict[str, float]] = None, unscheduled: Iterable[str] = ()) -> None:
+        """
+            Puts polled sources back to the queue with interval adapted to the outcome of the poll.
+
+                Parameters:
+                    names (iterable): Collection of polled sources
+                    changed (iterable): Collection of sources with detected changes
+                    throttled (dict): Collection of source name: delay in seconds requested by server (Retry-After),
+                        delay is applied to all sources of the same tenant
+                    unscheduled (iterable): Collection of sources which are not polled periodically (event driven)
+
+                Returns:
+                    None
+        """
+        logger = logging.getLogger(__name__)
+        now = monotonic()
+        changed, unscheduled, throttled = set(changed), set(unscheduled), throttled or {}
+
+        tenant_delays = {}
+        for name, delay in throttled.items():
+            for tenant in self.tenants.get(name, ()):
+                tenant_delays[tenant] = max(delay, tenant_delays.get(tenant, 0.0))
+            logger.warning(f'{name} throttled by server, next poll in {delay:.0f} sec')
+
+        for name in names:
+            if name not in self.base or name in unscheduled:
+                continue
+
+            base = self.base[name]
+            if name in changed:
+                self.current[name] = max(base * self.min_factor, self.current[name] / 2)
+            else:
+                self.current[name] = min(base * self.max_factor, self.current[name] * self.backoff)
+
+            self._push(name, now + max(self.current[name], throttled.get(name, 0.0)))
+
+        for name, tenants in self.tenants.items():
+            delay = max((tenant_delays.get(tenant, 0.0) for tenant in tenants), default=0.0)
+            if delay and name in self._due and self._due[name] < now + delay:
+                self._push(name, now + delay)
@@ -0,0 +1,833 @@
+import os
+import json
+import logging
+from time import time, monotonic
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from collections.abc import Callable, Iterable, Iterator
+from threading import Lock, local
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+from collections import namedtuple
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+
+import requests
+from requests.adapters import HTTPAdapter
+from office365.runtime.auth.authentication_provider import AuthenticationProvider
+from office365.runtime.auth.token_response import TokenResponse
+from office365.runtime.http.request_options import RequestOptions
+from office365.sharepoint.client_context import ClientContext
+
+from helpers.metrics import SP_REQUESTS, SP_RESPONSE_BYTES, SP_THROTTLES, SP_REQUEST_SECONDS
+from helpers.patterns import is_pattern, pattern_literals, pattern_matcher
+from helpers.state import StateStore
+
+JSON_LIGHT = 'application/json;odata=nometadata'
+JSON_VERBOSE = 'application/json;odata=verbose'
+
+# SP.ChangeType values after which item is no longer in the folder
+REMOVED_CHANGE_TYPES = {3, 5}
+CHANGES_FETCH_LIMIT = 1000
+# number of changed items refreshed by single items query ($filter=Id eq ... or ...)
+ITEMS_FILTER_BATCH = 50
+ITEM_FIELDS = 'Id,FileDirRef,FileLeafRef,File/TimeLastModified,File/Length'
+# largest number of values of single CAML 'In' condition
+CAML_IN_LIMIT = 500
+THROTTLE_STATUSES = (429, 503)
+# delay applied when throttled response does not tell how long to wait
+THROTTLE_DEFAULT_DELAY = 60.0
+
+SHAREPOINT_PRINCIPAL = '00000003-0000-0ff1-ce00-000000000000'
+ACS_TOKEN_URL = 'https://accounts.accesscontrol.windows.net/{realm}/tokens/OAuth/2'
+# token is refreshed this number of seconds before it expires
+TOKEN_REFRESH_MARGIN = 300.0
+
+sp_file = namedtuple("sp_file", "name, time_last_modified, length", defaults=[None, None, None])
+
+
+class SpRestClient:
+    """
+        Thin client for SharePoint REST API ('_api') used by polling hot path, requests are sent with JSON light
+        (odata=nometadata) to keep payloads small. Client can be pointed to any server, including local stub.
+
+            Parameters:
+                site_url (str): absolute url of sharepoint site, e.g. https://corp.sharepoint.com/teams/<tenant name>
+                authenticate (Callable): function which adds authentication headers to given dict of headers
+                timeout (float): timeout in seconds of single request
+                session (Session): optional HTTP session (connection pool) shared with other clients of the tenant
+                invalidate (Callable): optional function called when server rejects authentication (HTTP 401),
+                    request is then repeated once with new credentials
+    """
+
+    def __init__(self, site_url: str, authenticate: Optional[Callable[[dict], None]] = None, timeout: float = 30.0,
+                 session: Optional[requests.Session] = None, invalidate: Optional[Callable[[], None]] = None):
+        self.site_url = site_url.rstrip('/')
+        self.host = urlparse(self.site_url).netloc.lower()
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self._authenticate = authenticate
+        self._invalidate = invalidate
+
+    def request(self, method: str, endpoint: str, params: Optional[dict] = None,
+                payload: Optional[dict] = None) -> dict:
+        """
+            Sends request to REST endpoint of the site and returns decoded JSON response.
+
+                Parameters:
+                    method (str): HTTP method
+                    endpoint (str): endpoint relative to '<site url>/_api/' or absolute url (e.g. next page link)
+                    params (dict): query string parameters
+                    payload (dict): body of the request, sent as verbose JSON
+
+                Returns:
+                    response (dict): decoded JSON response, empty dict for empty response
+        """
+        headers = {'Accept': JSON_LIGHT}
+        data = None
+
+        if payload is not None:
+            headers['Content-Type'] = JSON_VERBOSE
+            data = json.dumps(payload)
+
+        url = endpoint if endpoint.startswith(('http://', 'https://')) else f'{self.site_url}/_api/{endpoint}'
+
+        for attempt in range(2):
+            if self._authenticate is not None:
+                self._authenticate(headers)
+            started = monotonic()
+            response = self.session.request(method, url, params=params, data=data, headers=headers,
+                                            timeout=self.timeout)
+            SP_REQUEST_SECONDS.observe(monotonic() - started, self.host)
+            SP_REQUESTS.inc(self.host, method, response.status_code)
+            SP_RESPONSE_BYTES.inc(self.host, value=len(response.content))
+            if response.status_code in THROTTLE_STATUSES:
+                SP_THROTTLES.inc(self.host)
+            if response.status_code != 401 or self._invalidate is None or attempt:
+                break
+            self._invalidate()
+
+        response.raise_for_status()
+
+        return response.json() if response.content else {}
+
+    def get(self, endpoint: str, params: Optional[dict] = None) -> dict:
+        return self.request('GET', endpoint, params=params)
+
+    def post(self, endpoint: str, payload: dict, params: Optional[dict] = None) -> dict:
+        return self.request('POST', endpoint, params=params, payload=payload)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """
+        Returns delay in seconds requested by sharepoint in throttled response (HTTP 429/503, 'Retry-After' header
+        with seconds or HTTP date).
+
+            Parameters:
+                exc (Exception): exception raised while querying sharepoint
+
+            Returns:
+                delay (float): delay in seconds, None if exception is not caused by throttling
+    """
+    response = getattr(exc, 'response', None)
+
+    if response is None or response.status_code not in THROTTLE_STATUSES:
+        return None
+
+    value = response.headers.get('Retry-After')
+
+    if not value:
+        return THROTTLE_DEFAULT_DELAY
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return THROTTLE_DEFAULT_DELAY
+
+
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def sp_session(site_url: str, max_connections: int = 8) -> requests.Session:
+    """
+        Returns HTTP session of sharepoint host, single session (connection pool with keep-alive) is shared by all
+        sites and sources of the host. Number of open connections is bounded, requests above the limit wait for
+        a free connection.
+
+            Parameters:
+                site_url (str): absolute url of sharepoint site
+                max_connections (int): maximum number of connections to the host
+
+            Returns:
+                session (Session): HTTP session of the host
+    """
+    host = urlparse(site_url).netloc.lower()
+
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, max_connections), pool_block=True)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+        return _sessions[host]
+
+
+class TokenCache:
+    """
+        On-disk cache of access tokens, tokens survive restart of the program, so authentication does not start from
+        scratch. File is readable by owner only and replaced atomically on each write. Single cache is shared by all
+        token providers using the same file (see shared_token_cache), file is read again before each write and only
+        the written token is replaced, so tokens stored by other processes are kept. Client secrets are not stored.
+
+            Parameters:
+                path (str): path of the cache file, None keeps tokens in memory only
+    """
+
+    def __init__(self, path: Optional[str] = './logs/sp_tokens.json'):
+        self.path = path
+        self._lock = Lock()
+        self._tokens = None
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                tokens = json.load(f)
+        except (TypeError, OSError, ValueError):
+            return {}
+        return tokens if isinstance(tokens, dict) else {}
+
+    def _load(self) -> dict:
+        if self._tokens is None:
+            self._tokens = self._read()
+        return self._tokens
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key: str, token: dict) -> None:
+        logger = logging.getLogger(__name__)
+
+        with self._lock:
+            if self.path is None:
+                self._load()[key] = token
+                return
+            self._tokens = {**self._read(), key: token}
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                tmp_path = f'{self.path}.tmp'
+                with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w',
+                          encoding='utf-8') as f:
+                    json.dump(self._tokens, f)
+                os.replace(tmp_path, self.path)
+            except OSError as exc:
+                logger.warning(f'Token cache {self.path} not written ({exc})')
+
+
+class AcsTokenProvider(AuthenticationProvider):
+    """
+        App-only (client credentials) token provider of sharepoint host (Azure ACS). Token is kept in token cache and
+        refreshed shortly before it expires, requests go through shared connection pool of the host. Single provider
+        is shared by all contexts of the same host and client id.
+
+            Parameters:
+                site_url (str): absolute url of sharepoint site
+                client_id (str): Client ID of sharepoint app
+                client_secret (str): Client Secret of sharepoint app
+                session (Session): HTTP session of the host
+                cache (TokenCache): token cache
+    """
+
+    def __init__(self, site_url: str, client_id: str, client_secret: str, session: requests.Session,
+                 cache: TokenCache):
+        self.site_url = site_url
+        self.host = urlparse(site_url).netloc
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._session = session
+        self._cache = cache
+        self._key = f'{client_id}@{self.host.lower()}'
+        self._lock = Lock()
+
+    def _realm(self) -> str:
+        response = self._session.head(self.site_url, headers={'Authorization': 'Bearer'}, timeout=30)
+        challenge = response.headers.get('WWW-Authenticate', '')
+        for part in challenge.split(','):
+            name, _, value = part.strip().partition('=')
+            if name.lower().endswith('realm'):
+                return value.strip('"')
+        raise ValueError(f'Realm of {self.site_url} not found in authentication challenge')
+
+    def _acquire(self, realm: str) -> dict:
+        resource = f'{SHAREPOINT_PRINCIPAL}/{self.host}@{realm}'
+        response = self._session.post(ACS_TOKEN_URL.format(realm=realm),
+                                      data={'grant_type': 'client_credentials',
+                                            'client_id': f'{self._client_id}@{realm}',
+                                            'client_secret': self._client_secret,
+                                            'resource': resource, 'scope': resource},
+                                      timeout=30)
+        response.raise_for_status()
+        token = response.json()
+        expires_on = float(token.get('expires_on') or time() + float(token.get('expires_in', 3600)))
+
+        return {'access_token': token['access_token'], 'token_type': token.get('token_type', 'Bearer'),
+                'expires_on': expires_on, 'realm': realm}
+
+    def token(self) -> TokenResponse:
+        """
+            Returns valid access token, token is taken from cache or acquired again if it expires within refresh
+            margin.
+
+                Returns:
+                    token (TokenResponse): access token
+        """
+        logger = logging.getLogger(__name__)
+
+        with self._lock:
+            token = self._cache.get(self._key)
+            if token is None or token['expires_on'] - TOKEN_REFRESH_MARGIN <= time():
+                realm = token['realm'] if token else self._realm()
+                token = self._acquire(realm)
+                self._cache.set(self._key, token)
+                logger.debug(f'Access token of {self.host} acquired, valid for '
+                             f'{token["expires_on"] - time():.0f} sec')
+
+        return TokenResponse(accessToken=token['access_token'], tokenType=token['token_type'])
+
+    def invalidate(self) -> None:
+        """
+            Drops cached token (e.g. rejected by server), next request acquires new one.
+        """
+        with self._lock:
+            token = self._cache.get(self._key)
+            if token is not None:
+                self._cache.set(self._key, {**token, 'expires_on': 0})
+
+    def authenticate_request(self, request: RequestOptions) -> None:
+        token = self.token()
+        request.set_header('Authorization', f'{token.tokenType} {token.accessToken}')
+
+
+class SpClientContext(ClientContext):
+    """
+        Sharepoint context authenticated by shared token provider of the host (cached and refreshed token) instead
+        of per-context credentials.
+
+            Parameters:
+                site_url (str): absolute url of sharepoint site
+                token_provider (AcsTokenProvider): token provider of the host
+                max_connections (int): maximum number of connections to the host used by REST client
+    """
+
+    def __init__(self, site_url: str, token_provider: AcsTokenProvider, max_connections: int = 8):
+        super().__init__(site_url)
+        self.token_provider = token_provider
+        self.max_connections = max_connections
+
+    def authenticate_request(self, request: RequestOptions) -> None:
+        self.token_provider.authenticate_request(request)
+
+
+_token_caches = {}
+_token_caches_lock = Lock()
+
+
+def shared_token_cache(path: Optional[str] = './logs/sp_tokens.json') -> TokenCache:
+    """
+        Returns token cache of given file, single cache is kept per file (shared by all hosts and client ids).
+
+            Parameters:
+                path (str): path of the cache file, None keeps tokens in memory only
+
+            Returns:
+                cache (TokenCache): token cache
+    """
+    with _token_caches_lock:
+        key = os.path.abspath(path) if path is not None else None
+        if key not in _token_caches:
+            _token_caches[key] = TokenCache(path)
+        return _token_caches[key]
+
+
+_token_providers = {}
+_token_providers_lock = Lock()
+
+
+def sp_client_context(site_url: str, client_id: str, client_secret: str, max_connections: int = 8,
+                      token_cache: Optional[str] = './logs/sp_tokens.json') -> SpClientContext:
+    """
+        Returns sharepoint context of the site, contexts of the same host and client id share token provider, token
+        cache and connection pool.
+
+            Parameters:
+                site_url (str): absolute url of sharepoint site
+                client_id (str): Client ID of sharepoint app
+                client_secret (str): Client Secret of sharepoint app
+                max_connections (int): maximum number of connections to the host
+                token_cache (str): path of on-disk token cache, None keeps tokens in memory only
+
+            Returns:
+                ctx (SpClientContext): sharepoint context
+    """
+    with _token_providers_lock:
+        key = (urlparse(site_url).netloc.lower(), client_id)
+        if key not in _token_providers:
+            _token_providers[key] = AcsTokenProvider(site_url, client_id, client_secret,
+                                                     sp_session(site_url, max_connections),
+                                                     shared_token_cache(token_cache))
+        return SpClientContext(site_url, _token_providers[key], max_connections)
+
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def sp_rest_client(ctx: ClientContext) -> SpRestClient:
+    """
+        Returns REST client for site of given sharepoint context, requests are authenticated by the context.
+        Single client is kept per site, clients of contexts with shared token provider use connection pool of
+        the host.
+
+            Parameters:
+                ctx (ClientContext): Sharepoint connection object (ctx)
+
+            Returns:
+                client (SpRestClient): REST client of ctx site
+    """
+    def _authenticate(headers: dict) -> None:
+        request = RequestOptions(ctx.base_url)
+        ctx.authenticate_request(request)
+        headers.update(request.headers)
+
+    with _clients_lock:
+        if ctx.base_url not in _clients:
+            if isinstance(ctx, SpClientContext):
+                _clients[ctx.base_url] = SpRestClient(ctx.base_url, _authenticate,
+                                                      session=sp_session(ctx.base_url, ctx.max_connections),
+                                                      invalidate=ctx.token_provider.invalidate)
+            else:
+                _clients[ctx.base_url] = SpRestClient(ctx.base_url, _authenticate)
+        return _clients[ctx.base_url]
+
+
+def odata_literal(value: str) -> str:
+    """
+        Returns string as OData string literal (quoted, inner quotes doubled).
+
+            Parameters:
+                value (str): string value
+
+            Returns:
+                literal (str): OData literal
+    """
+    return "'" + value.replace("'", "''") + "'"
+
+
+def files_condition(files: Iterable[str]) -> Optional[str]:
+    """
+        Returns CAML condition narrowing file names of folder listing on server side. Exact names are combined into
+        single 'In' condition, single pattern is narrowed down by its literal parts ('BeginsWith', 'Contains'), exact
+        match is left to the caller (helpers.patterns). Only last level of recursive patterns is used (file names in
+        any folder).
+
+            Parameters:
+                files (iterable): Collection of file names and file patterns (see helpers.patterns)
+
+            Returns:
+                condition (str): CAML condition, None if names cannot be narrowed (e.g. '*' or names mixed with
+                    patterns)
+    """
+    names = sorted({file.strip('/').rsplit('/', 1)[-1] for file in files})
+
+    if names and len(names) <= CAML_IN_LIMIT and not any(is_pattern(name) for name in names):
+        values = ''.join(f'<Value Type="File">{escape(name)}</Value>' for name in names)
+        return f'<In><FieldRef Name="FileLeafRef"/><Values>{values}</Values></In>'
+
+    if len(names) != 1:
+        return None
+
+    parts = pattern_literals(names[0])
+    conditions = [f'<BeginsWith><FieldRef Name="FileLeafRef"/><Value Type="File">{escape(parts[0])}</Value>'
+                  f'</BeginsWith>'] if parts[0] else []
+    conditions += [f'<Contains><FieldRef Name="FileLeafRef"/><Value Type="File">{escape(part)}</Value></Contains>'
+                   for part in parts[1:] if part]
+
+    return caml_and(conditions)
+
+
+def caml_and(conditions: list[str]) -> Optional[str]:
+    """
+        Returns CAML conditions combined with nested 'And' (binary in CAML).
+
+            Parameters:
+                conditions (list): Collection of CAML conditions
+
+            Returns:
+                condition (str): combined condition, None for no conditions
+    """
+    if not conditions:
+        return None
+
+    combined = conditions[-1]
+    for condition in reversed(conditions[:-1]):
+        combined = f'<And>{condition}{combined}</And>'
+
+    return combined
+
+
+_folder_lists = {}
+_folder_lists_lock = Lock()
+
+
+def sp_folder_list_id(client: SpRestClient, folder_url: str) -> str:
+    """
+        Returns id of document library holding given folder, looked up once per site and folder.
+
+            Parameters:
+                client (SpRestClient): REST client of the site
+                folder_url (str): server relative url of the folder
+
+            Returns:
+                list_id (str): id of the document library
+    """
+    folder_url = '/' + folder_url.strip('/')
+    key = (client.site_url, folder_url.lower())
+
+    with _folder_lists_lock:
+        list_id = _folder_lists.get(key)
+
+    if list_id is None:
+        properties = client.get('web/GetFolderByServerRelativeUrl(@u)/Properties',
+                                {'@u': odata_literal(folder_url), '$select': 'vti_x005f_listname'})
+        list_id = properties['vti_x005f_listname'].strip('{}').lower()
+        with _folder_lists_lock:
+            _folder_lists[key] = list_id
+
+    return list_id
+
+
+def sp_folder_items(client: SpRestClient, list_id: str, folder_url: str, page_size: int = 500,
+                    condition: Optional[str] = None) -> Iterator[dict]:
+    """
+        Yields file items of single folder (without its subfolders) page by page. Query is scoped to the folder
+        (FolderServerRelativeUrl) and pages are ordered and bounded by item id, which is always indexed, so listing
+        stays within list view threshold of large libraries.
+
+            Parameters:
+                client (SpRestClient): REST client of the site
+                list_id (str): id of the document library
+                folder_url (str): server relative url of the folder
+                page_size (int): number of items requested per page
+                condition (str): optional CAML condition on items (e.g. file names, see files_condition)
+
+            Returns:
+                items (Iterator): list items with Id, FileDirRef, FileLeafRef and File (TimeLastModified, Length)
+    """
+    last_id = 0
+
+    while True:
+        where = caml_and([f'<Gt><FieldRef Name="ID"/><Value Type="Counter">{last_id}</Value></Gt>',
+                          *([condition] if condition else [])])
+        view = (f'<View Scope="FilesOnly"><Query><Where>{where}</Where><OrderBy><FieldRef Name="ID" '
+                f'Ascending="TRUE"/></OrderBy></Query><RowLimit>{page_size}</RowLimit></View>')
+        page = client.post(f"web/lists(guid'{list_id}')/GetItems",
+                                       {'query': {'__metadata': {'type': 'SP.CamlQuery'}, 'ViewXml': view,
+                                                  'FolderServerRelativeUrl': '/' + folder_url.strip('/')}},
+                                       {'$select': ITEM_FIELDS, '$expand': 'File'}).get('value', [])
+        yield from (item for item in page if item.get('File'))
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['Id']
+
+
+def sp_folder_files(client: SpRestClient, folder_url: str, files: Iterable[str],
+                    page_size: int = 500) -> list[NamedTuple]:
+    """
+        Returns files of sharepoint folder matching any of file names or patterns. Each folder is listed once for all
+        names and patterns, listing is checked by single compiled matcher. Items of the folder are fetched page by
+        page (see sp_folder_items) with only name, modify time and size, exact names (or single pattern) are
+        narrowed on server side. Recursive patterns ('**', 'sub/*.csv') walk only subfolders they can reach.
+
+            Parameters:
+                client (SpRestClient): REST client of the site
+                folder_url (str): server relative url of the folder
+                files (iterable): Collection of file names and file patterns (see helpers.patterns)
+                page_size (int): number of items requested per page
+
+            Returns:
+                files (list): Collection of sp_file (path relative to the folder, time last modified, length)
+    """
+    files = frozenset(files)
+    matcher = pattern_matcher(files)
+    condition = files_condition(files)
+    list_id = sp_folder_list_id(client, folder_url)
+    folders = ['']
+    matched = []
+
+    while folders:
+        prefix = folders.pop()
+        url = '/' + f"{folder_url.strip('/')}/{prefix}".strip('/')
+
+        matched += [sp_file(prefix + item['FileLeafRef'], item['File']['TimeLastModified'],
+                            int(item['File']['Length']))
+                    for item in sp_folder_items(client, list_id, url, page_size, condition)
+                    if matcher.match(prefix + item['FileLeafRef'])]
+
+        if matcher.recursive:
+            subfolders = client.get('web/GetFolderByServerRelativeUrl(@u)/Folders',
+                                    {'@u': odata_literal(url), '$select': 'Name'}).get('value', [])
+            folders += [f"{prefix}{f['Name']}/" for f in subfolders if matcher.descend(prefix + f['Name'])]
+
+    return matched
+
+
+class SpDeltaTracker:
+    """
+        Change token (delta) tracker of single sharepoint document library, shared by all its tracked folders. Each
+        folder is listed once when it is first tracked (list items of the folder, page by page), then changes of the
+        library since current change token are queried once per cycle (GetChanges) for all folders at once and
+        changed items are refreshed with single items query per batch of ids. Change token is persisted in state
+        store (if given) together with files of folders which changed, so tracking continues after restart without
+        listing folders again. If token expired or was rejected, tracked folders are listed again from scratch.
+
+            Parameters:
+                client (SpRestClient): REST client of the site
+                list_id (str): id of the document library
+                page_size (int): number of items requested per page of folder listing
+                store (StateStore): optional state store keeping change token and files of tracked folders
+    """
+
+    def __init__(self, client: SpRestClient, list_id: str, page_size: int = 500, store: Optional[StateStore] = None):
+        self.client = client
+        self.list_id = list_id
+        self.page_size = page_size
+        self.store = store
+        self.token = None
+        self.stale = False
+        self._folders = {}
+        self._changed = set()
+        self._lock = Lock()
+
+        stored = store.delta_state(self._key) if store is not None else None
+        if stored is not None:
+            self.token = stored[0]
+            self._folders = {folder: {int(item_id): sp_file(*f) for item_id, f in files.items()}
+                             for folder, files in stored[1].items()}
+            self.stale = True
+
+    @property
+    def _key(self) -> str:
+        return f'{self.client.site_url}|{self.list_id}'
+
+    @property
+    def _list(self) -> str:
+        return f"web/lists(guid'{self.list_id}')"
+
+    def _current_token(self) -> str:
+        return self.client.get(self._list, {'$select': 'CurrentChangeToken'})['CurrentChangeToken']['StringValue']
+
+    def _full_listing(self, folder_url: str) -> dict[int, NamedTuple]:
+        return {item['Id']: sp_file(item['FileLeafRef'], item['File']['TimeLastModified'], int(item['File']['Length']))
+                for item in sp_folder_items(self.client, self.list_id, folder_url, self.page_size)}
+
+    def _changes(self) -> list[dict]:
+        query = {'__metadata': {'type': 'SP.ChangeQuery'},
+                 'Item': True, 'File': True, 'Add': True, 'Update': True, 'DeleteObject': True, 'Rename': True,
+                 'Restore': True, 'Move': True, 'FetchLimit': CHANGES_FETCH_LIMIT,
+                 'ChangeTokenStart': {'__metadata': {'type': 'SP.ChangeToken'}, 'StringValue': self.token}}
+        changes = []
+
+        while True:
+            page = self.client.post(f'{self._list}/GetChanges', {'query': query}).get('value', [])
+            changes.extend(page)
+            if len(page) < CHANGES_FETCH_LIMIT:
+                return changes
+            query['ChangeTokenStart']['StringValue'] = page[-1]['ChangeToken']['StringValue']
+
+    def _refresh_items(self, item_ids: list[int]) -> None:
+        items = {}
+
+        for i in range(0, len(item_ids), ITEMS_FILTER_BATCH):
+            batch = item_ids[i:i + ITEMS_FILTER_BATCH]
+            page = self.client.get(f'{self._list}/items',
+                                   {'$filter': ' or '.join(f'Id eq {item_id}' for item_id in batch),
+                                    '$select': ITEM_FIELDS,
+                                    '$expand': 'File', '$top': len(batch)})
+            items.update((item['Id'], item) for item in page.get('value', []))
+
+        for item_id in item_ids:
+            item = items.get(item_id)
+            folder = item['FileDirRef'].lower() if item is not None and item.get('File') else None
+
+            for folder_url, files in self._folders.items():
+                if folder_url == folder:
+                    files[item_id] = sp_file(item['FileLeafRef'], item['File']['TimeLastModified'],
+                                             int(item['File']['Length']))
+                    self._changed.add(folder_url)
+                elif files.pop(item_id, None) is not None:
+                    self._changed.add(folder_url)
+
+    def _apply_changes(self, changes: list[dict]) -> bool:
+        changed_items = {}
+
+        for change in changes:
+            if 'ItemId' in change:
+                changed_items[change['ItemId']] = change['ChangeType']
+
+        for item_id, change_type in changed_items.items():
+            if change_type in REMOVED_CHANGE_TYPES:
+                for folder_url, files in self._folders.items():
+                    if files.pop(item_id, None) is not None:
+                        self._changed.add(folder_url)
+
+        self._refresh_items([item_id for item_id, change_type in changed_items.items()
+                             if change_type not in REMOVED_CHANGE_TYPES])
+
+        if changes:
+            self.token = changes[-1]['ChangeToken']['StringValue']
+
+        return bool(changes)
+
+    def _relist(self) -> None:
+        # token and listings are replaced together, failed listing keeps the previous state for the next attempt
+        token = self._current_token()
+        folders = {folder_url: self._full_listing(folder_url) for folder_url in self._folders}
+        self.token, self._folders = token, folders
+        self._changed.update(folders)
+
+    def _save(self) -> None:
+        if self.store is not None:
+            self.store.set_delta_state(self._key, self.token,
+                                       {folder: {item_id: list(f) for item_id, f in self._folders[folder].items()}
+                                        for folder in self._changed})
+        self._changed.clear()
+
+    def files(self, folder_url: str) -> list[NamedTuple]:
+        """
+            Returns files of the folder, up to date with the latest change of the document library. Changes are
+            queried at most once per cycle (see new_cycle) for all tracked folders, inside own cycle of calling
+            thread (see sp_delta_own_cycle) once per own cycle.
+
+                Parameters:
+                    folder_url (str): server relative url of the folder
+
+                Returns:
+                    files (list): Collection of sp_file (name, time last modified, length)
+        """
+        logger = logging.getLogger(__name__)
+        folder_url = '/' + folder_url.strip('/')
+        changed = False
+        refreshed = getattr(_own_cycle, 'trackers', None)
+
+        with self._lock:
+            stale = self.stale if refreshed is None else self not in refreshed
+            if self.token is None:
+                self.token = self._current_token()
+                stale, changed = False, True
+            elif stale:
+                try:
+                    changes = self._changes()
+                except requests.HTTPError as exc:
+                    status = exc.response.status_code if exc.response is not None else None
+                    if status in (401, 403, *THROTTLE_STATUSES):
+                        raise
+                    logger.info(f'Change token of library {self.list_id} rejected ({status}), listing '
+                                f'{len(self._folders)} folders again')
+                    self._relist()
+                    changed = True
+                else:
+                    changed = self._apply_changes(changes)
+                stale = False
+
+            if refreshed is None:
+                self.stale = stale
+            else:
+                refreshed.add(self)
+
+            if folder_url.lower() not in self._folders:
+                # listing is taken after the token, changes in between are applied again next cycle (idempotent)
+                self._folders[folder_url.lower()] = self._full_listing(folder_url)
+                self._changed.add(folder_url.lower())
+                changed = True
+
+            if changed:
+                self._save()
+
+            return list(self._folders[folder_url.lower()].values())
+
+    def new_cycle(self) -> None:
+        """
+            Starts new polling cycle, changes of the library are queried again on next call of files.
+
+                Returns:
+                    None
+        """
+        self.stale = True
+
+
+_trackers = {}
+_trackers_lock = Lock()
+_own_cycle = local()
+
+
+def sp_delta_tracker(ctx: ClientContext, folder_url: str, page_size: int = 500,
+                     store: Optional[StateStore] = None) -> SpDeltaTracker:
+    """
+        Returns delta tracker of document library of given folder, single tracker is kept per site and library and
+        is shared by all its folders.
+
+            Parameters:
+                ctx (ClientContext): Sharepoint connection object (ctx)
+                folder_url (str): server relative url of the folder
+                page_size (int): number of items requested per page of folder listing
+                store (StateStore): optional state store keeping change tokens
+
+            Returns:
+                tracker (SpDeltaTracker): change token tracker of the library
+    """
+    client = sp_rest_client(ctx)
+    list_id = sp_folder_list_id(client, folder_url)
+
+    with _trackers_lock:
+        key = (ctx.base_url, list_id)
+        if key not in _trackers:
+            _trackers[key] = SpDeltaTracker(client, list_id, page_size, store)
+        return _trackers[key]
+
+
+def sp_delta_new_cycle() -> None:
+    """
+        Starts new polling cycle of all delta trackers, each library is asked for its changes once per cycle. Inside
+        sp_delta_own_cycle only own cycle of calling thread is started again.
+
+            Returns:
+                None
+    """
+    refreshed = getattr(_own_cycle, 'trackers', None)
+
+    if refreshed is not None:
+        refreshed.clear()
+        return
+
+    with _trackers_lock:
+        for tracker in _trackers.values():
+            tracker.new_cycle()
+
+
+@contextmanager
+def sp_delta_own_cycle() -> Iterator[None]:
+    """
+        Runs delta tracker lookups of calling thread in its own cycle (e.g. refresh of single source while main
+        polling cycle is in progress), only trackers used by the thread are asked for their changes, cycle of
+        other trackers is left intact.
+    """
+    _own_cycle.trackers = set()
+    try:
+        yield
+    finally:
+        del _own_cycle.trackers
@@ -0,0 +1,81 @@
+import logging
+from time import monotonic
+from collections import namedtuple
+from collections.abc import Iterable
+from typing import NamedTuple, Optional
+
+stability_window = namedtuple("stability_window", "seconds, polls", defaults=[0.0, 0])
+
+
+class WriteStabilizer:
+    """
+        Quiescence window of sources. Change of source is held back until its files stay stable (no further change
+        detected) for given number of seconds or given number of polls, all changes in between are coalesced into
+        single dispatch. Protects executables from running on partially copied or uploaded files.
+
+            Parameters:
+                windows (dict): Collection of source name: stability_window (seconds, polls), sources without window
+                    or with empty window are dispatched right away
+    """
+
+    def __init__(self, windows: dict[str, NamedTuple]):
+        self.windows = {name: window for name, window in windows.items() if window.seconds or window.polls}
+        self._pending = {}
+
+    def configure(self, windows: dict[str, NamedTuple]) -> None:
+        """
+            Applies new stability windows (after config reload), sources left without window are no longer held.
+
+                Parameters:
+                    windows (dict): Collection of source name: stability_window (seconds, polls)
+
+                Returns:
+                    None
+        """
+        self.windows = {name: window for name, window in windows.items() if window.seconds or window.polls}
+        self._pending = {name: pending for name, pending in self._pending.items() if name in self.windows}
+
+    def update(self, polled: Iterable[str], changed: Iterable[str]) -> list[str]:
+        """
+            Registers outcome of the poll and returns sources ready to be dispatched.
+
+                Parameters:
+                    polled (iterable): Collection of polled sources
+                    changed (iterable): Collection of sources with detected changes
+
+                Returns:
+                    ready (list): Collection of sources which are stable and should be dispatched
+        """
+        logger = logging.getLogger(__name__)
+        now = monotonic()
+        changed = list(changed)
+        ready = [name for name in changed if name not in self.windows]
+
+        for name in changed:
+            if name in self.windows:
+                if name not in self._pending:
+                    logger.info(f'{name} changed, waiting until files are stable')
+                self._pending[name] = [now, 0]
+
+        for name in set(polled) - set(changed):
+            if name not in self._pending:
+                continue
+
+            last_change, stable_polls = self._pending[name]
+            self._pending[name][1] = stable_polls = stable_polls + 1
+            window = self.windows[name]
+
+            if now - last_change >= window.seconds and stable_polls >= window.polls:
+                del self._pending[name]
+                ready.append(name)
+
+        return ready
+
+    def wake_times(self) -> dict[str, Optional[float]]:
+        """
+            Returns delay in seconds after which pending sources need to be polled again to confirm stability,
+            None for windows counted in polls (regular poll interval applies).
+        """
+        now = monotonic()
+        return {name: max(0.0, last_change + self.windows[name].seconds - now) if self.windows[name].seconds else None
+                for name, (last_change, _) in self._pending.items()}
@@ -0,0 +1,488 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+from time import time
+from threading import RLock
+from collections import namedtuple
+from typing import NamedTuple, Optional
+
+file_state = namedtuple("file_state", "path, mtime_ns, size, fingerprint", defaults=[None, None, None, None])
+file_delta = namedtuple("file_delta", "added, modified, removed", defaults=[(), (), ()])
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sources (
+        source TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS files (
+        source TEXT NOT NULL,
+        path TEXT NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER,
+        fingerprint TEXT,
+        PRIMARY KEY (source, path)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS pending (
+        source TEXT NOT NULL,
+        path TEXT NOT NULL,
+        change TEXT NOT NULL,
+        mtime_ns INTEGER,
+        size INTEGER,
+        PRIMARY KEY (source, path)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        source TEXT NOT NULL,
+        status TEXT NOT NULL,
+        inputs TEXT NOT NULL,
+        dispatched_at REAL NOT NULL,
+        finished_at REAL,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS runs_source ON runs (source, id);
+    DROP TABLE IF EXISTS delta;
+    CREATE TABLE IF NOT EXISTS delta_tokens (
+        library TEXT PRIMARY KEY,
+        token TEXT NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS delta_folders (
+        library TEXT NOT NULL,
+        folder TEXT NOT NULL,
+        files TEXT NOT NULL,
+        PRIMARY KEY (library, folder)
+    ) WITHOUT ROWID;
+"""
+
+# number of runs kept in the journal for each source
+JOURNAL_RUNS = 100
+# number of paths bound to single query (SQLite limits number of variables of a statement)
+QUERY_CHUNK = 900
+
+run_record = namedtuple("run_record", "id, source, status, inputs, dispatched_at, finished_at, error",
+                        defaults=[None, None, None, None, None, None, None])
+
+# (new change, pending change): merged change, file removed after being added is dropped from pending changes
+PENDING_MERGE = {('added', 'removed'): 'modified', ('modified', 'added'): 'added'}
+
+
+class StateStore:
+    """
+        Crash-safe store of per-file state (modify time in ns, size, content fingerprint) of all sources, kept in
+        SQLite database in WAL mode. Only rows which changed are written (single transaction per cycle), state of
+        source is loaded from disk on first use, so startup does not depend on number of tracked files.
+
+            Parameters:
+                path (str): path of the database file
+                timeout (float): time in seconds to wait for write lock held by other instance (cluster mode)
+    """
+
+    def __init__(self, path: str = './logs/state.sqlite3', timeout: float = 5.0):
+        self.path = path
+        self._lock = RLock()
+        self._files = {}
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        self._known = {row[0] for row in self._conn.execute('SELECT source FROM sources')}
+
+    def files(self, source: str) -> dict[str, NamedTuple]:
+        """
+            Returns stored state of files of the source (loaded from disk on first call).
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    files (dict): Collection of path: file_state
+        """
+        with self._lock:
+            if source not in self._files:
+                rows = self._conn.execute('SELECT path, mtime_ns, size, fingerprint FROM files WHERE source = ?',
+                                          (source,))
+                self._files[source] = {row[0]: file_state(*row) for row in rows}
+            return self._files[source]
+
+    def update(self, snapshot: dict[str, dict[str, NamedTuple]]) -> dict[str, NamedTuple]:
+        """
+            Applies current state of polled sources and returns deltas of sources which changed. File counts as
+            modified if its modify time or size differs. Sources seen for the first time are stored as a baseline
+            and are not reported. Deltas are also merged into pending changes of the source (changes since its last
+            successful run).
+
+                Parameters:
+                    snapshot (dict): Collection of source name: {path: file_state} for polled sources
+
+                Returns:
+                    deltas (dict): Collection of source name: file_delta (added, modified, removed) of changed sources
+        """
+        deltas = {}
+
+        with self._lock:
+            # write lock is taken up front, instances sharing the database (cluster mode) do not fail on upgrade
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for source, current in snapshot.items():
+                    delta = self._apply(source, current)
+                    if source not in self._known:
+                        self._conn.execute('INSERT OR IGNORE INTO sources (source) VALUES (?)', (source,))
+                        self._known.add(source)
+                    elif delta is not None:
+                        deltas[source] = delta
+                        self._add_pending(source, delta)
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                self._files.clear()
+                raise
+
+        return deltas
+
+    def _apply(self, source: str, current: dict[str, NamedTuple]) -> Optional[NamedTuple]:
+        stored = self.files(source)
+        added = [f for path, f in current.items() if path not in stored]
+        modified = [f for path, f in current.items()
+                    if path in stored and (stored[path].mtime_ns, stored[path].size) != (f.mtime_ns, f.size)]
+        removed = [f for path, f in stored.items() if path not in current]
+
+        if not (added or modified or removed):
+            return None
+
+        upserts = [(source, f.path, f.mtime_ns, f.size, stored[f.path].fingerprint if f.path in stored else None)
+                   for f in added + modified]
+        self._conn.executemany('INSERT OR REPLACE INTO files (source, path, mtime_ns, size, fingerprint) '
+                               'VALUES (?, ?, ?, ?, ?)', upserts)
+        self._conn.executemany('DELETE FROM files WHERE source = ? AND path = ?',
+                               [(source, f.path) for f in removed])
+
+        for row in upserts:
+            stored[row[1]] = file_state(*row[1:])
+        for f in removed:
+            del stored[f.path]
+
+        return file_delta(tuple(added), tuple(modified), tuple(removed))
+
+    def _add_pending(self, source: str, delta: NamedTuple) -> None:
+        paths = [f.path for f in delta.added + delta.modified + delta.removed]
+        pending = {}
+
+        for i in range(0, len(paths), QUERY_CHUNK):
+            chunk = paths[i:i + QUERY_CHUNK]
+            pending.update(self._conn.execute(
+                f'SELECT path, change FROM pending WHERE source = ? AND path IN ({", ".join("?" * len(chunk))})',
+                (source, *chunk)).fetchall())
+
+        upserts, deletes = [], []
+        for change, files in (('added', delta.added), ('modified', delta.modified), ('removed', delta.removed)):
+            for f in files:
+                previous = pending.get(f.path)
+                if change == 'removed' and previous == 'added':
+                    deletes.append((source, f.path))
+                    continue
+                upserts.append((source, f.path, PENDING_MERGE.get((change, previous), change), f.mtime_ns, f.size))
+
+        self._conn.executemany('INSERT OR REPLACE INTO pending (source, path, change, mtime_ns, size) '
+                               'VALUES (?, ?, ?, ?, ?)', upserts)
+        self._conn.executemany('DELETE FROM pending WHERE source = ? AND path = ?', deletes)
+
+    def pending(self, source: str) -> NamedTuple:
+        """
+            Returns changes of source files since last successful run of its executable.
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    changes (file_delta): added, modified and removed files (file_state with modify time and size)
+        """
+        changes = {'added': [], 'modified': [], 'removed': []}
+
+        with self._lock:
+            rows = self._conn.execute('SELECT path, change, mtime_ns, size FROM pending WHERE source = ? '
+                                      'ORDER BY path', (source,)).fetchall()
+
+        for path, change, mtime_ns, size in rows:
+            changes[change].append(file_state(path, mtime_ns, size))
+
+        return file_delta(**{change: tuple(files) for change, files in changes.items()})
+
+    def clear_pending(self, source: str, changes: NamedTuple) -> None:
+        """
+            Removes delivered changes from pending changes of the source (after successful run). Files which changed
+            again in the meantime stay pending.
+
+                Parameters:
+                    source (str): source name
+                    changes (file_delta): changes delivered to the executable
+
+                Returns:
+                    None
+        """
+        rows = [(source, f.path, change, f.mtime_ns, f.size)
+                for change, files in zip(file_delta._fields, changes) for f in files]
+
+        with self._lock:
+            self._conn.executemany('DELETE FROM pending WHERE source = ? AND path = ? AND change = ? '
+                                   'AND mtime_ns IS ? AND size IS ?', rows)
+
+    def skip(self, source: str) -> None:
+        """
+            Records that current changes of the source need no run (e.g. only modify times changed, content is the
+            same): pending changes are dropped, so they are neither delivered to its next run nor dispatched after
+            restart. Changes of failed latest run stay pending, they still have to be processed.
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            latest = self.last_run(source)
+            if latest is None or latest.status != 'failed':
+                self._conn.execute('DELETE FROM pending WHERE source = ?', (source,))
+
+    def inputs(self, source: str) -> str:
+        """
+            Returns fingerprint of current inputs of the source (paths, modify times and sizes of its files).
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    inputs (str): hex digest of source inputs
+        """
+        digest = hashlib.blake2b(digest_size=16)
+
+        with self._lock:
+            for path, f in sorted(self.files(source).items()):
+                digest.update(f'{path}\0{f.mtime_ns}\0{f.size}\n'.encode())
+
+        return digest.hexdigest()
+
+    def last_run(self, source: str, status: Optional[str] = None) -> Optional[NamedTuple]:
+        """
+            Returns latest run of the source recorded in the journal.
+
+                Parameters:
+                    source (str): source name
+                    status (str): optional status of the run ('dispatched', 'succeeded', 'failed')
+
+                Returns:
+                    run (run_record): latest run or None if there is no such run
+        """
+        query = 'SELECT * FROM runs WHERE source = ?' + (' AND status = ?' if status else '') + \
+            ' ORDER BY id DESC LIMIT 1'
+
+        with self._lock:
+            row = self._conn.execute(query, (source, status) if status else (source,)).fetchone()
+
+        return run_record(*row) if row else None
+
+    def run_started(self, source: str) -> NamedTuple:
+        """
+            Records dispatched run of the source in the journal together with fingerprint of its inputs and returns
+            changes of source files since last successful run (to be delivered to the executable).
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    changes (file_delta): added, modified and removed files since last successful run
+        """
+        with self._lock:
+            self._conn.execute('INSERT INTO runs (source, status, inputs, dispatched_at) VALUES (?, ?, ?, ?)',
+                               (source, 'dispatched', self.inputs(source), time()))
+            self._conn.execute('DELETE FROM runs WHERE source = ? AND id <= (SELECT id FROM runs WHERE source = ? '
+                               'ORDER BY id DESC LIMIT 1 OFFSET ?)', (source, source, JOURNAL_RUNS))
+            return self.pending(source)
+
+    def run_finished(self, source: str, changes: Optional[NamedTuple], exitcode: int,
+                     error: Optional[str] = None) -> None:
+        """
+            Records outcome of the latest run of the source in the journal, changes delivered to successful run are
+            no longer pending.
+
+                Parameters:
+                    source (str): source name
+                    changes (file_delta): changes delivered to the executable
+                    exitcode (int): 0 if run succeeded
+                    error (str): optional error message of failed run
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._conn.execute('UPDATE runs SET status = ?, finished_at = ?, error = ? WHERE id = '
+                               '(SELECT max(id) FROM runs WHERE source = ? AND status = ?)',
+                               ('failed' if exitcode else 'succeeded', time(), error, source, 'dispatched'))
+            if not exitcode and changes is not None:
+                self.clear_pending(source, changes)
+
+    def unprocessed(self, sources: list[str]) -> list[str]:
+        """
+            Returns sources which need to be dispatched after restart (or after they are taken over from another
+            instance in cluster mode): sources with changes not processed by a successful run (run interrupted by
+            crash, failed or never started) whose inputs differ from inputs of their last successful run.
+            Interrupted runs of given sources are marked as failed, sources whose inputs are the same as in the last
+            successful run have their pending changes dropped.
+
+                Parameters:
+                    sources (list): Collection of source names
+
+                Returns:
+                    sources2refresh (list): Collection of sources to dispatch
+        """
+        logger = logging.getLogger(__name__)
+        sources2refresh = []
+
+        with self._lock:
+            for source in sources:
+                self._conn.execute('UPDATE runs SET status = ?, finished_at = ?, error = ? WHERE source = ? AND '
+                                   'status = ?', ('failed', time(), 'interrupted', source, 'dispatched'))
+                latest, succeeded, pending = self.last_run(source), self.last_run(source, 'succeeded'), \
+                    self.pending(source)
+
+                if not any(pending) and (latest is None or latest.status == 'succeeded'):
+                    continue
+
+                if succeeded is not None and succeeded.inputs == self.inputs(source):
+                    self.clear_pending(source, pending)
+                    continue
+
+                logger.info(f'{source} has changes not processed by successful run, dispatch scheduled')
+                sources2refresh.append(source)
+
+        return sources2refresh
+
+    def set_fingerprints(self, source: str, fingerprints: dict[str, str]) -> None:
+        """
+            Stores content fingerprints of source files, only fingerprints which differ are written.
+
+                Parameters:
+                    source (str): source name
+                    fingerprints (dict): Collection of path: fingerprint
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            stored = self.files(source)
+            changed = [(digest, source, path) for path, digest in fingerprints.items()
+                       if path in stored and stored[path].fingerprint != digest]
+            if not changed:
+                return
+            self._conn.executemany('UPDATE files SET fingerprint = ? WHERE source = ? AND path = ?', changed)
+            for digest, _, path in changed:
+                stored[path] = stored[path]._replace(fingerprint=digest)
+
+    def delta_state(self, library: str) -> Optional[tuple[str, dict]]:
+        """
+            Returns stored change token of sharepoint document library with files of its tracked folders.
+
+                Parameters:
+                    library (str): site url and id of the library
+
+                Returns:
+                    state (tuple): change token and Collection of folder url: {item id: file}, None if not stored
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT token FROM delta_tokens WHERE library = ?', (library,)).fetchone()
+            if row is None:
+                return None
+            rows = self._conn.execute('SELECT folder, files FROM delta_folders WHERE library = ?', (library,))
+            return row[0], {folder: json.loads(files) for folder, files in rows}
+
+    def set_delta_state(self, library: str, token: str, folders: dict) -> None:
+        """
+            Stores change token of sharepoint document library with files of its folders which changed since the
+            previous token (single transaction), files of other tracked folders are the same as of the new token
+            and their rows are kept.
+
+                Parameters:
+                    library (str): site url and id of the library
+                    token (str): change token
+                    folders (dict): Collection of folder url: {item id: file} of changed folders
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('INSERT OR REPLACE INTO delta_tokens (library, token) VALUES (?, ?)',
+                                   (library, token))
+                self._conn.executemany('INSERT OR REPLACE INTO delta_folders (library, folder, files) '
+                                       'VALUES (?, ?, ?)',
+                                       [(library, folder, json.dumps(files)) for folder, files in folders.items()])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def forget(self, source: str) -> None:
+        """
+            Drops stored state of source files (e.g. source configuration changed), next update stores new baseline
+            without reporting changes. Pending changes and run journal of the source are kept.
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._conn.execute('DELETE FROM files WHERE source = ?', (source,))
+            self._conn.execute('DELETE FROM sources WHERE source = ?', (source,))
+            self._known.discard(source)
+            self._files.pop(source, None)
+
+    def reload(self, source: str) -> None:
+        """
+            Drops cached state of the source, next use reads it from the database again (source taken over from
+            another instance sharing the database in cluster mode).
+
+                Parameters:
+                    source (str): source name
+
+                Returns:
+                    None
+        """
+        with self._lock:
+            self._files.pop(source, None)
+            if self._conn.execute('SELECT 1 FROM sources WHERE source = ?', (source,)).fetchone():
+                self._known.add(source)
+            else:
+                self._known.discard(source)
+
+    def close(self) -> None:
+        """
+            Closes database, WAL is checkpointed into the main file.
+        """
+        with self._lock:
+            self._conn.close()
+
+
+def state_store(path: str = './logs/state.sqlite3', fallback: bool = True, timeout: float = 5.0) -> StateStore:
+    """
+        Returns state store, database file is created if it does not exist. Falls back to in-memory store if
+        database cannot be opened (state is not kept between runs then), unless fallback is disabled (cluster mode,
+        state is shared by instances), then error is raised.
+
+            Parameters:
+                path (str): path of the database file
+                fallback (bool): use in-memory store if database cannot be opened
+                timeout (float): time in seconds to wait for write lock held by other instance (cluster mode)
+
+            Returns:
+                store (StateStore): state store
+    """
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return StateStore(path, timeout)
+    except (OSError, sqlite3.Error) as exc:
+        if not fallback:
+            raise
+        logging.getLogger(__name__).warning(f'State store {path} not available ({exc}), state kept in memory only')
+        return StateStore(':memory:')
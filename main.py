@@ -1,60 +1,253 @@
-import pickle
+import sys
+import atexit
+import signal
+import sqlite3
 import logging
 
-from time import sleep
-from multiprocessing import Process, Queue
-from typing import NoReturn
+from functools import partial
+from time import monotonic
+from multiprocessing import Process
+from typing import NamedTuple, NoReturn
 
-from helpers.config import config_loader
-from helpers.log import listener_process, listener_configurer, worker_configurer
-from helpers.filewatcher import sources_latest_date_modified, sources_comparison, process_files
+from helpers.config import config_loader, log_settings_loader
+from helpers.log import listener_process, listener_configurer, worker_configurer, queue_backlog, log_queue
+from helpers.metrics import registry, CYCLE_SECONDS, CYCLE_OVERRUNS, CYCLE_SOURCES, POLL_TIME_SECONDS, \
+    DISPATCH_QUEUE_DEPTH, DISPATCH_RUNNING, LOG_QUEUE_BACKLOG
+from helpers.poller import SourcePoller
+from helpers.inotify import InotifyWatcher
+from helpers.dispatcher import WorkerPool
+from helpers.scheduler import PollScheduler
+from helpers.sharepoint import retry_after
+from helpers.fingerprint import FingerprintCache
+from helpers.stability import WriteStabilizer
+from helpers.state import state_store
+from helpers.cluster import ClusterMembership, source_groups, owned_sources
+from helpers.reload import ConfigWatcher, sources_diff, CONFIG_CHECK_INTERVAL, RELOADABLE_SETTINGS
+from helpers.filewatcher import sources_files_snapshot, sources_content_filter, source_run_started, process_files
+
+
+CONFIG_PATH = './config.ini'
+# delay in seconds before sources whose state could not be stored are polled again
+STORE_RETRY_DELAY = 5.0
+
+
+def active_intervals(active: tuple[NamedTuple, ...], intervals: dict[str, float]) -> dict[str, float]:
+    """
+        Returns base poll intervals of sources polled by this instance.
+
+            Parameters:
+                active (tuple): Collection of sources polled by this instance
+                intervals (dict): Collection of source name: base poll interval of all sources
+
+            Returns:
+                intervals (dict): Collection of source name: base poll interval of polled sources
+    """
+    return {source.name: intervals[source.name] for source in active if source.name in intervals}
 
 
 def main() -> NoReturn:
-    queue = Queue(-1)
+    # log queue is bounded and shared with spawned workers of the pool (same context), workers get the same levels
+    log_config = log_settings_loader(CONFIG_PATH)
+    queue = log_queue(log_config.queue_size)
     listener = Process(target=listener_process, args=(listener_configurer, queue))
     listener.start()
 
-    worker_configurer(queue)
+    configurer = partial(worker_configurer, settings=log_config)
+    configurer(queue)
     logger_main = logging.getLogger(__name__)
 
-    mode, poll_time, sources, source_exec, source_paths = config_loader('./config.ini')
-
-    logger_main.info(f'FileWatcher started, mode: {mode}, polling interval: {poll_time} sec')
+    mode, poll_time, sources, source_exec, source_paths, settings = config_loader(CONFIG_PATH)
+
+    # cluster mode: instances sharing the config split sources (groups of sources linked by upstreams) with leases,
+    # only owned sources are polled and dispatched, ownership is rebalanced when instances join or die
+    cluster = ClusterMembership(settings.cluster, settings.cluster_instance, settings.cluster_lease) \
+        if settings.cluster else None
+    groups = source_groups(sources)
+    if cluster is not None:
+        cluster.start()
+        # leases are released on exit, SIGTERM (service stop) exits through interpreter shutdown to run atexit too
+        atexit.register(cluster.leave)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        cluster.rebalance(set(groups.values()))
+    active = owned_sources(sources, cluster)
+
+    poller = SourcePoller(settings.workers, settings.source_timeout)
+    watcher = InotifyWatcher(active, settings.event_coalesce) if mode == 'local' and settings.local_events else None
+    stabilizer = WriteStabilizer(settings.stability)
+    # instances sharing the database wait for each other's writes as long as for the cluster database, well
+    # within the lease, a write still failing on lock skips the cycle of affected sources and is retried
+    store = state_store(settings.state_path, fallback=cluster is None,
+                        timeout=settings.cluster_lease / 3 if cluster is not None else 5.0)
+    pool = WorkerPool(settings.pool_size, configurer, queue,
+                      partial(source_run_started, sources=sources, mode=mode, settings=settings, store=store),
+                      store.run_finished, settings.downstream, settings.policies)
+    fingerprints = FingerprintCache(store) if settings.fingerprint and mode != 'sharepoint' else None
+    scheduler = PollScheduler(active, active_intervals(active, settings.intervals), settings.interval_min_factor,
+                              settings.interval_max_factor, settings.interval_backoff)
+
+    config_watcher = ConfigWatcher(CONFIG_PATH)
+
+    registry.start(settings.metrics_port, settings.metrics_file, settings.metrics_interval)
+    POLL_TIME_SECONDS.set(poll_time)
+    DISPATCH_QUEUE_DEPTH.set_function(lambda: pool.queue_depth)
+    DISPATCH_RUNNING.set_function(lambda: pool.running)
+    LOG_QUEUE_BACKLOG.set_function(partial(queue_backlog, queue))
+
+    logger_main.info(f'FileWatcher started, mode: {mode}, polling interval: {poll_time} sec, '
+                     f'workers: {settings.workers}' +
+                     (f', cluster instance: {cluster.instance}, owned sources: {len(active)}/{len(sources)}'
+                      if cluster is not None else ''))
+
+    # all sources are scanned right away, sources without stored state (first start or newly configured) get
+    # a baseline, sources changed while program was stopped or whose last run did not succeed are dispatched
+    # unless their inputs are the same as in the last successful run
+    try:
+        store.update(sources_files_snapshot(active, mode, poller, settings, store))
+    except sqlite3.Error as exc:
+        logger_main.error(f'Initial state of sources not stored ({exc}), taken on next poll')
+    # unprocessed sources wait for their stability window like changes detected by polling
+    sources2refresh = stabilizer.update((), store.unprocessed([source.name for source in active]))
+    scheduler.defer(stabilizer.wake_times())
+    if sources2refresh:
+        process_files(sources2refresh, source_exec, source_paths, configurer, queue, pool, store,
+                      settings.policies)
 
     while True:
 
-        if 'watching' not in locals():
-
+        if config_watcher.requested():
+            # config reload: only the delta of sources is applied, connections, state and in-flight jobs of
+            # unchanged sources are kept, new and changed sources get new baseline
             try:
-                with open('./logs/dir_modified_dates.pickle', 'rb') as f:
-                    last_check_dates = pickle.load(f)
-                    f.close()
-            except FileNotFoundError:
-                logger_main.warning(f'File not found, probably first start, if error will persist check the access')
-            except EOFError:
-                logger_main.warning(f'File is empty, check the file if error persist')
-            finally:
+                new_mode, _, new_sources, new_exec, new_paths, new_settings = config_loader(CONFIG_PATH, reload=True)
+            except Exception:
+                logger_main.exception('Config reload failed, running configuration kept')
+            else:
+                if new_mode != mode or \
+                        new_settings._replace(**{f: None for f in RELOADABLE_SETTINGS}) != \
+                        settings._replace(**{f: None for f in RELOADABLE_SETTINGS}):
+                    logger_main.warning('Changes of working mode and [Environs] options are applied after restart')
+
+                delta = sources_diff(sources, new_sources)
+                sources, source_exec, source_paths = new_sources, new_exec, new_paths
+                groups = source_groups(sources)
+                active = owned_sources(sources, cluster)
+                settings = settings._replace(**{f: getattr(new_settings, f) for f in RELOADABLE_SETTINGS})
+                rescan = set(delta.added + delta.changed)
+
+                # stored state is shared in cluster mode, only owner of changed source starts it from scratch
+                for name in set(delta.changed) & {source.name for source in active}:
+                    try:
+                        store.forget(name)
+                    except sqlite3.Error as exc:
+                        logger_main.error(f'Stored state of {name} not reset ({exc}), changes are reported against '
+                                          f'previous configuration')
+                    if fingerprints is not None:
+                        fingerprints.forget(name)
+
+                scheduler.configure(active, active_intervals(active, settings.intervals), rescan)
+                stabilizer.configure(settings.stability)
+                pool.configure(partial(source_run_started, sources=sources, mode=mode, settings=settings, store=store),
+                               settings.downstream, settings.policies)
+
+                if watcher is not None and (rescan or delta.removed):
+                    previous, watcher = watcher, InotifyWatcher(active, settings.event_coalesce)
+                    scheduler.wake(previous.wait(0))
+                    previous.close()
+
+                if rescan:
+                    try:
+                        store.update(sources_files_snapshot(tuple(s for s in active if s.name in rescan), mode,
+                                                            poller, settings, store))
+                    except sqlite3.Error as exc:
+                        logger_main.error(f'Baseline of reloaded sources not stored ({exc}), taken on next poll')
+
+                logger_main.info(f'Config reloaded, sources added: {list(delta.added)}, changed: '
+                                 f'{list(delta.changed)}, removed: {list(delta.removed)}')
+
+        if cluster is not None and cluster.rebalance_due():
+            # sources taken over from other instances continue from state stored by their previous owner, changes
+            # since then and runs interrupted by dead owner are dispatched; released sources are no longer polled
+            cluster.rebalance(set(groups.values()), {groups[name] for name in pool.busy if name in groups})
+            previous_active, active = active, owned_sources(sources, cluster)
+            taken = sources_diff(previous_active, active)
+
+            if taken.added or taken.removed:
+                for name in taken.added:
+                    store.reload(name)
+                    if fingerprints is not None:
+                        fingerprints.forget(name)
+
+                scheduler.configure(active, active_intervals(active, settings.intervals), taken.added)
+
+                if watcher is not None:
+                    previous, watcher = watcher, InotifyWatcher(active, settings.event_coalesce)
+                    scheduler.wake(previous.wait(0))
+                    previous.close()
+
+                if taken.added:
+                    try:
+                        store.update(sources_files_snapshot(tuple(s for s in active if s.name in taken.added),
+                                                            mode, poller, settings, store))
+                        sources2refresh = stabilizer.update((), store.unprocessed(list(taken.added)))
+                        scheduler.defer(stabilizer.wake_times())
+                    except sqlite3.Error as exc:
+                        logger_main.error(f'State of sources taken over not stored ({exc}), changes are detected '
+                                          f'on next poll')
+                        sources2refresh = []
+                    if sources2refresh:
+                        process_files(sources2refresh, source_exec, source_paths, configurer, queue, pool, store,
+                                      settings.policies)
+
+        if watcher is None:
+            config_watcher.wait(min(scheduler.wait_time(), CONFIG_CHECK_INTERVAL))
+        else:
+            scheduler.wake(watcher.wait(min(scheduler.wait_time(), CONFIG_CHECK_INTERVAL)))
+
+        polled = scheduler.due()
+        sources2check = tuple(source for source in sources if source.name in polled)
+
+        if not sources2check:
+            continue
 
-                if 'last_check_dates' not in locals():
-                    last_check_dates = sources_latest_date_modified(sources, mode)
-                watching = True
+        cycle_started = monotonic()
+        try:
+            deltas = store.update(sources_files_snapshot(sources2check, mode, poller, settings, store))
+        except sqlite3.Error as exc:
+            # state is rolled back, changes are detected again once the sources are polled next time
+            logger_main.error(f'State of {len(sources2check)} sources not stored ({exc}), '
+                              f'next attempt in {STORE_RETRY_DELAY:.0f} sec')
+            scheduler.defer({name: STORE_RETRY_DELAY for name in polled})
+            continue
 
-        sleep(poll_time)
+        sources2refresh = list(deltas)
 
-        current_check_dates = sources_latest_date_modified(sources, mode)
+        throttled = {name: delay for name, exc in poller.errors.items() if (delay := retry_after(exc)) is not None}
+        scheduler.reschedule(polled, sources2refresh, throttled, watcher.event_sources if watcher else ())
 
-        sources2refresh = sources_comparison(last_check_dates, current_check_dates)
+        sources2refresh = stabilizer.update(polled, sources2refresh)
+        scheduler.defer(stabilizer.wake_times())
 
-        last_check_dates = current_check_dates
+        logger_main.debug(f'Checked {len(sources2check)} sources, changed: {len(deltas)}')
 
-        checked_at = last_check_dates.get('CHECKED_AT')
-        logger_main.debug(f'Last check at: {checked_at}')
+        if fingerprints is not None and sources2refresh:
+            sources2refresh = sources_content_filter(sources2refresh, sources, fingerprints)
 
-        if not sources2refresh:
-            continue
+        if cluster is not None and sources2refresh:
+            lost = [name for name in sources2refresh if not cluster.owns(groups.get(name))]
+            if lost:
+                logger_main.warning(f'Lease of {lost} lost, dispatch left to their new owner')
+                sources2refresh = [name for name in sources2refresh if name not in lost]
+
+        if sources2refresh:
+            process_files(sources2refresh, source_exec, source_paths, configurer, queue, pool, store,
+                          settings.policies)
 
-        process_files(sources2refresh, source_exec, source_paths, worker_configurer, queue)
+        cycle_time = monotonic() - cycle_started
+        CYCLE_SECONDS.observe(cycle_time)
+        CYCLE_SOURCES.inc('polled', value=len(sources2check))
+        CYCLE_SOURCES.inc('dispatched', value=len(sources2refresh))
+        if cycle_time > poll_time:
+            CYCLE_OVERRUNS.inc()
 
 
 if __name__ == '__main__':
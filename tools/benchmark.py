@@ -0,0 +1,525 @@
+"""
+    Reproducible benchmark of SharepointFileWatcher hot paths. Each scenario runs in its own process (CPU time and
+    peak RSS are not shared between scenarios, SharePoint stub runs in separate process as well) and results are
+    written as JSON, so runs of different commits can be compared and regressions found before deployment.
+
+        Scenarios:
+            local_poll   synthetic local tree (files spread over folders, one source per folder), cycle time, CPU
+                         time and peak RSS of polling all sources (sources_files_snapshot + state store update),
+                         given share of files is modified before each cycle
+            sp_poll      the same against local SharePoint stub with injected latency and throttling, with full
+                         folder listings and with change token (delta) queries
+            dispatch     time from change of a file to dispatch of its executable (process_files) and to start of
+                         the executable in pooled worker, per-run cost of pooled worker and of Process per run
+
+        Run:
+            python3 -m tools.benchmark --files 1000 10000 100000 --change-rate 0.01 --output ./logs/bench.json
+            python3 -m tools.benchmark --files 1000 10000 --compare ./logs/bench.json   # exit code 1 on regression
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from threading import Event
+from functools import partial
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from multiprocessing import get_context
+from statistics import median
+from time import monotonic, perf_counter, process_time, time_ns
+from typing import Optional
+
+import requests
+
+from helpers.dispatcher import WorkerPool
+from helpers.filewatcher import sources_files_snapshot, process_files
+from helpers.inotify import InotifyWatcher
+from helpers.poller import SourcePoller
+from helpers.sharepoint import SpClientContext
+from helpers.state import StateStore
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SP_ROOT = '/teams/stub/Shared Documents'
+# metrics compared by --compare, lower is better
+COMPARED_SUFFIXES = ('_s', '_mb')
+
+source = namedtuple("source", "name, func, files, upstream", defaults=[None, None, None, ()])
+file = namedtuple("file", "local_path, ctx, sp_url, tenant", defaults=[None, None, None, None])
+bench_settings = namedtuple("bench_settings", "sp_delta, sp_page_size", defaults=[False, 500])
+
+
+def noop(source: str, file: str) -> None:
+    """
+        Executable doing nothing, measures pure dispatch cost.
+    """
+
+
+def stamp(source: str, file: str) -> None:
+    """
+        Executable which appends its start time (monotonic clock, shared by processes) to the file given as source.
+    """
+    with open(source, 'a') as f:
+        f.write(f'{monotonic()}\n')
+
+
+def quiet_configurer(queue: Optional[object] = None) -> None:
+    """
+        Logger configurer of benchmark processes, only errors are kept and printed, so logging does not distort
+        measurements.
+    """
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(logging.StreamHandler())
+    root.setLevel(logging.ERROR)
+
+
+class StubTokenProvider:
+    """
+        Token provider of the SharePoint stub, stub does not check authentication.
+    """
+
+    def authenticate_request(self, request) -> None:
+        request.set_header('Authorization', 'Bearer stub')
+
+    def invalidate(self) -> None:
+        pass
+
+
+def peak_rss_mb() -> Optional[float]:
+    """
+        Returns peak resident set size of current process in MB, None where not available (Windows).
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def summary(values: list[float]) -> dict[str, float]:
+    """
+        Returns min, median, 95th percentile and max of measured values.
+    """
+    if not values:
+        return {}
+
+    ordered = sorted(values)
+    return {'min': round(ordered[0], 6), 'median': round(median(ordered), 6),
+            'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 6), 'max': round(ordered[-1], 6)}
+
+
+def generate_tree(root: Path, files: int, files_per_dir: int) -> list[Path]:
+    """
+        Creates synthetic tree of files ('d0000/f0000000.csv', ...), existing tree of the same shape is reused.
+
+            Parameters:
+                root (Path): root folder of the tree
+                files (int): number of files
+                files_per_dir (int): number of files in single folder
+
+            Returns:
+                directories (list): Collection of folders of the tree
+    """
+    marker = root / '.bench_tree'
+    shape = f'{files} {files_per_dir}'
+    directories = [root / f'd{i:04d}' for i in range((files + files_per_dir - 1) // files_per_dir)]
+
+    if marker.exists() and marker.read_text() == shape:
+        return directories
+
+    shutil.rmtree(root, ignore_errors=True)
+
+    for i in range(files):
+        directory = directories[i // files_per_dir]
+        if i % files_per_dir == 0:
+            directory.mkdir(parents=True)
+        with open(directory / f'f{i:07d}.csv', 'w') as f:
+            f.write('x')
+
+    marker.write_text(shape)
+
+    return directories
+
+
+def modify_local(directories: list[Path], files: int, files_per_dir: int, count: int,
+                 rng: random.Random) -> set[str]:
+    """
+        Sets new modify time of randomly picked files, returns names of sources (folders) of modified files.
+    """
+    modified = set()
+    mtime_ns = time_ns()
+
+    for i in rng.sample(range(files), count):
+        os.utime(directories[i // files_per_dir] / f'f{i:07d}.csv', ns=(mtime_ns, mtime_ns))
+        modified.add(f'bench.d{i // files_per_dir:04d}')
+
+    return modified
+
+
+def bench_local_poll(files: int, change_rate: float, cycles: int, files_per_dir: int, workers: int,
+                     workdir: str, seed: int) -> dict:
+    """
+        Measures polling of synthetic local tree: cold cycle (first listing of all folders) and warm cycles with
+        given share of files modified before each of them.
+    """
+    quiet_configurer()
+    rng = random.Random(seed)
+    root = Path(workdir) / f'tree_{files}_{files_per_dir}'
+
+    started = perf_counter()
+    directories = generate_tree(root, files, files_per_dir)
+    generate_s = perf_counter() - started
+
+    sources = tuple(source(f'bench.{directory.name}', noop, {'*.csv': file(directory)}) for directory in directories)
+    poller = SourcePoller(workers, 600)
+    store = StateStore(os.path.join(workdir, f'state_local_{files}.sqlite3'))
+    count = max(1, int(files * change_rate))
+    cycle_s, cycle_cpu_s, missed = [], [], 0
+
+    started, cpu = perf_counter(), process_time()
+    store.update(sources_files_snapshot(sources, 'local', poller))
+    cold_s, cold_cpu_s = perf_counter() - started, process_time() - cpu
+
+    for _ in range(cycles):
+        modified = modify_local(directories, files, files_per_dir, count, rng)
+        started, cpu = perf_counter(), process_time()
+        deltas = store.update(sources_files_snapshot(sources, 'local', poller))
+        cycle_s.append(perf_counter() - started)
+        cycle_cpu_s.append(process_time() - cpu)
+        missed += len(modified - set(deltas))
+
+    poller.shutdown()
+    store.close()
+    os.remove(os.path.join(workdir, f'state_local_{files}.sqlite3'))
+
+    return {'files': files, 'sources': len(sources), 'change_rate': change_rate, 'modified_per_cycle': count,
+            'generate_s': round(generate_s, 3), 'cold_cycle_s': round(cold_s, 6),
+            'cold_cycle_cpu_s': round(cold_cpu_s, 6), 'cycle_s': summary(cycle_s),
+            'cycle_cpu_s': summary(cycle_cpu_s), 'missed_changes': missed}
+
+
+def stub_server(files: int, folders: int, conn) -> None:
+    """
+        Runs SharePoint stub with generated document library in separate process, sends its url through the pipe.
+    """
+    from tools.sp_stub_server import SharePointStub, make_server
+
+    stub = SharePointStub()
+    modified = datetime.now(timezone.utc) - timedelta(days=1)
+
+    for i in range(files):
+        stub.put_file(f'{SP_ROOT}/d{i % folders:04d}', f'f{i:07d}.csv', modified=modified)
+
+    server = make_server(stub)
+    conn.send(f'http://127.0.0.1:{server.server_address[1]}{stub.site_path}')
+    server.serve_forever()
+
+
+def bench_sp_poll(files: int, change_rate: float, cycles: int, folders: int, latency_ms: float, throttle: int,
+                  sp_delta: bool, workers: int, page_size: int, seed: int) -> dict:
+    """
+        Measures polling of sharepoint folders served by local stub (in separate process) with injected latency
+        of each request and optional throttling (first requests of each cycle answered with HTTP 429).
+    """
+    quiet_configurer()
+    rng = random.Random(seed)
+    context = get_context('spawn')
+    parent_conn, child_conn = context.Pipe()
+    server = context.Process(target=stub_server, args=(files, folders, child_conn), daemon=True)
+    server.start()
+    site_url = parent_conn.recv()
+    control = requests.Session()
+    stub_url = site_url.split('/teams/')[0]
+
+    def _stub(method: str, path: str, body: Optional[dict] = None) -> dict:
+        response = control.request(method, f'{stub_url}/_stub/{path}', json=body)
+        response.raise_for_status()
+        return response.json()
+
+    ctx = SpClientContext(site_url, StubTokenProvider(), workers)
+    sources = tuple(source(f'bench.d{i:04d}', noop, {'*.csv': file(Path('.'), ctx, f'{SP_ROOT}/d{i:04d}', 'stub')})
+                    for i in range(folders))
+    settings = bench_settings(sp_delta, page_size)
+    poller = SourcePoller(workers, 600)
+    store = StateStore(':memory:')
+    count = max(1, int(files * change_rate))
+    cycle_s, cycle_cpu_s, requests_per_cycle, failed, missed = [], [], [], 0, 0
+
+    _stub('POST', 'latency', {'seconds': latency_ms / 1000})
+
+    started, cpu, served = perf_counter(), process_time(), _stub('GET', 'stats')['requests']
+    store.update(sources_files_snapshot(sources, 'sharepoint', poller, settings, store))
+    cold_s, cold_cpu_s = perf_counter() - started, process_time() - cpu
+    cold_requests = _stub('GET', 'stats')['requests'] - served
+
+    for cycle in range(cycles):
+        modified = set()
+        for i in rng.sample(range(files), count):
+            _stub('POST', 'files', {'folder': f'{SP_ROOT}/d{i % folders:04d}', 'name': f'f{i:07d}.csv',
+                                    'modified': (datetime.now(timezone.utc) + timedelta(seconds=cycle)).isoformat()})
+            modified.add(f'bench.d{i % folders:04d}')
+        if throttle:
+            _stub('POST', 'throttle', {'count': throttle, 'retry_after': 1})
+
+        served = _stub('GET', 'stats')['requests']
+        started, cpu = perf_counter(), process_time()
+        deltas = store.update(sources_files_snapshot(sources, 'sharepoint', poller, settings, store))
+        cycle_s.append(perf_counter() - started)
+        cycle_cpu_s.append(process_time() - cpu)
+        requests_per_cycle.append(_stub('GET', 'stats')['requests'] - served)
+        failed += len(poller.errors)
+        missed += len(modified - set(deltas) - set(poller.errors))
+
+    poller.shutdown()
+    server.kill()
+
+    return {'files': files, 'sources': folders, 'change_rate': change_rate, 'modified_per_cycle': count,
+            'sp_delta': sp_delta, 'latency_ms': latency_ms, 'throttled_requests_per_cycle': throttle,
+            'cold_cycle_s': round(cold_s, 6), 'cold_cycle_cpu_s': round(cold_cpu_s, 6),
+            'cold_cycle_requests': cold_requests, 'cycle_s': summary(cycle_s), 'cycle_cpu_s': summary(cycle_cpu_s),
+            'requests_per_cycle': summary(requests_per_cycle), 'failed_polls': failed, 'missed_changes': missed}
+
+
+def bench_dispatch(runs: int, pool_size: int, events: bool, workdir: str) -> dict:
+    """
+        Measures latency from change of a file to dispatch of its executable to worker pool (poll of the changed
+        source, state update, process_files) and to start of the executable, cost of single pooled run and of
+        single run in Process started per run (process_files without pool). With events, change is detected by
+        inotify, otherwise source is polled right after the change (engine overhead only, without poll interval).
+    """
+    quiet_configurer()
+    root = Path(workdir) / 'dispatch'
+    shutil.rmtree(root, ignore_errors=True)
+    names = [f'bench.s{i}' for i in range(pool_size)]
+
+    for name in names:
+        (root / name).mkdir(parents=True)
+        (root / name / 'input.csv').write_text('x')
+
+    sources = tuple(source(name, stamp, {'input.csv': file(root / name)}) for name in names)
+    source_exec = {name: stamp for name in names}
+    source_paths = {name: {'source': os.fspath(root / f'{name}.stamps'), 'file': 'input.csv'} for name in names}
+    store = StateStore(os.path.join(workdir, 'state_dispatch.sqlite3'))
+    store.update(sources_files_snapshot(sources, 'local'))
+    finished, done = {}, Event()
+
+    def _finished(name: str, changes, exitcode: int, error: Optional[str]) -> None:
+        store.run_finished(name, changes, exitcode, error)
+        finished[name] = monotonic()
+        done.set()
+
+    started = monotonic()
+    pool = WorkerPool(pool_size, quiet_configurer, None, store.run_started, _finished)
+    pool.dispatch([names[0]], {names[0]: noop}, {names[0]: {'source': '', 'file': ''}})
+    done.wait(60)
+    pool_start_s = monotonic() - started
+    watcher = InotifyWatcher(sources, 0.0) if events else None
+    events = bool(watcher and watcher.event_sources)
+    to_dispatch, to_start, to_finish, pooled_run = [], [], [], []
+
+    for i in range(runs):
+        name = names[i % len(names)]
+        done.clear()
+        changed = monotonic()
+        (root / name / 'input.csv').write_text(str(i))
+
+        polled = watcher.wait(5) if events else {name}
+        deltas = store.update(sources_files_snapshot(tuple(s for s in sources if s.name in polled), 'local'))
+        dispatching = monotonic()
+        process_files(list(deltas), source_exec, source_paths, quiet_configurer, None, pool, store)
+        dispatched = monotonic()
+        done.wait(60)
+
+        started = float(Path(source_paths[name]['source']).read_text().split()[-1])
+        to_dispatch.append(dispatched - changed)
+        to_start.append(started - changed)
+        to_finish.append(finished[name] - changed)
+        pooled_run.append(finished[name] - dispatching)
+
+    pool.shutdown(5)
+    if watcher is not None:
+        watcher.close()
+
+    process_run = []
+    for _ in range(max(1, runs // 4)):
+        started = monotonic()
+        process_files([names[0]], {names[0]: noop}, {names[0]: {'source': '', 'file': ''}}, quiet_configurer, None)
+        process_run.append(monotonic() - started)
+
+    store.close()
+    shutil.rmtree(root, ignore_errors=True)
+    os.remove(os.path.join(workdir, 'state_dispatch.sqlite3'))
+
+    return {'runs': runs, 'pool_size': pool_size, 'detection': 'inotify' if events else 'poll',
+            'pool_start_s': round(pool_start_s, 6), 'change_to_dispatch_s': summary(to_dispatch),
+            'change_to_start_s': summary(to_start), 'change_to_finish_s': summary(to_finish),
+            'pooled_run_s': summary(pooled_run), 'process_per_run_s': summary(process_run)}
+
+
+def _isolated(func: partial, results) -> None:
+    try:
+        result = func()
+        result['peak_rss_mb'] = peak_rss_mb()
+        results.put(result)
+    except Exception as exc:
+        results.put({'error': f'{exc.__class__.__name__}: {exc}'})
+
+
+def run_isolated(scenario: str, func: partial) -> dict:
+    """
+        Runs scenario in separate (spawned) process and returns its results.
+    """
+    context = get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_isolated, args=(func, results), name=scenario)
+    process.start()
+    result = results.get()
+    process.join()
+    print(f'{scenario}: {json.dumps(result)}', file=sys.stderr)
+    return {'scenario': scenario, **result}
+
+
+def revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result: dict, prefix: str = '') -> dict[str, float]:
+    """
+        Returns numeric metrics of single result as flat Collection of 'metric.statistic': value.
+    """
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def result_key(result: dict) -> tuple:
+    return tuple((key, value) for key, value in result.items()
+                 if key in ('scenario', 'files', 'sources', 'change_rate', 'sp_delta', 'latency_ms',
+                            'throttled_requests_per_cycle', 'runs', 'pool_size', 'detection'))
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float) -> list[str]:
+    """
+        Returns regressions against baseline results: time and memory metrics (median and p95 of cycles) of the same
+        scenario and parameters worse by more than given share.
+
+            Parameters:
+                results (list): Collection of current results
+                baseline (list): Collection of baseline results
+                threshold (float): allowed relative slowdown, e.g. 0.2 for 20%
+
+            Returns:
+                regressions (list): Collection of descriptions of regressed metrics
+    """
+    baseline = {result_key(result): flatten(result) for result in baseline}
+    regressions = []
+
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        for metric, value in flatten(result).items():
+            name = metric.rsplit('.', 1)[0] if '.' in metric else metric
+            if not name.endswith(COMPARED_SUFFIXES) or metric.endswith(('.min', '.max')) or \
+                    metric == 'generate_s' or not previous.get(metric):
+                continue
+            if value > previous[metric] * (1 + threshold):
+                regressions.append(f"{result['scenario']} {dict(result_key(result)[1:])} {metric}: "
+                                   f"{previous[metric]} -> {value} ({value / previous[metric] - 1:+.1%})")
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark of SharepointFileWatcher hot paths')
+    parser.add_argument('--scenarios', nargs='+', default=['local_poll', 'sp_poll', 'dispatch'],
+                        choices=['local_poll', 'sp_poll', 'dispatch'])
+    parser.add_argument('--files', nargs='+', type=int, default=[1000, 10000, 100000],
+                        help='sizes of local trees (1k - 1M files)')
+    parser.add_argument('--files-per-dir', type=int, default=1000, help='files per folder (source)')
+    parser.add_argument('--change-rate', nargs='+', type=float, default=[0.01],
+                        help='share of files modified before each cycle')
+    parser.add_argument('--cycles', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=8, help='sources polled concurrently')
+    parser.add_argument('--sp-files', nargs='+', type=int, default=[1000, 10000])
+    parser.add_argument('--sp-folders', type=int, default=10)
+    parser.add_argument('--sp-latency', nargs='+', type=float, default=[0.0, 50.0], help='latency of request, ms')
+    parser.add_argument('--sp-throttle', type=int, default=0, help='throttled requests at start of each cycle')
+    parser.add_argument('--sp-page-size', type=int, default=500)
+    parser.add_argument('--runs', type=int, default=20, help='dispatched runs')
+    parser.add_argument('--pool-size', type=int, default=4)
+    parser.add_argument('--no-events', action='store_true', help='poll instead of inotify in dispatch scenario')
+    parser.add_argument('--workdir', default=None, help='folder for synthetic trees, kept and reused if given')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='path of JSON results, printed to stdout if not given')
+    parser.add_argument('--compare', default=None, help='baseline JSON results, exit code 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against baseline')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sfw_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+
+    try:
+        if 'local_poll' in args.scenarios:
+            for files in args.files:
+                for change_rate in args.change_rate:
+                    results.append(run_isolated('local_poll', partial(
+                        bench_local_poll, files, change_rate, args.cycles, args.files_per_dir, args.workers, workdir,
+                        args.seed)))
+
+        if 'sp_poll' in args.scenarios:
+            for files in args.sp_files:
+                for latency_ms in args.sp_latency:
+                    for sp_delta in (False, True):
+                        results.append(run_isolated('sp_poll', partial(
+                            bench_sp_poll, files, args.change_rate[0], args.cycles, args.sp_folders, latency_ms,
+                            args.sp_throttle, sp_delta, args.workers, args.sp_page_size, args.seed)))
+
+        if 'dispatch' in args.scenarios:
+            results.append(run_isolated('dispatch', partial(bench_dispatch, args.runs, args.pool_size,
+                                                            not args.no_events, workdir)))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {'meta': {'revision': revision(), 'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                       'python': platform.python_version(), 'platform': platform.platform(),
+                       'cpu_count': os.cpu_count(), 'args': vars(args)},
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+    Local stub of SharePoint REST endpoints used by SharepointFileWatcher. Keeps a single document library in memory
+    together with its change log, so delta (change token) queries and full listings can be exercised without real
+    tenant.
+
+        Run:
+            python3 -m tools.sp_stub_server --port 8000 --folder "/teams/stub/Shared Documents/data" --files 100
+
+        Control endpoints (JSON):
+            POST   /_stub/files     add or modify file {"folder": ..., "name": ..., "length": ..., "modified": ...}
+            DELETE /_stub/files     delete file ?folder=...&name=...
+            POST   /_stub/expire    drop change log, old tokens expire
+            POST   /_stub/throttle  answer next requests with HTTP 429 {"count": ..., "retry_after": ...}
+            POST   /_stub/latency   delay every REST request {"seconds": ...}
+            GET    /_stub/stats     number of served REST requests and stored files
+"""
+import re
+import json
+import uuid
+import argparse
+from time import sleep
+from threading import Lock, Thread
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional
+from xml.sax.saxutils import unescape
+
+CHANGE_ADD, CHANGE_UPDATE, CHANGE_DELETE = 1, 2, 3
+
+FILTER_TERMS = {
+    'eq': (re.compile(r"Name eq ('(?:[^']|'')*')"), lambda name, value: name == value),
+    'startswith': (re.compile(r"startswith\(Name,('(?:[^']|'')*')\)"), lambda name, value: name.startswith(value)),
+    'substringof': (re.compile(r"substringof\(('(?:[^']|'')*'),Name\)"), lambda name, value: value in name),
+}
+ITEM_ID_TERM = re.compile(r'\bId eq (\d+)')
+FOLDER_TERM = re.compile(r"FileDirRef eq ('(?:[^']|'')*')")
+
+
+def odata_value(literal: str) -> str:
+    return literal[1:-1].replace("''", "'") if literal.startswith("'") else literal
+
+
+class SharePointStub:
+    """
+        In memory document library with change log.
+
+            Parameters:
+                site_path (str): server relative url of the site, e.g. /teams/stub
+    """
+
+    def __init__(self, site_path: str = '/teams/stub'):
+        self.site_path = '/' + site_path.strip('/')
+        self.list_id = str(uuid.uuid4())
+        self.items = {}
+        self.changes = []
+        self.first_seq = 1
+        self.seq = 0
+        self.requests = 0
+        self.throttled = 0
+        self.retry_after = 0
+        self.latency = 0.0
+        self._index = {}
+        self._last_id = 0
+        self.lock = Lock()
+
+    def token(self, seq: int) -> str:
+        return f'1;3;{self.list_id};0;{seq}'
+
+    def _log(self, change_type: int, item_id: int) -> None:
+        self.seq += 1
+        self.changes.append((self.seq, change_type, item_id))
+
+    def find(self, folder: str, name: str) -> Optional[int]:
+        return self._index.get((('/' + folder.strip('/')).lower(), name))
+
+    def put_file(self, folder: str, name: str, length: int = 1024, modified: Optional[datetime] = None) -> int:
+        with self.lock:
+            modified = (modified or datetime.now(timezone.utc)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            item_id = self.find(folder, name)
+            if item_id is None:
+                self._last_id = item_id = self._last_id + 1
+                self.items[item_id] = {'folder': '/' + folder.strip('/'), 'name': name}
+                self._index[(self.items[item_id]['folder'].lower(), name)] = item_id
+                self._log(CHANGE_ADD, item_id)
+            else:
+                self._log(CHANGE_UPDATE, item_id)
+            self.items[item_id].update(length=length, modified=modified)
+            return item_id
+
+    def delete_file(self, folder: str, name: str) -> None:
+        with self.lock:
+            item_id = self.find(folder, name)
+            if item_id is not None:
+                del self.items[item_id]
+                del self._index[(('/' + folder.strip('/')).lower(), name)]
+                self._log(CHANGE_DELETE, item_id)
+
+    def expire(self) -> None:
+        with self.lock:
+            self.changes = []
+            self.first_seq = self.seq + 1
+
+    def throttle(self, count: int, retry_after: int = 5) -> None:
+        with self.lock:
+            self.throttled, self.retry_after = count, retry_after
+
+    def delay(self, seconds: float) -> None:
+        with self.lock:
+            self.latency = seconds
+
+    def file_json(self, item_id: int) -> dict:
+        item = self.items[item_id]
+        return {'Name': item['name'], 'TimeLastModified': item['modified'], 'Length': str(item['length']),
+                'ServerRelativeUrl': f"{item['folder']}/{item['name']}", 'ListItemAllFields': {'Id': item_id}}
+
+    def folder_files(self, folder: str, query: dict) -> dict:
+        folder = '/' + folder.strip('/')
+        names = sorted((item['name'], item_id) for item_id, item in self.items.items()
+                       if item['folder'].lower() == folder.lower())
+
+        for term, condition in FILTER_TERMS.values():
+            for literal in term.findall(query.get('$filter', '')):
+                names = [(name, item_id) for name, item_id in names if condition(name, odata_value(literal))]
+
+        # like sharepoint, folder collections ignore $top and return all files without next page link
+        fields = [field.split('/')[0] for field in query['$select'].split(',')] if '$select' in query else None
+        files = [self.file_json(item_id) for _, item_id in names]
+
+        if fields:
+            files = [{key: value for key, value in f.items() if key in fields} for f in files]
+
+        return {'value': files}
+
+    def folder_folders(self, folder: str) -> dict:
+        folder = '/' + folder.strip('/')
+        names = sorted({item['folder'][len(folder) + 1:].split('/', 1)[0] for item in self.items.values()
+                        if item['folder'].lower().startswith(folder.lower() + '/')})
+        return {'value': [{'Name': name} for name in names]}
+
+    def list_items(self, query: dict, base_url: str) -> dict:
+        item_filter = query.get('$filter', '')
+        item_ids = sorted(self.items)
+
+        if ITEM_ID_TERM.search(item_filter):
+            item_ids = [item_id for item_id in map(int, ITEM_ID_TERM.findall(item_filter)) if item_id in self.items]
+        for literal in FOLDER_TERM.findall(item_filter):
+            item_ids = [item_id for item_id in item_ids
+                        if self.items[item_id]['folder'].lower() == odata_value(literal).lower()]
+
+        skip = int(query.get('$skiptoken', 0))
+        top = int(query.get('$top', 100))
+        page = self.items_json(item_ids[skip:skip + top], query)
+        items = page['value']
+
+        # like sharepoint, every full page has next page link (last one may lead to empty page)
+        if len(items) == top:
+            page['odata.nextLink'] = f"{base_url}?{urlencode({**query, '$skiptoken': str(skip + top)})}"
+
+        return page
+
+    def caml_items(self, query: dict, caml: dict) -> dict:
+        # folder scoped query (Scope="FilesOnly"), conditions on ID, FileLeafRef ('In', 'BeginsWith', 'Contains')
+        view = caml.get('ViewXml', '')
+        folder = '/' + caml.get('FolderServerRelativeUrl', '').strip('/')
+
+        def values(tag: str) -> list[str]:
+            return [unescape(value) for block in re.findall(f'<{tag}>(.*?)</{tag}>', view)
+                    for value in re.findall(r'<Value(?: [^>]*)?>(.*?)</Value>', block)]
+
+        min_id = max([int(v) for v in values('Gt')] or [0])
+        names, prefixes, parts = set(values('In')), values('BeginsWith'), values('Contains')
+        item_ids = [item_id for item_id in sorted(self.items) if item_id > min_id and
+                    self.items[item_id]['folder'].lower() == folder.lower() and
+                    (not names or self.items[item_id]['name'] in names) and
+                    all(self.items[item_id]['name'].startswith(p) for p in prefixes) and
+                    all(p in self.items[item_id]['name'] for p in parts)]
+        limit = re.search(r'<RowLimit[^>]*>(\d+)</RowLimit>', view)
+        item_ids = item_ids[:int(limit.group(1))] if limit else item_ids
+        return self.items_json(item_ids, query)
+
+    def items_json(self, item_ids: list[int], query: dict) -> dict:
+        expanded = 'File' in query.get('$expand', '').split(',')
+        items = []
+
+        for item_id in item_ids:
+            item, f = self.items[item_id], self.file_json(item_id)
+            items.append({'Id': item_id, 'FileDirRef': item['folder'], 'FileLeafRef': item['name'],
+                          **({'File': {'TimeLastModified': f['TimeLastModified'], 'Length': f['Length']}}
+                             if expanded else {})})
+
+        return {'value': items}
+
+    def get_changes(self, query: dict) -> tuple[int, dict]:
+        start = int(query['ChangeTokenStart']['StringValue'].rsplit(';', 1)[1])
+        if start < self.first_seq - 1:
+            return 500, {'odata.error': {'code': '-2146233086, System.ArgumentOutOfRangeException',
+                                         'message': {'value': 'The changeToken refers to a time before the start '
+                                                              'of the current change log.'}}}
+        limit = int(query.get('FetchLimit', 1000))
+        changes = [{'ChangeType': change_type, 'ItemId': item_id, 'ChangeToken': {'StringValue': self.token(seq)}}
+                   for seq, change_type, item_id in self.changes if seq > start][:limit]
+        return 200, {'value': changes}
+
+
+ROUTES = [
+    ('GET', re.compile(r'web/?$'), 'web'),
+    ('GET', re.compile(r'web/GetFolderByServerRelativeUrl\(@u\)/Properties$', re.I), 'folder_properties'),
+    ('GET', re.compile(r'web/GetFolderByServerRelativeUrl\(@u\)/Files$', re.I), 'folder_files'),
+    ('GET', re.compile(r'web/GetFolderByServerRelativeUrl\(@u\)/Folders$', re.I), 'folder_folders'),
+    ('GET', re.compile(r"web/lists\(guid'(?P<list_id>[^']+)'\)$", re.I), 'list'),
+    ('POST', re.compile(r"web/lists\(guid'(?P<list_id>[^']+)'\)/GetChanges$", re.I), 'changes'),
+    ('GET', re.compile(r"web/lists\(guid'(?P<list_id>[^']+)'\)/items$", re.I), 'items'),
+    ('POST', re.compile(r"web/lists\(guid'(?P<list_id>[^']+)'\)/GetItems$", re.I), 'get_items'),
+]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    stub: SharePointStub = None
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _reply(self, status: int, body: Optional[dict] = None, headers: Optional[dict] = None) -> None:
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json;odata=nometadata')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self) -> dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _dispatch(self, method: str) -> None:
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path.startswith('/_stub/'):
+            return self._control(method, url.path, query)
+
+        prefix = self.stub.site_path + '/_api/'
+        if not url.path.startswith(prefix):
+            return self._reply(404, {'odata.error': {'message': {'value': 'Not found'}}})
+
+        endpoint = url.path[len(prefix):]
+
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(endpoint)
+            if route_method == method and match:
+                if self.stub.latency:
+                    sleep(self.stub.latency)
+                with self.stub.lock:
+                    self.stub.requests += 1
+                    if self.stub.throttled:
+                        self.stub.throttled -= 1
+                        return self._reply(429, {'odata.error': {'message': {'value': 'Too many requests'}}},
+                                           {'Retry-After': str(self.stub.retry_after)})
+                    return getattr(self, f'_route_{name}')(query, **match.groupdict())
+
+        return self._reply(404, {'odata.error': {'message': {'value': f'No route for {endpoint}'}}})
+
+    def _route_web(self, query: dict) -> None:
+        self._reply(200, {'Title': 'Stub', 'ServerRelativeUrl': self.stub.site_path})
+
+    def _route_folder_properties(self, query: dict) -> None:
+        self._reply(200, {'vti_x005f_listname': '{' + self.stub.list_id + '}'})
+
+    def _route_folder_files(self, query: dict) -> None:
+        self._reply(200, self.stub.folder_files(odata_value(query.get('@u', '')), query))
+
+    def _route_folder_folders(self, query: dict) -> None:
+        self._reply(200, self.stub.folder_folders(odata_value(query.get('@u', ''))))
+
+    def _route_list(self, query: dict, list_id: str) -> None:
+        self._reply(200, {'Id': self.stub.list_id,
+                          'CurrentChangeToken': {'StringValue': self.stub.token(self.stub.seq)}})
+
+    def _route_get_items(self, query: dict, list_id: str) -> None:
+        self._reply(200, self.stub.caml_items(query, self._body()['query']))
+
+    def _route_changes(self, query: dict, list_id: str) -> None:
+        self._reply(*self.stub.get_changes(self._body()['query']))
+
+    def _route_items(self, query: dict, list_id: str) -> None:
+        base_url = f'http://{self.headers.get("Host")}{urlsplit(self.path).path}'
+        self._reply(200, self.stub.list_items(query, base_url))
+
+    def _control(self, method: str, path: str, query: dict) -> None:
+        if path == '/_stub/files' and method == 'POST':
+            body = self._body()
+            modified = datetime.fromisoformat(body['modified']) if body.get('modified') else None
+            item_id = self.stub.put_file(body['folder'], body['name'], int(body.get('length', 1024)), modified)
+            return self._reply(200, {'ItemId': item_id})
+        if path == '/_stub/files' and method == 'DELETE':
+            self.stub.delete_file(query['folder'], query['name'])
+            return self._reply(200, {})
+        if path == '/_stub/throttle' and method == 'POST':
+            body = self._body()
+            self.stub.throttle(int(body.get('count', 1)), int(body.get('retry_after', 5)))
+            return self._reply(200, {})
+        if path == '/_stub/latency' and method == 'POST':
+            self.stub.delay(float(self._body().get('seconds', 0)))
+            return self._reply(200, {})
+        if path == '/_stub/stats' and method == 'GET':
+            return self._reply(200, {'requests': self.stub.requests, 'files': len(self.stub.items)})
+        if path == '/_stub/expire' and method == 'POST':
+            self.stub.expire()
+            return self._reply(200, {})
+        self._reply(404, {})
+
+    def do_GET(self) -> None:
+        self._dispatch('GET')
+
+    def do_POST(self) -> None:
+        self._dispatch('POST')
+
+    def do_DELETE(self) -> None:
+        self._dispatch('DELETE')
+
+
+def make_server(stub: SharePointStub, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    handler = type('BoundStubHandler', (StubHandler,), {'stub': stub})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(stub: SharePointStub, host: str = '127.0.0.1', port: int = 0) -> tuple[ThreadingHTTPServer, str]:
+    """
+        Starts stub server in background thread.
+
+            Parameters:
+                stub (SharePointStub): in memory document library
+                host (str): interface to bind
+                port (int): port to bind, 0 picks free port
+
+            Returns:
+                server (ThreadingHTTPServer): running server (call shutdown() to stop)
+                site_url (str): absolute url of the stub site
+    """
+    server = make_server(stub, host, port)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}{stub.site_path}'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Stub of SharePoint REST endpoints')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--site', default='/teams/stub')
+    parser.add_argument('--folder', default='/teams/stub/Shared Documents')
+    parser.add_argument('--files', type=int, default=0, help='number of generated files in the folder')
+    parser.add_argument('--latency', type=float, default=0.0, help='delay of every REST request in milliseconds')
+    args = parser.parse_args()
+
+    stub = SharePointStub(args.site)
+    stub.delay(args.latency / 1000)
+    for i in range(args.files):
+        stub.put_file(args.folder, f'file_{i:07d}.xlsx')
+
+    server = make_server(stub, args.host, args.port)
+    print(f'SharePoint stub listening on http://{args.host}:{server.server_address[1]}{stub.site_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()